@@ -0,0 +1,629 @@
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+import math
+
+import numpy as np
+import sympy
+
+from parametric import METRICS, compile_expression
+import rendering
+
+
+# Grids with more parameter sets than this are split into chunks and
+# evaluated across a process pool.
+PROCESS_POOL_THRESHOLD = 16384
+
+# The number of parameter sets evaluated per vectorized call. This bounds the
+# size of the intermediate (parameter sets x frequencies) response array.
+CHUNK_SIZE = 4096
+
+# The largest number of parameter sets accepted in a single sweep.
+MAX_GRID_POINTS = 100000
+
+_process_pool = None
+_process_pool_lock = Lock()
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    # The workers are started from the same context as those of background
+    # renders, rather than forked from the (threaded) web server.
+    global _process_pool
+
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                mp_context=rendering.process_context())
+
+        return _process_pool
+
+
+def parameter_axis(spec: Mapping) -> Tuple[str, np.ndarray]:
+    """Builds the values of a single sweep axis.
+
+    Args:
+        spec: A mapping with the parameter 'name', and either an explicit list
+            of 'values', or a 'scale' ('linear' or 'log') with 'start',
+            'stop' and 'num' values.
+
+    Returns:
+        A (name, values) tuple.
+    """
+    name = spec.get('name')
+    if not name:
+        raise ValueError('Sweep axes must have a parameter name.')
+
+    if 'values' in spec:
+        values = np.asarray(spec['values'], dtype=float)
+        if values.ndim != 1 or not len(values):
+            raise ValueError(f'Invalid values for parameter {name}.')
+        return name, values
+
+    scale = spec.get('scale', 'linear')
+    try:
+        start = float(spec['start'])
+        stop = float(spec['stop'])
+        num = int(spec['num'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(
+            f'Parameter {name} must have start, stop and num values.')
+
+    if not 0 < num <= MAX_GRID_POINTS:
+        raise ValueError(
+            f'num must be between 1 and {MAX_GRID_POINTS} for parameter '
+            f'{name}.')
+
+    if scale == 'linear':
+        values = np.linspace(start, stop, num)
+    elif scale == 'log':
+        if start <= 0 or stop <= 0:
+            raise ValueError(
+                f'Log-scaled parameter {name} must have positive bounds.')
+        values = np.geomspace(start, stop, num)
+    else:
+        raise ValueError(f'Invalid scale for parameter {name}.')
+
+    return name, values
+
+
+def grid_points(axes: Iterable[Mapping]) \
+        -> Tuple[Dict[str, np.ndarray], Dict[str, List[float]], Tuple[int, ...]]:
+    """Builds the Cartesian grid of a set of sweep axes.
+
+    Args:
+        axes: Sweep axis specifications. See parameter_axis.
+
+    Returns:
+        A (points, axis_values, shape) tuple, where points maps each parameter
+        to its flattened grid values, axis_values maps each parameter to the
+        values along its axis, and shape is the shape of the grid.
+    """
+    axis_values = dict(parameter_axis(spec) for spec in axes)
+    if not axis_values:
+        raise ValueError('At least one sweep axis is required.')
+
+    size = math.prod(len(values) for values in axis_values.values())
+    if size > MAX_GRID_POINTS:
+        raise ValueError(f'The sweep has {size} parameter sets, more than '
+                         f'the maximum of {MAX_GRID_POINTS}.')
+
+    grids = np.meshgrid(*axis_values.values(), indexing='ij')
+    points = {name: grid.ravel() for name, grid in zip(axis_values, grids)}
+
+    return (points,
+            {name: values.tolist() for name, values in axis_values.items()},
+            grids[0].shape)
+
+
+def corner_points(corners: Iterable[Mapping[str, float]],
+                  defaults: Mapping[str, float]) -> Dict[str, np.ndarray]:
+    """Builds the parameter values of a list of corners.
+
+    Args:
+        corners: A list of mappings from parameter names to values. Parameters
+            missing from a corner take their default value.
+        defaults: The default parameter values.
+
+    Returns:
+        A mapping from each parameter set by any corner to its values across
+        all corners.
+    """
+    corners = list(corners)
+    if not corners:
+        raise ValueError('At least one corner is required.')
+    if len(corners) > MAX_GRID_POINTS:
+        raise ValueError(f'There are {len(corners)} corners, more than the '
+                         f'maximum of {MAX_GRID_POINTS}.')
+
+    names = {name for corner in corners for name in corner}
+    for name in names:
+        if name not in defaults:
+            raise ValueError(f'Invalid parameter: {name}.')
+
+    return {
+        name: np.array([corner.get(name, defaults[name]) for corner in corners],
+                       dtype=float)
+        for name in names
+    }
+
+
+def _evaluate_chunk(
+    expression: sympy.Expr,
+    freq: np.ndarray,
+    parameters: Mapping,
+    metrics: Tuple[str, ...]
+) -> Dict[str, np.ndarray]:
+    # Module-level so that it can be sent to pool workers, which compile the
+    # expression at most once thanks to compile_expression's cache.
+    function = compile_expression(expression)
+    response = function(2j * np.pi * freq, parameters)
+    return {metric: METRICS[metric](freq, response) for metric in metrics}
+
+
+def evaluate_metrics(
+    expression: sympy.Expr,
+    freq: np.ndarray,
+    base_parameters: Mapping[str, float],
+    points: Mapping[str, np.ndarray],
+    metrics: Iterable[str]
+) -> Dict[str, np.ndarray]:
+    """Evaluates metrics of a transfer function over a batch of parameter sets.
+
+    Args:
+        expression: The symbolic transfer function.
+        freq: The frequencies, in hertz, at which to evaluate the response.
+        base_parameters: The values of all circuit parameters. Swept
+            parameters override these values.
+        points: A mapping from swept parameter names to 1-D arrays of values,
+            all of equal length.
+        metrics: The names of the metrics to compute. See parametric.METRICS.
+
+    Returns:
+        A mapping from each metric name to a 1-D array of its values.
+    """
+    metrics = tuple(metrics)
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError(f'Invalid metric: {metric}.')
+
+    for name in points:
+        if name not in base_parameters:
+            raise ValueError(f'Invalid parameter: {name}.')
+
+    num_points = len(next(iter(points.values())))
+    chunks = [
+        {**base_parameters,
+         **{name: values[i:i + CHUNK_SIZE] for name, values in points.items()}}
+        for i in range(0, num_points, CHUNK_SIZE)
+    ]
+
+    if num_points > PROCESS_POOL_THRESHOLD:
+        pool = _get_process_pool()
+        futures = [pool.submit(_evaluate_chunk, expression, freq, chunk, metrics)
+                   for chunk in chunks]
+        results = [future.result() for future in futures]
+    else:
+        results = [_evaluate_chunk(expression, freq, chunk, metrics)
+                   for chunk in chunks]
+
+    return {metric: np.concatenate([result[metric] for result in results])
+            for metric in metrics}
+
+
+def to_json_array(array: np.ndarray) -> List:
+    """Converts an array to nested lists, replacing non-finite values with
+    None so that the result can be serialized as JSON."""
+    array = np.asarray(array, dtype=float)
+    return np.where(np.isfinite(array), array, None).tolist()
+
+
+def sweep(
+    expression: sympy.Expr,
+    freq: np.ndarray,
+    base_parameters: Mapping[str, float],
+    axes: Optional[Iterable[Mapping]] = None,
+    corners: Optional[Iterable[Mapping[str, float]]] = None,
+    metrics: Iterable[str] = ('phase_margin', 'bandwidth', 'dc_gain')
+) -> Dict:
+    """Evaluates metrics of a transfer function over a multi-parameter grid
+    or a list of corners.
+
+    Args:
+        expression: The symbolic transfer function.
+        freq: The frequencies, in hertz, at which to evaluate the response.
+        base_parameters: The values of all circuit parameters.
+        axes: Sweep axis specifications, whose Cartesian grid is evaluated.
+            See parameter_axis.
+        corners: A list of parameter sets to evaluate instead of a grid.
+        metrics: The names of the metrics to compute.
+
+    Returns:
+        A dictionary with the swept 'parameters', the 'shape' of the result,
+        and the dense 'metrics' arrays (as nested lists).
+    """
+    if (axes is None) == (corners is None):
+        raise ValueError('Exactly one of axes or corners must be given.')
+
+    if axes is not None:
+        points, parameters, shape = grid_points(axes)
+    else:
+        points = corner_points(corners, base_parameters)
+        parameters = {name: values.tolist() for name, values in points.items()}
+        shape = (len(next(iter(points.values()))),)
+
+    results = evaluate_metrics(expression, freq, base_parameters, points,
+                               metrics)
+
+    return {
+        'parameters': parameters,
+        'shape': list(shape),
+        'metrics': {metric: to_json_array(values.reshape(shape))
+                    for metric, values in results.items()},
+    }
+
+
+# The largest number of Monte-Carlo samples accepted in a single analysis.
+MAX_SAMPLES = 100000
+
+
+def sample_parameters(
+    distributions: Mapping[str, Mapping],
+    base_parameters: Mapping[str, float],
+    num_samples: int,
+    rng: np.random.Generator
+) -> Dict[str, np.ndarray]:
+    """Draws random parameter values around their nominal values.
+
+    Args:
+        distributions: A mapping from parameter names, or fnmatch patterns
+            such as 'R*', to distributions. Each distribution is a mapping
+            with a relative 'tolerance' and a 'type', which is either
+            'uniform' (values within +/- tolerance) or 'normal' (tolerance
+            taken as three standard deviations). Exact names take precedence
+            over patterns, and earlier patterns over later ones.
+        base_parameters: The nominal parameter values.
+        num_samples: The number of samples to draw.
+        rng: The random number generator.
+
+    Returns:
+        A mapping from each randomized parameter name to an array of
+        num_samples values.
+    """
+    samples = {}
+
+    for name, nominal in base_parameters.items():
+        if name in distributions:
+            distribution = distributions[name]
+        else:
+            distribution = next(
+                (distributions[pattern] for pattern in distributions
+                 if fnmatchcase(name, pattern)),
+                None
+            )
+
+        if distribution is None:
+            continue
+
+        try:
+            tolerance = float(distribution['tolerance'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'Invalid tolerance for parameter {name}.')
+
+        kind = distribution.get('type', 'uniform')
+        if kind == 'uniform':
+            deviation = rng.uniform(-tolerance, tolerance, num_samples)
+        elif kind == 'normal':
+            deviation = rng.normal(0, tolerance / 3, num_samples)
+        else:
+            raise ValueError(f'Invalid distribution for parameter {name}.')
+
+        samples[name] = nominal * (1 + deviation)
+
+    if not samples:
+        raise ValueError('The distributions do not match any parameter.')
+
+    return samples
+
+
+def summarize(
+    values: np.ndarray,
+    bins: int,
+    percentiles: Iterable[float]
+) -> Dict:
+    """Summarizes the distribution of a metric.
+
+    Args:
+        values: The metric values. Non-finite values are ignored.
+        bins: The number of histogram bins.
+        percentiles: The percentiles to compute, between 0 and 100.
+
+    Returns:
+        A dictionary with the 'mean', standard deviation ('std'),
+        'percentiles', 'histogram' and the number of non-finite ('invalid')
+        values.
+    """
+    finite = values[np.isfinite(values)]
+    percentiles = list(percentiles)
+
+    if not len(finite):
+        return {
+            'mean': None,
+            'std': None,
+            'percentiles': {str(p): None for p in percentiles},
+            'histogram': {'counts': [], 'edges': []},
+            'invalid': len(values),
+        }
+
+    counts, edges = np.histogram(finite, bins=bins)
+
+    return {
+        'mean': float(np.mean(finite)),
+        'std': float(np.std(finite)),
+        'percentiles': dict(zip(
+            (str(p) for p in percentiles),
+            np.percentile(finite, percentiles).tolist()
+        )),
+        'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()},
+        'invalid': len(values) - len(finite),
+    }
+
+
+def montecarlo(
+    expression: sympy.Expr,
+    freq: np.ndarray,
+    base_parameters: Mapping[str, float],
+    distributions: Mapping[str, Mapping],
+    num_samples: int,
+    metrics: Iterable[str] = ('phase_margin', 'bandwidth', 'dc_gain'),
+    bins: int = 20,
+    percentiles: Iterable[float] = (1, 5, 50, 95, 99),
+    seed: Optional[int] = None
+) -> Dict:
+    """Runs a Monte-Carlo tolerance analysis of a transfer function.
+
+    All samples are drawn up front as arrays and evaluated together, in
+    vectorized calls to the compiled transfer function.
+
+    Args:
+        expression: The symbolic transfer function.
+        freq: The frequencies, in hertz, at which to evaluate the response.
+        base_parameters: The nominal values of all circuit parameters.
+        distributions: The parameter distributions. See sample_parameters.
+        num_samples: The number of samples.
+        metrics: The names of the metrics to compute.
+        bins: The number of histogram bins per metric.
+        percentiles: The percentiles to report per metric.
+        seed: Optional; A seed for reproducible results.
+
+    Returns:
+        A dictionary with the number of 'samples', the randomized
+        'parameters', and a summary of each metric (see summarize).
+    """
+    if not 0 < num_samples <= MAX_SAMPLES:
+        raise ValueError(f'samples must be between 1 and {MAX_SAMPLES}.')
+
+    rng = np.random.default_rng(seed)
+    points = sample_parameters(distributions, base_parameters, num_samples,
+                               rng)
+    results = evaluate_metrics(expression, freq, base_parameters, points,
+                               metrics)
+
+    return {
+        'samples': num_samples,
+        'parameters': sorted(points),
+        'metrics': {metric: summarize(values, bins, percentiles)
+                    for metric, values in results.items()},
+    }
+
+
+# The number of points of the initial scan used to bracket a single free
+# parameter, and the number of points evaluated per refinement of a bracket.
+SCAN_POINTS = 33
+REFINE_POINTS = 8
+
+
+class _FreeParameter:
+    """Maps a bounded parameter to and from the normalized interval [0, 1]."""
+
+    def __init__(self, spec: Mapping, nominal: float):
+        self.name = spec.get('name')
+        try:
+            self.min = float(spec['min'])
+            self.max = float(spec['max'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(
+                f'Free parameter {self.name} must have min and max values.')
+
+        if self.min >= self.max:
+            raise ValueError(
+                f'min must be less than max for parameter {self.name}.')
+
+        self.scale = spec.get('scale', 'log' if self.min > 0 else 'linear')
+        if self.scale == 'log' and self.min <= 0:
+            raise ValueError(
+                f'Log-scaled parameter {self.name} must have positive bounds.')
+        if self.scale not in ('linear', 'log'):
+            raise ValueError(f'Invalid scale for parameter {self.name}.')
+
+        self.initial = self.normalize(min(max(nominal, self.min), self.max))
+
+    def normalize(self, value: float) -> float:
+        if self.scale == 'log':
+            return math.log(value / self.min) / math.log(self.max / self.min)
+        return (value - self.min) / (self.max - self.min)
+
+    def denormalize(self, x: np.ndarray) -> np.ndarray:
+        if self.scale == 'log':
+            return self.min * (self.max / self.min) ** x
+        return self.min + x * (self.max - self.min)
+
+
+def solve_for(
+    expression: sympy.Expr,
+    freq: np.ndarray,
+    base_parameters: Mapping[str, float],
+    metric: str,
+    target: float,
+    free: Iterable[Mapping],
+    tolerance: float = 1e-3,
+    max_iterations: int = 50
+) -> Dict:
+    """Finds parameter values for which a transfer function metric reaches a
+    target value.
+
+    With a single free parameter, a vectorized scan of its range brackets a
+    root of (metric - target), which is then narrowed by evaluating several
+    points per iteration. With more free parameters, a pattern search
+    minimizes |metric - target| within the bounds, starting from the current
+    parameter values and evaluating all search directions in one call.
+
+    Args:
+        expression: The symbolic transfer function.
+        freq: The frequencies, in hertz, at which to evaluate the response.
+            Since metrics are computed on this grid, its resolution bounds
+            how precisely the target can be met.
+        base_parameters: The current values of all circuit parameters.
+        metric: The name of the target metric. See parametric.METRICS.
+        target: The target metric value.
+        free: The free parameters. Each is a mapping with the parameter
+            'name', its 'min' and 'max' bounds, and optionally its 'scale'
+            ('linear' or 'log', by default 'log' for positive bounds).
+        tolerance: The tolerance on the metric, relative to max(1, |target|).
+        max_iterations: The maximum number of search iterations.
+
+    Returns:
+        A dictionary with the solved 'parameters', the achieved 'metric'
+        value, whether the search 'converged' to within the tolerance,
+        whether the target was 'bracketed' (i.e. the metric crosses it within
+        the bounds, so that a search which did not converge is limited by
+        the frequency grid), and the number of parameter sets evaluated
+        ('evaluations').
+    """
+    free = [_FreeParameter(spec, base_parameters.get(spec.get('name'), 0.0))
+            for spec in free]
+    if not free:
+        raise ValueError('At least one free parameter is required.')
+
+    for parameter in free:
+        if parameter.name not in base_parameters:
+            raise ValueError(f'Invalid parameter: {parameter.name}.')
+
+    tolerance = tolerance * max(1.0, abs(target))
+    evaluations = 0
+
+    def error(x: np.ndarray) -> np.ndarray:
+        # Evaluates (metric - target) for a batch of normalized points of
+        # shape (num_points, num_free).
+        nonlocal evaluations
+        evaluations += len(x)
+
+        points = {p.name: p.denormalize(x[:, i]) for i, p in enumerate(free)}
+        values = evaluate_metrics(expression, freq, base_parameters, points,
+                                  (metric,))[metric]
+        return values - target
+
+    if len(free) == 1:
+        x, err, converged, bracketed = _bracket_search(
+            error, free[0].initial, tolerance, max_iterations)
+    else:
+        x, err, converged = _pattern_search(
+            error, np.array([p.initial for p in free]), tolerance,
+            max_iterations)
+        bracketed = converged
+
+    return {
+        'parameters': {p.name: float(p.denormalize(x[i]))
+                       for i, p in enumerate(free)},
+        'metric': None if not np.isfinite(err) else float(err + target),
+        'target': target,
+        'converged': converged,
+        'bracketed': bracketed,
+        'evaluations': evaluations,
+    }
+
+
+def _bracket_search(
+    error: Callable[[np.ndarray], np.ndarray],
+    initial: float,
+    tolerance: float,
+    max_iterations: int
+) -> Tuple[np.ndarray, float, bool, bool]:
+    x = np.linspace(0, 1, SCAN_POINTS)
+    err = error(x[:, np.newaxis])
+
+    # Find sign changes between consecutive, well-defined scan points.
+    valid = np.isfinite(err[:-1]) & np.isfinite(err[1:])
+    brackets = np.flatnonzero(valid & (np.sign(err[:-1]) != np.sign(err[1:])))
+
+    if not len(brackets):
+        # The target is not reachable within the bounds; return the closest
+        # point that was found.
+        best = np.nanargmin(np.abs(err)) if np.isfinite(err).any() else 0
+        converged = bool(abs(err[best]) <= tolerance)
+        return x[best:best + 1], err[best], converged, converged
+
+    # Prefer the bracket closest to the initial value.
+    i = brackets[np.argmin(np.abs(x[brackets] - initial))]
+    lo, hi, err_lo = x[i], x[i + 1], err[i]
+    best_x, best_err = (x[i], err[i]) \
+        if abs(err[i]) <= abs(err[i + 1]) else (x[i + 1], err[i + 1])
+
+    for _ in range(max_iterations):
+        if abs(best_err) <= tolerance or hi - lo <= 1e-12:
+            break
+
+        x = np.linspace(lo, hi, REFINE_POINTS + 2)[1:-1]
+        err = error(x[:, np.newaxis])
+
+        best = np.nanargmin(np.abs(err)) if np.isfinite(err).any() else None
+        if best is not None and abs(err[best]) < abs(best_err):
+            best_x, best_err = x[best], err[best]
+
+        # Narrow down to the first sub-interval whose sign changes. Points
+        # where the metric is undefined are skipped, as in the initial scan.
+        points = np.concatenate(([lo], x, [hi]))
+        start, err_start = 0, err_lo
+        for j in range(len(x)):
+            if not np.isfinite(err[j]):
+                continue
+            if np.sign(err[j]) != np.sign(err_lo):
+                hi = points[j + 1]
+                break
+            start, err_start = j + 1, err[j]
+        lo, err_lo = points[start], err_start
+
+    # Note that the metric, being evaluated on a frequency grid, may jump
+    # over the target, in which case the search does not converge.
+    return np.array([best_x]), best_err, bool(abs(best_err) <= tolerance), \
+        True
+
+
+def _pattern_search(
+    error: Callable[[np.ndarray], np.ndarray],
+    initial: np.ndarray,
+    tolerance: float,
+    max_iterations: int
+) -> Tuple[np.ndarray, float, bool]:
+    x = initial
+    best_err = error(x[np.newaxis, :])[0]
+    step = 0.25
+
+    directions = np.concatenate((np.eye(len(x)), -np.eye(len(x))))
+
+    for _ in range(max_iterations):
+        if abs(best_err) <= tolerance or step < 1e-6:
+            break
+
+        candidates = np.clip(x + step * directions, 0, 1)
+        err = error(candidates)
+
+        best = np.nanargmin(np.abs(err)) if np.isfinite(err).any() else None
+        if best is not None and (abs(err[best]) < abs(best_err)
+                                 or not np.isfinite(best_err)):
+            x = candidates[best]
+            best_err = err[best]
+        else:
+            step /= 2
+
+    return x, best_err, bool(abs(best_err) <= tolerance)
@@ -0,0 +1,107 @@
+"""Benchmarks the compilation and evaluation of Mason expressions, with and
+without common subexpression elimination.
+
+Usage:
+    python benchmark_compile.py [circuit ...]
+
+Each circuit is the name of a netlist and operating point log pair in
+test_data, e.g. 2N3904_cascode. The transfer function from Vin to Vout and the
+loop gain are compiled with all parameters substituted, as done by
+Circuit._compute_transfer_function and Circuit._compute_loop_gain.
+"""
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+import sympy
+
+import circuit_parser
+import mason
+from dpi import DPI_algorithm as DPI
+from parametric import S, frequency_points
+
+
+DEFAULT_CIRCUITS = ('2N3904_cascode', '2N3904_common_emitter')
+
+# Evaluate over 1000 points, as for a Bode plot from 1 Hz to 1 GHz at
+# ~110 points per decade.
+FREQUENCY_POINTS = frequency_points(1, 1e9, 111)[1]
+
+
+def _read(path: str) -> str:
+    data = open(path, 'rb').read()
+    if data[:2] in (b'\xff\xfe', b'\xfe\xff'):
+        return data.decode('utf-16')
+    return data.decode('utf-8')
+
+
+def _best_time(function, repeat: int = 20) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def _benchmark(name: str, expression: sympy.Expr, parameters: dict):
+    s = FREQUENCY_POINTS
+
+    # Numeric functions of s, as cached on a circuit.
+    numeric = expression.subs({k: v for k, v in parameters.items() if k != 'f'})
+    _compare(name, lambda cse: sympy.lambdify('s', numeric, 'numpy', cse=cse),
+             lambda function: function(s))
+
+    # Parametric functions, as used for sweeps, evaluating 100 parameter sets
+    # at once.
+    symbols = sorted(expression.free_symbols - {S}, key=lambda x: x.name)
+    batch = [np.full((100, 1), parameters[x.name]) for x in symbols]
+    _compare(name + ' x100',
+             lambda cse: sympy.lambdify([S, *symbols], expression, 'numpy',
+                                        cse=cse),
+             lambda function: function(s, *batch))
+
+
+def _compare(name: str, compile_function, evaluate):
+    results = {}
+    for cse in (False, True):
+        start = time.perf_counter()
+        function = compile_function(cse)
+        compile_time = time.perf_counter() - start
+
+        results[cse] = evaluate(function)
+        eval_time = _best_time(lambda: evaluate(function), repeat=5)
+        print(f'  {name:<23} cse={str(cse):<5} compile {compile_time * 1e3:8.1f} ms'
+              f'   evaluate {eval_time * 1e3:8.3f} ms')
+
+    # Both evaluate the same expression, up to rounding errors, which are
+    # large where the expression cancels out.
+    difference = np.max(np.abs(results[True] - results[False])) / \
+        np.max(np.abs(results[False]))
+    print(f'  {name:<23} max difference {difference:.1e}')
+
+
+def main(circuits):
+    for circuit_name in circuits:
+        netlist = _read(f'test_data/{circuit_name}.cir')
+        op_point_log = _read(f'test_data/{circuit_name}.log')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            circuit = circuit_parser.Circuit.from_ltspice_netlist(
+                netlist, op_point_log)
+            sfg = DPI(circuit).graph
+            transfer_function, _ = mason.transfer_function(sfg, 'Vin', 'Vout')
+            loop_gain = mason.loop_gain(sfg)
+
+        parameters = circuit.parameters()
+        print(f'{circuit_name}: {sfg}, '
+              f'{sympy.count_ops(transfer_function)} transfer function ops')
+
+        _benchmark('transfer function', transfer_function, parameters)
+        _benchmark('loop gain', loop_gain, parameters)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or DEFAULT_CIRCUITS)
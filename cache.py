@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """A thread-safe, in-process least-recently-used cache.
+
+    Each server worker holds its own caches, so cached values must only be
+    derived from data that identifies them completely (e.g. the SFG version
+    and parameter values), never from mutable document state.
+
+    The cache holds at most maxsize items. If a sizeof function is given, the
+    total size of the items, as measured by it, is also kept within maxbytes.
+    """
+
+    def __init__(self, maxsize: int = 128, maxbytes: Optional[int] = None,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._total_size = 0
+        self._lock = Lock()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._remove(key)
+            self._items[key] = value
+
+            if self._sizeof is not None:
+                self._sizes[key] = self._sizeof(value)
+                self._total_size += self._sizes[key]
+
+            while len(self._items) > self.maxsize or (
+                    self.maxbytes is not None and len(self._items) > 1
+                    and self._total_size > self.maxbytes):
+                self._remove(next(iter(self._items)))
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            return self._remove(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._sizes.clear()
+            self._total_size = 0
+
+    @property
+    def size(self) -> int:
+        """The total size of the items, as measured by sizeof."""
+        return self._total_size
+
+    def _remove(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        self._total_size -= self._sizes.pop(key, 0)
+        return self._items.pop(key, default)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
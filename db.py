@@ -1,16 +1,18 @@
-from typing import Tuple, List, Union, Optional, Dict, Callable, Iterable
+from typing import (Any, Tuple, List, Union, Optional, Dict, Callable,
+                    Iterable)
 import os
+from collections import Counter
 
 from mongoengine import *
-from datetime import datetime
+from mongoengine.base import BaseDocument, BaseField
+from datetime import datetime, timedelta
 import sympy
 from sympy.parsing.latex import parse_latex
 import mason
 import math
-import cmath
 import numpy as np
-import dill
 import circuit_parser
+import dpi
 from dpi import DPI_algorithm as DPI
 from dpi import simplify
 from dpi import removing_branch
@@ -18,6 +20,25 @@ from dpi import remove_dead_branches
 from dpi import simplify_whole_graph
 import ltspice2svg
 import networkx as nx
+import analysis
+from parametric import (
+    ParametricVector,
+    compile_expression,
+    compile_sensitivities,
+    frequency_points,
+    gain_db,
+)
+import rational
+import nyquist
+import symbolic as backend
+import expressions
+import rendering
+import sfg_format
+from cache import LRUCache
+import hashlib
+import pickle
+from threading import Lock
+import bson
 
 
 if 'DB_URI' in os.environ:
@@ -29,10 +50,546 @@ else:
     connect('capstone')
 
 
+# Reduced-order transfer function models, shared by every circuit in this
+# process and keyed by SFG version and parameter values.
+_reduced_models = LRUCache(maxsize=64)
+
+# The total serialized size of the SFGs held in memory by _sfgs.
+SFG_CACHE_BYTES = 64 * 2 ** 20
+
+
+class _SFGEntry:
+    """A de-serialized SFG, and the artifacts derived from it alone (e.g. its
+    symbolic transfer functions).
+
+    The graph is only decoded when first accessed: reads of a few edges go
+    through the reader, which decodes just those edges.
+    """
+
+    __slots__ = ('reader', 'artifacts', 'size', '_graph')
+
+    def __init__(self, reader: sfg_format.SFGReader, size: int,
+                 graph: Optional[nx.DiGraph] = None):
+        self.reader = reader
+        self.artifacts = LRUCache(maxsize=32)
+        self.size = size
+        self._graph = graph and nx.freeze(graph)
+
+    @property
+    def graph(self) -> nx.DiGraph:
+        # The graph is shared by every request for this SFG version, so it is
+        # frozen to guard against accidental modification.
+        if self._graph is None:
+            self._graph = nx.freeze(self.reader.graph())
+        return self._graph
+
+
+# De-serialized SFGs, keyed by SFG version, so that steady-state requests skip
+# de-serialization, and circuits with equal SFGs share them. The memory held
+# is bounded by the serialized size of the SFGs, which is proportional to
+# their size in memory.
+_sfgs = LRUCache(maxsize=256, maxbytes=SFG_CACHE_BYTES,
+                 sizeof=lambda entry: entry.size)
+
+# Live preview evaluators, keyed by circuit ID. See preview_transfer_function.
+_previews = LRUCache(maxsize=32)
+
+# Content versions of SFGs (see Circuit._sfg_version), keyed by a hash of
+# their serialized bytes.
+_versions = LRUCache(maxsize=1024)
+
+# The serialized SFGs of branches, keyed by circuit ID, the content version of
+# the original SFG and a hash of their delta from it.
+_branch_sfgs = LRUCache(maxsize=64)
+
+# The results of processing uploads (see Upload), keyed by a hash of the
+# uploaded files.
+_uploads = LRUCache(maxsize=32)
+
+# Symbolic results shared by every circuit whose SFG has the same canonical
+# form (see Analysis), keyed by its fingerprint, the kind of result and the
+# canonical labels of the nodes it is for.
+_analyses = LRUCache(maxsize=256)
+
+# Decoded transfer function and loop gain expressions, keyed by the digest of
+# their encoding, so that cached documents are only decoded once per worker.
+_expressions = LRUCache(maxsize=64)
+
+
+def _load_expression(
+    document: Union['TransferFunction', 'LoopGainFunction']
+) -> sympy.Expr:
+    digest = document.expression_digest
+    expression = _expressions.get(digest) if digest else None
+
+    if expression is None:
+        expression = sfg_format.loads_expression(document.sympy_expression)
+        if digest:
+            _expressions.put(digest, expression)
+
+    return expression
+
+
+def _content_version(data: bytes) -> str:
+    # The content digest of a serialized SFG (see sfg_format.content_digest),
+    # computed once per worker for the same bytes.
+    data_hash = hashlib.sha1(data).hexdigest()
+
+    version = _versions.get(data_hash)
+    if version is None:
+        version = sfg_format.content_digest(data)
+        _versions.put(data_hash, version)
+
+    return version
+
+
+# How many times a save is merged with concurrent changes and retried before
+# it is given up as a conflict.
+MAX_MERGES = 3
+
+
+class ConflictError(Exception):
+    """Raised when a circuit is saved after another request changed the
+    same data in a different way."""
+
+
+def _fingerprint(value: Any) -> Union[None, bytes, List[bytes]]:
+    # Identifies a stored field value by its BSON encoding. Lists are encoded
+    # item by item, so that items appended to them can be told apart.
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [bson.encode({'v': item}) for item in value]
+    return bson.encode({'v': value})
+
+
+def _unfingerprint(fingerprint: Union[None, bytes, List[bytes]]) -> Any:
+    # The stored value a fingerprint was made from.
+    if isinstance(fingerprint, list):
+        return [bson.decode(item)['v'] for item in fingerprint]
+    return fingerprint and bson.decode(fingerprint)['v']
+
+
+def _merge_value(key: str, base: Any, ours: Any, theirs: Any) -> Any:
+    # Merges two changes to a stored field value, made independently to
+    # base. Changes to different edges of the SFG, or to different keys of a
+    # dictionary, commute; as do items appended to a list.
+    if key == 'sfg' and base and ours and theirs:
+        try:
+            return sfg_format.merge(base, ours, theirs, compress=True)
+        except ValueError as e:
+            raise ConflictError(f'The SFG was changed by another request: {e}')
+
+    if all(isinstance(v, (dict, type(None))) for v in (base, ours, theirs)):
+        base, ours, theirs = base or {}, ours or {}, theirs or {}
+        merged = dict(theirs)
+        for k in base.keys() | ours.keys():
+            if k in base and k in ours and base[k] == ours[k]:
+                continue
+            if theirs.get(k) != base.get(k) and theirs.get(k) != ours.get(k):
+                raise ConflictError(
+                    f'{key}.{k} was changed by another request.'
+                )
+
+            if k in ours:
+                merged[k] = ours[k]
+            else:
+                merged.pop(k, None)
+        return merged
+
+    if all(isinstance(v, (list, type(None))) for v in (base, ours, theirs)):
+        base, ours, theirs = base or [], ours or [], theirs or []
+        if ours[:len(base)] == base and theirs[:len(base)] == base:
+            return theirs + ours[len(base):]
+
+    raise ConflictError(f'{key} was changed by another request.')
+
+
+# How long a circuit is kept after it is uploaded, in seconds.
+CIRCUIT_TTL = 86400
+
+# The total size of the blob contents held in memory by _blobs.
+BLOB_CACHE_BYTES = 64 * 2 ** 20
+
+# The contents of blobs, keyed by their hash. Blobs never change, so their
+# contents can be kept for as long as there is room.
+_blobs = LRUCache(maxsize=1024, maxbytes=BLOB_CACHE_BYTES, sizeof=len)
+
+
+class Blob(Document):
+    """Content which is stored once for every document that holds it (see
+    BlobField), keyed by a hash of the content.
+
+    Each blob counts the references to it, and is deleted once none are left.
+    Because circuits expire without their references being released, a blob
+    also expires once every circuit which referred to it has.
+    """
+    id = StringField(primary_key=True)
+    data = BinaryField()
+    refs = IntField(default=0)
+    expires = DateTimeField()
+    meta = {
+        'indexes': [
+            {'fields': ['expires'], 'expireAfterSeconds': 0}
+        ]
+    }
+
+
+def _blob_key(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def _load_blob(key: str) -> bytes:
+    data = _blobs.get(key)
+    if data is None:
+        document = Blob._get_collection().find_one(
+            {'_id': key}, projection=['data']
+        )
+        if document is None:
+            raise LookupError(f'Blob {key} not found')
+        data = bytes(document['data'])
+        _blobs.put(key, data)
+
+    return data
+
+
+class _BlobRef:
+    """The content of a BlobField which was not read yet."""
+
+    __slots__ = ('key', 'text')
+
+    def __init__(self, key: str, text: bool):
+        self.key = key
+        self.text = text
+
+    def load(self) -> Union[bytes, str]:
+        data = _load_blob(self.key)
+        return data.decode() if self.text else data
+
+
+class BlobField(BaseField):
+    """A field whose content is stored in a Blob, which is shared by every
+    document with the same content.
+
+    The document holds a reference to the blob, {'blob': key}, which is only
+    resolved when the field is read. Values stored before the field held
+    references are read as they are.
+    """
+
+    def __init__(self, text: bool = False, **kwargs):
+        """
+        Args:
+            text: Whether the content is a string, rather than bytes.
+        """
+        self.text = text
+        super().__init__(**kwargs)
+
+    def __get__(self, instance, owner):
+        value = super().__get__(instance, owner)
+        if isinstance(value, _BlobRef):
+            value = value.load()
+            instance._data[self.name] = value
+        return value
+
+    def to_python(self, value):
+        if isinstance(value, dict) and 'blob' in value:
+            return _BlobRef(value['blob'], self.text)
+        return value
+
+    def to_mongo(self, value):
+        if isinstance(value, _BlobRef):
+            return {'blob': value.key}
+        return {'blob': _blob_key(self.encode(value))}
+
+    def encode(self, value: Union[bytes, str]) -> bytes:
+        return value.encode() if isinstance(value, str) else bytes(value)
+
+    def validate(self, value):
+        if not isinstance(value, (bytes, str, _BlobRef)):
+            self.error('BlobField only accepts bytes and strings')
+
+
+def _blob_refs(value: Any) -> Counter:
+    # Counts the blob references in a stored value.
+    if isinstance(value, dict):
+        if len(value) == 1 and isinstance(value.get('blob'), str):
+            return Counter([value['blob']])
+        return sum(map(_blob_refs, value.values()), Counter())
+    if isinstance(value, list):
+        return sum(map(_blob_refs, value), Counter())
+    return Counter()
+
+
+def _blob_contents(document: BaseDocument,
+                   names: Optional[Iterable[str]] = None) -> Dict[str, bytes]:
+    # The contents of the blob fields of a document, and of the documents
+    # embedded in it, by key. Contents which were not read are left out.
+    contents = {}
+    for name in document._fields if names is None else names:
+        field = document._fields[name]
+        value = document._data.get(name)
+        if isinstance(field, BlobField) and isinstance(value, (bytes, str)):
+            data = field.encode(value)
+            contents[_blob_key(data)] = data
+
+        for item in value if isinstance(value, list) else [value]:
+            if isinstance(item, BaseDocument):
+                contents.update(_blob_contents(item))
+
+    return contents
+
+
+def _holds_blobs(field: BaseField) -> bool:
+    # Whether the values of a field may refer to blobs.
+    if isinstance(field, BlobField):
+        return True
+    if isinstance(field, ListField):
+        return _holds_blobs(field.field)
+    if isinstance(field, EmbeddedDocumentField):
+        return any(map(_holds_blobs, field.document_type._fields.values()))
+    return False
+
+
+def _inline_blobs(document: BaseDocument, son: Dict) -> Dict:
+    # Replaces the blob references in the stored form of a document, and of
+    # the documents embedded in it, with their content.
+    for name, field in document._fields.items():
+        if field.db_field not in son:
+            continue
+
+        if isinstance(field, BlobField):
+            son[field.db_field] = getattr(document, name)
+            continue
+
+        value = document._data.get(name)
+        if isinstance(value, BaseDocument):
+            _inline_blobs(value, son[field.db_field])
+        elif isinstance(value, list):
+            for item, item_son in zip(value, son[field.db_field]):
+                if isinstance(item, BaseDocument):
+                    _inline_blobs(item, item_son)
+
+    return son
+
+
+def _acquire_blobs(refs: Counter, contents: Dict[str, bytes]):
+    # Adds references to blobs, storing those which do not exist yet.
+    collection = Blob._get_collection()
+    expires = datetime.utcnow() + timedelta(seconds=CIRCUIT_TTL)
+    for key, count in refs.items():
+        update = {'$inc': {'refs': count}, '$max': {'expires': expires}}
+        # The content is only sent for blobs which are new.
+        if collection.update_one({'_id': key}, update).matched_count:
+            continue
+        if key not in contents:
+            raise LookupError(f'Blob {key} not found')
+
+        collection.update_one(
+            {'_id': key},
+            {**update, '$setOnInsert': {'data': contents[key]}},
+            upsert=True,
+        )
+        _blobs.put(key, contents[key])
+
+
+def _release_blobs(refs: Counter):
+    # Removes references to blobs, deleting those which are left without any.
+    collection = Blob._get_collection()
+    for key, count in refs.items():
+        collection.update_one({'_id': key}, {'$inc': {'refs': -count}})
+        collection.delete_one({'_id': key, 'refs': {'$lte': 0}})
+
+
+class Analysis(Document):
+    """A symbolic result (e.g. a transfer function) computed from an SFG, which
+    is shared by every circuit whose SFG has the same canonical form (see
+    sfg_format.canonical_form), whatever its node names or parameter values.
+
+    The id is made of the fingerprint of the canonical form, the kind of
+    result and the canonical labels of the nodes it is for.
+    """
+    id = StringField(primary_key=True)
+    expression = BinaryField()
+    expires = DateTimeField()
+    meta = {
+        'indexes': [
+            {'fields': ['expires'], 'expireAfterSeconds': 0}
+        ]
+    }
+
+
+def _shared_analysis(key: Tuple, compute: Callable[[], sympy.Expr]) \
+        -> sympy.Expr:
+    # Returns a shared symbolic result, computing and storing it if no worker
+    # did so yet.
+    expression = _analyses.get(key)
+    if expression is not None:
+        return expression
+
+    analysis_id = '/'.join(map(str, key))
+    collection = Analysis._get_collection()
+    stored = collection.find_one({'_id': analysis_id},
+                                 projection=['expression'])
+    if stored is not None:
+        expression = sfg_format.loads_expression(bytes(stored['expression']))
+    else:
+        expression = compute()
+        collection.update_one({'_id': analysis_id}, {'$set': {
+            'expression': sfg_format.dumps_expression(expression,
+                                                      compress=True),
+            'expires': datetime.utcnow() + timedelta(seconds=CIRCUIT_TTL),
+        }}, upsert=True)
+
+    _analyses.put(key, expression)
+    return expression
+
+
+def _source_version(*modules) -> str:
+    # A digest of the source of modules (and of the top level of packages).
+    digest = hashlib.sha1()
+    for module in modules:
+        if os.path.basename(module.__file__) == '__init__.py':
+            directory = os.path.dirname(module.__file__)
+            paths = sorted(os.path.join(directory, name)
+                           for name in os.listdir(directory)
+                           if name.endswith('.py'))
+        else:
+            paths = [module.__file__]
+
+        for path in paths:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+# Identifies the code which processes uploads, and the format of its results,
+# so that results of a previous deploy are not reused once either changes.
+UPLOAD_VERSION = '{}-{}'.format(
+    sfg_format.FORMAT_VERSION,
+    _source_version(circuit_parser, dpi, ltspice2svg)
+)
+
+
+class Upload(Document):
+    """The results of processing the files of an upload: the parameters and
+    SFG of the circuit, and the svg drawing of its schematic.
+
+    Uploads of the same files (e.g. the netlist of a lab) are only parsed and
+    analyzed once. The id is a hash of the files and of UPLOAD_VERSION. The
+    SFG and svg are blobs, shared with the circuits created from them.
+    """
+    id = StringField(primary_key=True)
+    parameters = DictField()
+    sfg = BlobField()
+    svg = BlobField(text=True)
+    expires = DateTimeField()
+    meta = {
+        'indexes': [
+            {'fields': ['expires'], 'expireAfterSeconds': 0}
+        ]
+    }
+
+
+def _process_upload(netlist: str, schematic: Optional[str],
+                    op_point_log: Optional[str]) -> Tuple[Dict, bytes,
+                                                          Optional[str]]:
+    # Returns the parameters, serialized SFG and svg drawing of a circuit,
+    # from a previous upload of the same files if there was one.
+    key = hashlib.sha1(pickle.dumps(
+        (UPLOAD_VERSION, netlist, schematic, op_point_log), protocol=5
+    )).hexdigest()
+
+    result = _uploads.get(key)
+    if result is None:
+        result = _stored_upload(key) or _store_upload(
+            key, netlist, schematic, op_point_log)
+        _uploads.put(key, result)
+
+    parameters, sfg_bytes, svg = result
+    return dict(parameters), sfg_bytes, svg
+
+
+def _stored_upload(key: str) -> Optional[Tuple[Dict, bytes, Optional[str]]]:
+    upload = Upload.objects(id=key).first()
+    try:
+        return upload and (upload.parameters, upload.sfg, upload.svg)
+    except LookupError:
+        # The blobs expired before the upload was removed.
+        return None
+
+
+def _store_upload(key: str, netlist: str, schematic: Optional[str],
+                  op_point_log: Optional[str]) -> Tuple[Dict, bytes,
+                                                        Optional[str]]:
+    # Parse the circuit and generate its small-signal representation.
+    circuit = circuit_parser.Circuit.from_ltspice_netlist(
+        netlist, op_point_log)
+
+    # Map components / parameter names to their numerical values.
+    parameters = circuit.parameters()
+
+    # Perform DPI analysis.
+    sfg = DPI(circuit).graph
+
+    # Generate an svg if the schematic is given.
+    svg = None if schematic is None else ltspice2svg.asc_to_svg(schematic)
+
+    upload = Upload(
+        id=key,
+        parameters=parameters,
+        sfg=sfg_format.dumps(sfg, compress=True),
+        svg=svg,
+        expires=datetime.utcnow() + timedelta(seconds=CIRCUIT_TTL),
+    )
+    refs = _blob_refs(upload.to_mongo())
+    _acquire_blobs(refs, _blob_contents(upload))
+    try:
+        upload.save(force_insert=True)
+    except NotUniqueError:
+        # The same files were processed by another request meanwhile.
+        _release_blobs(refs)
+
+    return upload.parameters, upload.sfg, upload.svg
+
+
+# The number of edits of an SFG which can be undone.
+HISTORY_DEPTH = int(os.environ.get('SFG_HISTORY_DEPTH', 50))
+
+# One in this many edits also stores the whole SFG from before it. Undoing
+# such an edit restores the SFG as it was stored, rather than re-packing the
+# patched tables, so it keeps its version and what is cached for it.
+CHECKPOINT_INTERVAL = 10
+
+
+class SFGEdit(EmbeddedDocument):
+    """An edit of an SFG, stored as the changes to its nodes and edges (see
+    sfg_format.diff)."""
+    delta = BinaryField()
+    checkpoint = BlobField()
+
+
+# The name of a circuit's own SFG, as a branch.
+MAIN_BRANCH = 'main'
+
+
+class SFGBranch(EmbeddedDocument):
+    """A named copy of a circuit's SFG, stored as its changes from the
+    original SFG (see sfg_format.diff), so that it shares every unchanged
+    node and edge with it."""
+    name = StringField()
+    parent = StringField()
+    # Unset if the branch is the original SFG.
+    delta = BinaryField()
+    created = DateTimeField(default=datetime.utcnow)
+
+
 class TransferFunction(EmbeddedDocument):
     input_node = StringField()
     output_node = StringField()
-    sympy_expression = BinaryField()
+    sympy_expression = BlobField()
+    expression_digest = StringField()
+    # Only set in documents from before functions were compiled on load.
     lambda_function = BinaryField()
 
     meta = {
@@ -46,30 +603,115 @@ class TransferFunction(EmbeddedDocument):
 
 
 class LoopGainFunction(EmbeddedDocument):
-    sympy_expression = BinaryField()
+    sympy_expression = BlobField()
+    expression_digest = StringField()
+    # Only set in documents from before functions were compiled on load.
     lambda_function = BinaryField()
 
 
 class Circuit(Document):
     name = StringField()
-    svg = StringField()
-    schematic = StringField()
-    netlist = StringField()
-    op_point_log = StringField()
+    # The large fields are stored once for every circuit with the same
+    # content, e.g. the circuits uploaded from the same netlist.
+    svg = BlobField(text=True)
+    schematic = BlobField(text=True)
+    netlist = BlobField(text=True)
+    op_point_log = BlobField(text=True)
     parameters = DictField()
-    sfg = BinaryField()
-    original_sfg = BinaryField()
+    sfg = BlobField()
+    original_sfg = BlobField()
     original_parameters = DictField()
     transfer_functions = EmbeddedDocumentListField(TransferFunction)
     loop_gain = EmbeddedDocumentField(LoopGainFunction)
+    # The edits which can be undone, oldest first, and those which were
+    # undone and can be redone, most recently undone last.
+    history = EmbeddedDocumentListField(SFGEdit)
+    undone = EmbeddedDocumentListField(SFGEdit)
+    branches = EmbeddedDocumentListField(SFGBranch)
     created = DateTimeField(default=datetime.utcnow)
+    # Incremented by every save, which only succeeds if the stored version is
+    # the one which was loaded. Unset in documents which were never updated.
+    version = IntField()
     meta = {
         'indexes': [
-            {'fields': ['created'], 'expireAfterSeconds': 86400}
+            {'fields': ['created'], 'expireAfterSeconds': CIRCUIT_TTL}
         ]
     }
-    sfg_stack = []
-    redo_stack = []
+
+    @classmethod
+    def load(cls, circuit_id: str, *fields: str) -> Optional['Circuit']:
+        """Loads a circuit, fetching only the given fields.
+
+        The large fields (e.g. svg, netlist and the SFGs) are only needed by a
+        few operations, so each caller names the fields it reads. Any other
+        field is fetched from the database when first accessed.
+
+        Args:
+            circuit_id: The id of the circuit.
+            *fields: The fields to fetch. If none are given, every field is
+                fetched.
+
+        Returns:
+            The circuit, or None if it does not exist.
+        """
+        query = cls.objects(id=circuit_id)
+        if fields:
+            # The version is needed to save the circuit.
+            query = query.only(*fields, 'version')
+
+        circuit = query.first()
+        if circuit is None:
+            return None
+
+        # Fields which were fetched but are not in the document are unset.
+        for name in fields or cls._fields:
+            circuit._stored.setdefault(cls._fields[name].db_field, None)
+
+        if fields:
+            circuit._deferred = \
+                set(cls._fields) - set(fields) - {'id', 'version'}
+
+        return circuit
+
+    @classmethod
+    def _from_son(cls, son, *args, **kwargs) -> 'Circuit':
+        circuit = super()._from_son(son, *args, **kwargs)
+        # The stored values of the fetched fields, against which changes are
+        # found when saving (see _get_update_doc).
+        circuit._stored = {key: _fingerprint(value)
+                           for key, value in son.items()}
+        return circuit
+
+    def __getstate__(self) -> Dict:
+        # Pickles (e.g. exported circuits) hold the content of the blobs, so
+        # that they still load once the blobs are gone, or in another
+        # database.
+        state = super().__getstate__()
+        _inline_blobs(self, state['_data'])
+        return state
+
+    def __getattribute__(self, name: str):
+        # Fields left out by load() are fetched on first access.
+        deferred = object.__getattribute__(self, '__dict__').get('_deferred')
+        if deferred and name in deferred:
+            deferred.discard(name)
+            self.reload(name)
+            self._remember([self._fields[name].db_field])
+
+        return object.__getattribute__(self, name)
+
+    def __setattr__(self, name: str, value):
+        # A field which is assigned before it is read must not be fetched
+        # afterwards, over the new value. It is marked as changed even if
+        # the value is its default, which is not necessarily the stored one.
+        deferred = self.__dict__.get('_deferred')
+        if deferred and name in deferred:
+            deferred.discard(name)
+            super().__setattr__(name, value)
+            self._mark_as_changed(self._fields[name].db_field)
+            return
+
+        super().__setattr__(name, value)
 
     def to_dict(self, fields: Optional[Iterable[str]] = None) -> Dict:
         """Returns a dictionary representation of the Circuit document.
@@ -86,47 +728,133 @@ class Circuit(Document):
         
         fields = set(fields or ('id', 'name', 'parameters', 'sfg'))
 
-        output = {
-            'id': str(self.id),
-            'name': self.name,
-            'parameters': self.parameters.copy(),
-            'svg': self.svg
-        }
+        # Some fields are invalid.
+        if not fields <= {'id', 'name', 'parameters', 'svg', 'sfg'}:
+            raise ValueError('Invalid fields.')
+
+        # Only the requested fields are read, so that no field left out by
+        # load() is fetched.
+        output = {}
+        if 'id' in fields:
+            output['id'] = str(self.id)
+        if 'name' in fields:
+            output['name'] = self.name
+        if 'parameters' in fields:
+            output['parameters'] = self.parameters.copy()
+        if 'svg' in fields:
+            output['svg'] = self.svg
 
         # Because de-serializing and serializing the SFG is costly, only
         # do so when needed.
         if 'sfg' in fields:
-            sfg = dill.loads(self.sfg)
-            freq = 2j * math.pi * sympy.Symbol('f')
+            sfg = self._checkout_sfg()
 
             for src, dst in sfg.edges:
-                # print the edge and its weights
-                # print("src:", src)
-                # print("dst:", dst)
-                # print("edge:", sfg.edges[src, dst])
-                # print("edge weight:", sfg.edges[src, dst]['weight'])
-                symbolic = sfg.edges[src, dst]['weight']
+                sfg.edges[src, dst]['weight'] = expressions.edge_weight(
+                    sfg.edges[src, dst]['weight'], self.parameters
+                )
+
+            output['sfg'] = nx.cytoscape_data(sfg)
 
-                if isinstance(symbolic, sympy.Expr):
-                    numeric = symbolic.subs('s', freq).subs(self.parameters)
-                else:
-                    numeric = symbolic
+        return output
 
-                magnitude, phase = cmath.polar(numeric)
+    def evaluate_edges(
+        self,
+        edges: Optional[Iterable[Tuple[str, str]]] = None,
+        node: Optional[str] = None
+    ) -> List[Dict]:
+        """Evaluates the weights of a subset of the SFG edges.
 
-                sfg.edges[src, dst]['weight'] = {
-                    'symbolic': sympy.latex(symbolic) if isinstance(symbolic, sympy.Expr) else str(symbolic),
-                    'magnitude': magnitude,
-                    'phase': phase*(180/cmath.pi)
-                }
+        Only the requested edges are rendered and evaluated, so the cost does
+        not grow with the size of the SFG. If neither edges nor a node are
+        given, all edges are evaluated.
 
-            output['sfg'] = nx.cytoscape_data(sfg)
+        Args:
+            edges: Optional; The (source, target) pairs of the edges.
+            node: Optional; A node, all of whose incoming and outgoing edges
+                are evaluated.
 
-        # Some fields are invalid.
-        if not fields <= output.keys():
-            raise ValueError('Invalid fields.')
+        Returns:
+            The edges, in the same format as the edges of the 'sfg' field of
+            to_dict.
+
+        Raises:
+            LookupError: If an edge or the node does not exist.
+        """
+        sfg = self._sfg_entry().reader
+
+        if edges is None and node is None:
+            edges = sfg.edges
+        else:
+            edges = list(edges or ())
+
+            if node is not None:
+                if node not in sfg:
+                    raise LookupError(f'The node {node} does not exist!')
+                edges += sfg.in_edges(node)
+                edges += sfg.out_edges(node)
+
+        output = []
+        for src, dst in dict.fromkeys(edges):
+            if not sfg.has_edge(src, dst):
+                raise LookupError(
+                    f'The edge from {src} to {dst} does not exist!')
+
+            weight = sfg.weight(src, dst)
+            output.append({'data': {
+                'source': src,
+                'target': dst,
+                'weight': expressions.edge_weight(weight, self.parameters),
+            }})
+
+        return output
+
+    def eval_edge_table(
+        self,
+        start_freq: float,
+        end_freq: float,
+        points_per_decade: int = 10
+    ) -> Dict:
+        """Evaluates the magnitude and phase of every SFG edge weight over a
+        frequency range.
+
+        The edge weights are compiled, once per SFG version, into a single
+        vectorized function of s and the circuit parameters, which evaluates
+        the whole table in one call.
+
+        Args:
+            start_freq: The starting frequency, in hertz.
+            end_freq: The ending frequency, in hertz.
+            points_per_decade: The number of points per decade of frequency.
 
-        return {k: v for k, v in output.items() if k in fields}
+        Returns:
+            A dictionary with the 'frequency' points, the 'edges' as (source,
+            target) pairs, and their 'magnitude' and 'phase' (in degrees), as
+            lists of shape (edges, frequencies). Values which are undefined
+            (e.g. the weight of a capacitor at DC) are None.
+        """
+        artifacts = self._sfg_entry().artifacts
+
+        compiled = artifacts.get('edge_table')
+        if compiled is None:
+            sfg = self._load_sfg()
+            edges = list(sfg.edges)
+            function = ParametricVector(
+                [sfg.edges[edge]['weight'] for edge in edges])
+            compiled = (edges, function)
+            artifacts.put('edge_table', compiled)
+
+        edges, function = compiled
+
+        freq, s = frequency_points(start_freq, end_freq, points_per_decade)
+        table = function(s, self.parameters)
+
+        return {
+            'frequency': freq.tolist(),
+            'edges': [list(edge) for edge in edges],
+            'magnitude': analysis.to_json_array(np.abs(table)),
+            'phase': analysis.to_json_array(np.angle(table, deg=True)),
+        }
 
     @classmethod
     def create(
@@ -149,24 +877,15 @@ class Circuit(Document):
                 the circuit is presumed to be in small-signal form. Defaults to
                 None.
         """
-        # Parse the circuit and generate its small-signal representation.
-        circuit = circuit_parser.Circuit.from_ltspice_netlist(netlist,
-                                                              op_point_log)
-
-        # Map components / parameter names to their numerical values.
-        parameters = circuit.parameters()
-
-        # Perform DPI analysis.
-        sfg = DPI(circuit).graph
-
-        # Generate an svg if the schematic is given.
-        svg = None if schematic is None else ltspice2svg.asc_to_svg(schematic)
+        # Parse and analyze the circuit, unless the same files were uploaded
+        # before.
+        parameters, sfg_bytes, svg = _process_upload(netlist, schematic,
+                                                     op_point_log)
 
         # Note that loop gain and transfer functions are computed lazily. As
         # such, they are not constructed until they are accessed.
 
         # Initialize the underlying document.
-        sfg_bytes = dill.dumps(sfg)
         circuit = None
         if circuitId is not None:
             circuit = Circuit(
@@ -197,35 +916,228 @@ class Circuit(Document):
 
         return circuit
 
+    def save(self, *args, **kwargs) -> 'Circuit':
+        """Saves the fields which were changed.
+
+        Nothing is written if no field was changed, or if every changed
+        field still has its stored value (see _get_update_doc).
+
+        The update only applies if the circuit was not saved by another
+        request since it was loaded. If it was, the changes are merged with
+        the stored ones where they commute (e.g. edits of different edges),
+        and the update is retried.
+
+        The references to blobs (see BlobField) which the saved values add
+        are acquired before they are written, and those which they replace
+        are released afterwards.
+
+        Raises:
+            ConflictError: If another request changed the same data.
+            LookupError: If the circuit was deleted.
+        """
+        if self._created:
+            refs = _blob_refs(self.to_mongo())
+            _acquire_blobs(refs, _blob_contents(self))
+            try:
+                result = super().save(*args, **kwargs)
+            except Exception:
+                _release_blobs(refs)
+                raise
+
+            self._remember(self.to_mongo().keys())
+            _refresh_preview(self)
+            return result
+
+        # The references acquired for a save which was not written yet. They
+        # are kept while it is merged, since the merged values only refer to
+        # the blobs, rather than holding their content.
+        acquired = Counter()
+        try:
+            for _ in range(MAX_MERGES + 1):
+                changed = {path.split('.')[0]
+                           for path in self._get_changed_fields()}
+                if not self._get_update_doc():
+                    self._clear_changed_fields()
+                    return self
+
+                old_refs, new_refs = self._changed_blob_refs(changed)
+                added = new_refs - old_refs
+                _acquire_blobs(added - acquired, _blob_contents(
+                    self, [self._reverse_db_field_map[key] for key in changed]
+                ))
+                _release_blobs(acquired - added)
+                acquired = added
+
+                version = self.version
+                self.version = (version or 0) + 1
+                try:
+                    result = super().save(*args, save_condition={
+                        'version': version
+                    }, **kwargs)
+                except SaveConditionError:
+                    self._merge_stored_changes(changed - {'version'})
+                    continue
+
+                acquired = Counter()
+                _release_blobs(old_refs - new_refs)
+                self._remember(changed | {'version'})
+                _refresh_preview(self)
+                return result
+        finally:
+            _release_blobs(acquired)
+
+        raise ConflictError('The circuit is being changed by other requests.')
+
+    def _changed_blob_refs(self, keys: Iterable[str]) -> Tuple[Counter,
+                                                               Counter]:
+        # The blob references in the stored and current values of fields.
+        stored = self.__dict__.get('_stored', {})
+
+        # The stored values of fields which were assigned without being read
+        # are fetched, so that the references they hold are released. They
+        # are the values the save overwrites, since it only applies if the
+        # circuit was not saved since it was loaded.
+        unread = [key for key in keys if key not in stored and _holds_blobs(
+            self._fields[self._reverse_db_field_map[key]])]
+        current = {}
+        if unread:
+            current = self._get_collection().find_one(
+                {'_id': self.pk}, projection=unread
+            ) or {}
+
+        old_refs, new_refs = Counter(), Counter()
+        for key in keys:
+            field = self._fields[self._reverse_db_field_map[key]]
+            value = self._data.get(field.name)
+            old_refs += _blob_refs(_unfingerprint(stored[key])
+                                   if key in stored else current.get(key))
+            new_refs += _blob_refs(
+                None if value is None else field.to_mongo(value)
+            )
+
+        return old_refs, new_refs
+
+    def _merge_stored_changes(self, keys: Iterable[str]):
+        # Rebases the changes to the given fields on the stored document,
+        # which was saved by another request since this one was loaded.
+        stored = self.__dict__.setdefault('_stored', {})
+        current = self._get_collection().find_one(
+            {'_id': self.pk}, projection=[*keys, 'version']
+        )
+        if current is None:
+            raise LookupError('Circuit not found')
+
+        for key in keys:
+            field = self._fields[self._reverse_db_field_map[key]]
+            value = self._data.get(field.name)
+            ours = None if value is None else field.to_mongo(value)
+            theirs = current.get(key)
+
+            fingerprint = _fingerprint(theirs)
+            if key in stored and fingerprint == stored[key]:
+                # Only this request changed the field.
+                continue
+
+            # A field which was assigned without being read is overwritten:
+            # its new value does not depend on the stored one.
+            if key in stored and fingerprint != _fingerprint(ours):
+                base = _unfingerprint(stored[key])
+                if isinstance(field, BlobField):
+                    base, ours, theirs = (
+                        field.to_python(v) for v in (base, ours, theirs))
+                    base, ours, theirs = (
+                        v.load() if isinstance(v, _BlobRef) else v
+                        for v in (base, ours, theirs))
+                merged = _merge_value(key, base, ours, theirs)
+                setattr(self, field.name, field.to_python(merged))
+
+            stored[key] = fingerprint
+
+        self.version = current.get('version')
+        self._remember(['version'])
+
+    def _remember(self, keys: Iterable[str]):
+        # Records the values of fields as stored in the database.
+        stored = self.__dict__.setdefault('_stored', {})
+        for key in keys:
+            field = self._fields[self._reverse_db_field_map[key]]
+            value = self._data.get(field.name)
+            stored[key] = _fingerprint(
+                None if value is None else field.to_mongo(value)
+            )
+
+    def _get_update_doc(self) -> Dict:
+        # Called by save() for documents which are already stored. Fields
+        # whose values are unchanged, e.g. parameters which were set back,
+        # are not written, and items appended to a list are pushed rather
+        # than the list being set whole.
+        update = super()._get_update_doc()
+        stored = self.__dict__.get('_stored', {})
+
+        unchanged = set()
+        appended = {}
+        for key in {path.split('.')[0]
+                    for paths in update.values() for path in paths}:
+            if key not in stored:
+                continue
+
+            field = self._fields[self._reverse_db_field_map[key]]
+            value = self._data.get(field.name)
+            value = None if value is None else field.to_mongo(value)
+            fingerprint = _fingerprint(value)
+
+            old = stored[key]
+            if old is None and isinstance(fingerprint, list):
+                old = []
+
+            if fingerprint == old:
+                unchanged.add(key)
+            elif (isinstance(old, list) and isinstance(fingerprint, list)
+                    and update.get('$set', {}).get(key) is not None
+                    and len(fingerprint) > len(old)
+                    and fingerprint[:len(old)] == old):
+                appended[key] = {'$each': value[len(old):]}
+
+        result = {}
+        for operator, paths in update.items():
+            paths = {path: value for path, value in paths.items()
+                     if path.split('.')[0] not in unchanged
+                     and path not in appended}
+            if paths:
+                result[operator] = paths
+
+        if appended:
+            result['$push'] = appended
+
+        return result
+
+    def delete(self, *args, **kwargs):
+        stored = self._get_collection().find_one({'_id': self.pk})
+        super().delete(*args, **kwargs)
+        _previews.pop(str(self.id))
+        if stored is not None:
+            _release_blobs(_blob_refs(stored))
+
     def reset_to_original(self):
         """Reset the circuit back to its original uploaded state.
         Restores the original SFG and parameters from the stored copies.
         Clears undo/redo stacks and cached transfer functions."""
-        if self.original_sfg:
-            self.sfg = self.original_sfg
-        else:
-            # Fallback for circuits created before original_sfg was stored:
-            # re-derive from the netlist.
-            circuit = circuit_parser.Circuit.from_ltspice_netlist(
-                self.netlist, self.op_point_log
+        if not (self.original_sfg and self.original_parameters):
+            # Fallback for circuits created before the originals were stored:
+            # re-derive them from the netlist.
+            parameters, sfg_bytes, _ = _process_upload(
+                self.netlist, None, self.op_point_log
             )
-            sfg_bytes = dill.dumps(DPI(circuit).graph)
-            self.sfg = sfg_bytes
-            self.original_sfg = sfg_bytes
+            self.original_sfg = self.original_sfg or sfg_bytes
+            self.original_parameters = self.original_parameters or parameters
 
-        if self.original_parameters:
-            self.parameters = self.original_parameters.copy()
-        else:
-            circuit = circuit_parser.Circuit.from_ltspice_netlist(
-                self.netlist, self.op_point_log
-            )
-            self.parameters = circuit.parameters()
-            self.original_parameters = self.parameters.copy()
+        self.sfg = self.original_sfg
+        self.parameters = self.original_parameters.copy()
 
-        self.transfer_functions.delete()
+        self.transfer_functions = []
         self.loop_gain = None
-        self.sfg_stack = []
-        self.redo_stack = []
+        self.history = []
+        self.undone = []
 
     def update_parameters(self, update_dict: Dict):
         """Update the circuit parameters.
@@ -237,11 +1149,52 @@ class Circuit(Document):
         if not update_dict.keys() <= self.parameters.keys():
             raise ValueError('Invalid parameters.')
 
+        # Values which are set again keep the cached functions, and are not
+        # written.
+        if all(self.parameters[k] == v for k, v in update_dict.items()):
+            return
+
         self.parameters.update(update_dict)
 
-        self.transfer_functions.delete()
+        self.transfer_functions = []
         self.loop_gain = None
 
+    def _transfer_function_expression(
+        self,
+        input_node: str,
+        output_node: str
+    ) -> sympy.Expr:
+        # Re-use the cached symbolic expression if there is one, without
+        # de-serializing its lambda function.
+        transfer_function = self.transfer_functions. \
+            filter(input_node=input_node, output_node=output_node).first()
+
+        if transfer_function:
+            return _load_expression(transfer_function)
+
+        # The symbolic transfer function depends on the SFG alone.
+        artifacts = self._sfg_entry().artifacts
+        key = ('transfer_function', input_node, output_node)
+
+        sympy_expression = artifacts.get(key)
+        if sympy_expression is None:
+            fingerprint, labels = self._canonical_sfg()
+            compute = lambda: mason.transfer_function(
+                self._load_sfg(), input_node, output_node
+            )[0]
+
+            if input_node in labels and output_node in labels:
+                sympy_expression = _shared_analysis(
+                    (fingerprint, 'transfer_function', labels[input_node],
+                     labels[output_node]),
+                    compute
+                )
+            else:
+                sympy_expression = compute()
+            artifacts.put(key, sympy_expression)
+
+        return sympy_expression
+
     def _compute_transfer_function(
         self,
         input_node: str,
@@ -255,28 +1208,13 @@ class Circuit(Document):
 
         if transfer_function:
             # The transfer function was previously computed and cached.
+            sympy_expression = _load_expression(transfer_function)
+            return sympy_expression, self._numerical_function(sympy_expression)
 
-            # De-serialize
-            sympy_expression = dill.loads(transfer_function.sympy_expression)
-            lambda_function = dill.loads(transfer_function.lambda_function)
-            return sympy_expression, lambda_function
-
-        # De-serialize the signal-flow graph.
-        sfg = dill.loads(self.sfg)
-
-        # Compute the transfer function.
-        sympy_expression, _ = mason.transfer_function(
-            sfg, input_node, output_node
-        )
-
-        # Substitute all terms for their numerical values except the frequency.
-        lambda_function = sympy_expression.subs(
-            {k: v for k, v in self.parameters.items() if k != 'f'}
+        sympy_expression = self._transfer_function_expression(
+            input_node, output_node
         )
-
-        # Compile symbolic expression into lambda function for numerical
-        # computations.
-        lambda_function = sympy.lambdify('s', lambda_function, 'numpy')
+        lambda_function = self._numerical_function(sympy_expression)
 
         if cache_result:
             # Cache the newly computed sympy expression and lambda function for
@@ -285,9 +1223,11 @@ class Circuit(Document):
                 TransferFunction(
                     input_node=input_node,
                     output_node=output_node,
-                    # Serialize expression and function objects.
-                    sympy_expression=dill.dumps(sympy_expression),
-                    lambda_function=dill.dumps(lambda_function, recurse=True)
+                    # Serialize the expression only. The lambda function is
+                    # compiled again when loaded.
+                    sympy_expression=sfg_format.dumps_expression(
+                        sympy_expression, compress=True),
+                    expression_digest=sfg_format.digest(sympy_expression)
                 )
             )
 
@@ -318,22 +1258,76 @@ class Circuit(Document):
         Returns:
             The transfer function.
         """
+        return self.render_transfer_function(
+            input_node,
+            output_node,
+            latex=latex,
+            factor=factor,
+            numerical=numerical,
+            cache_result=cache_result
+        )['transfer_function']
+
+    def render_transfer_function(
+        self,
+        input_node: str,
+        output_node: str,
+        latex: bool = True,
+        factor: bool = True,
+        numerical: bool = False,
+        preview_terms: Optional[int] = None,
+        cache_result: bool = False
+    ) -> Dict:
+        """Formats the transfer function between a pair of input and output
+        nodes within a time budget.
+
+        See rendering.render: if the factored form is not ready in time, a
+        cheaper form is returned, and the factored form is cached for a later
+        request once computed.
+
+        Args:
+            input_node: The name of the input node.
+            output_node: The name of the output node.
+            latex: If True, formats the transfer function in latex. Defaults to
+                True.
+            factor: If True, factors the expression. Defaults to True.
+            numerical: If True, substitutes all symbols for numerical values,
+                except 's'. Defaults to False.
+            preview_terms: Optional; If given, a preview keeping this many
+                leading terms of the numerator and denominator is included.
+            cache_result: If True, caches the computed transfer function;
+                save() should be called to propagate changes to the cache.
+
+        Returns:
+            A dictionary with the 'transfer_function', whether it is
+            'complete', and, if preview_terms is given, the 'preview' and the
+            total number of 'terms'.
+        """
         sympy_expression, _ = self._compute_transfer_function(
             input_node,
             output_node,
             cache_result=cache_result
         )
 
+        return self._render(sympy_expression, 'transfer_function', latex,
+                            factor, numerical, preview_terms)
+
+    def _render(self, sympy_expression: sympy.Expr, name: str, latex: bool,
+                factor: bool, numerical: bool,
+                preview_terms: Optional[int]) -> Dict:
         if numerical:
-            sympy_expression = sympy_expression.subs(
+            sympy_expression = backend.subs(
+                sympy_expression,
                 {k: v for k, v in self.parameters.items() if k != 'f'}
             )
 
-        if factor:
-            sympy_expression = sympy_expression.factor()
+        text, complete = rendering.render(sympy_expression, factor, latex)
+        result = {name: text, 'complete': complete}
 
-        return sympy.latex(sympy_expression) if latex \
-            else str(sympy_expression)
+        if preview_terms is not None:
+            result['preview'], result['terms'] = rendering.preview(
+                sympy_expression, preview_terms, latex)
+
+        return result
 
     def eval_transfer_function(
         self,
@@ -345,7 +1339,8 @@ class Circuit(Document):
         frequency_unit: str = 'hz',
         gain_unit: Union[str, None] = 'db',
         phase_unit: str = 'deg',
-        cache_result: bool = False
+        cache_result: bool = False,
+        reduced: bool = False
     ) -> Tuple[List[float], List[float], List[float]]:
         """Given a frequency range, evaluates the gain and phase of the
             transfer function over that range.
@@ -364,16 +1359,13 @@ class Circuit(Document):
                 or 'rad' for radians.
             cache_result: If True, caches the computed transfer function;
                 save() should be called to propagate changes to the cache.
+            reduced: If True, evaluates a reduced-order model of the transfer
+                function fitted over the frequency range instead. See
+                reduced_transfer_function.
 
         Returns:
             A (frequency_list, gain_list, phase_list) tuple.
         """
-        _, lambda_function = self._compute_transfer_function(
-            input_node,
-            output_node,
-            cache_result=cache_result
-        )
-
         num_decades = math.log10(end_freq / start_freq)
         num_points = round(points_per_decade * num_decades)
         # Note that transfer function is expressed in terms of s.
@@ -390,6 +1382,22 @@ class Circuit(Document):
         else:
             raise ValueError('Invalid frequency unit.')
 
+        if reduced:
+            # Fit the model over the requested range, in hertz.
+            band = np.abs(s) / (2 * np.pi)
+            lambda_function = self.reduced_transfer_function(
+                input_node,
+                output_node,
+                start_freq=band[0],
+                end_freq=band[-1]
+            )
+        else:
+            _, lambda_function = self._compute_transfer_function(
+                input_node,
+                output_node,
+                cache_result=cache_result
+            )
+
         output = lambda_function(s)
 
         # If the output is not the same length as the frequency array, then
@@ -418,33 +1426,216 @@ class Circuit(Document):
         # Convert numpy arrays to plain python lists.
         return freq.tolist(), gain.tolist(), phase.tolist()
 
-    def _compute_loop_gain(self, cache_result: bool) \
-            -> Tuple[sympy.Expr, Callable]:
+    def _sfg_version(self) -> str:
+        # Identifies the content of the SFG, rather than its bytes, so that
+        # equal SFGs (e.g. a branch and the SFG it was forked from) share
+        # what is cached for them, however they were serialized.
+        return _content_version(self.sfg)
+
+    def _parameters_key(self) -> Tuple:
+        # The frequency parameter is only used to display edge weights, so it
+        # does not affect any transfer function.
+        return tuple(sorted(
+            (k, v) for k, v in self.parameters.items() if k != 'f'
+        ))
+
+    def _numerical_function(self, sympy_expression: sympy.Expr) -> Callable:
+        # Binds the current parameter values to the compiled expression. Each
+        # distinct expression is compiled at most once per worker, with the
+        # parameters as arguments (see compile_expression), so a change of
+        # parameter values does not compile anything again.
+        function = compile_expression(sympy_expression)
+        parameters = {k: v for k, v in self.parameters.items() if k != 'f'}
+        return lambda s: function(s, parameters)
+
+    def _sfg_entry(self) -> _SFGEntry:
+        key = self._sfg_version()
+
+        entry = _sfgs.get(key)
+        if entry is None:
+            entry = _SFGEntry(sfg_format.SFGReader(self.sfg), len(self.sfg))
+            _sfgs.put(key, entry)
+
+        return entry
+
+    def _canonical_sfg(self) -> Tuple[str, Dict[str, int]]:
+        # The fingerprint of the canonical form of the SFG, and the canonical
+        # labels of its nodes, which key the results shared with other
+        # circuits (see Analysis).
+        artifacts = self._sfg_entry().artifacts
+
+        canonical = artifacts.get('canonical')
+        if canonical is None:
+            canonical = sfg_format.canonical_form(self.sfg)
+            artifacts.put('canonical', canonical)
+
+        return canonical
+
+    def _load_sfg(self) -> nx.DiGraph:
+        """Returns the de-serialized SFG.
+
+        The graph is shared by every request for the same SFG version, and
+        is frozen: it must be read only. Use _checkout_sfg to modify it.
+        """
+        return self._sfg_entry().graph
 
-        if self.loop_gain:
-            sympy_expression = dill.loads(self.loop_gain.sympy_expression)
-            lambda_function = dill.loads(self.loop_gain.lambda_function)
-            return sympy_expression, lambda_function
+    def _checkout_sfg(self) -> nx.DiGraph:
+        """Returns a modifiable copy of the SFG.
 
-        # De-serialize the signal-flow graph.
-        sfg = dill.loads(self.sfg)
+        Only the graph structure is copied: the edge weight expressions are
+        immutable, and are shared with the cached SFG. Changes are stored with
+        _commit_sfg.
+        """
+        return self._load_sfg().copy()
+
+    def _commit_sfg(self, sfg: nx.DiGraph):
+        """Serializes a modified SFG, caches it as the new version, and
+        records the edit in the history."""
+        previous = self.sfg
+        self.sfg = sfg_format.dumps(sfg, compress=True)
+        if previous:
+            self._record_edit(previous)
+
+        # Another circuit may already have the same SFG cached, along with
+        # what was derived from it.
+        key = self._sfg_version()
+        if key not in _sfgs:
+            _sfgs.put(key, _SFGEntry(sfg_format.SFGReader(self.sfg),
+                                     len(self.sfg), sfg.copy()))
+
+    def reduced_transfer_function(
+        self,
+        input_node: str,
+        output_node: str,
+        tolerance: float = 1e-3,
+        max_order: int = 20,
+        start_freq: float = 1e-2,
+        end_freq: float = 1e9,
+        points_per_decade: int = 20
+    ) -> rational.PoleResidueModel:
+        """Fits a low-order rational approximation to the transfer function.
+
+        The exact transfer function is evaluated numerically over a frequency
+        range, and the lowest-order pole-residue model within the error bound
+        is found by vector fitting. Models are cached in-process per SFG
+        version and parameter set, so subsequent evaluations only cost a few
+        operations per pole and frequency point.
 
-        # Compute the loop gain function.
-        sympy_expression = mason.loop_gain(sfg)
+        Args:
+            input_node: The name of the input node.
+            output_node: The name of the output node.
+            tolerance: The maximum relative error of the model over the
+                frequency range.
+            max_order: The maximum number of poles.
+            start_freq: The starting frequency of the fit, in hertz.
+            end_freq: The ending frequency of the fit, in hertz. Note that the
+                exact evaluation of large expressions loses precision at very
+                high frequencies.
+            points_per_decade: The number of points per decade to fit.
 
-        # Substitute all terms for their numerical values except the frequency.
-        lambda_function = sympy_expression.subs(
-            {k: v for k, v in self.parameters.items() if k != 'f'}
-        )
+        Returns:
+            The reduced-order model. If no model meets the tolerance, the most
+            accurate one is returned; its error attribute should be checked.
+        """
+        key = (self._sfg_version(), self._parameters_key(), input_node,
+               output_node, tolerance, max_order, start_freq, end_freq,
+               points_per_decade)
+
+        model = _reduced_models.get(key)
+        if model is None:
+            _, lambda_function = self._compute_transfer_function(
+                input_node,
+                output_node,
+                cache_result=False
+            )
+
+            _, s = frequency_points(start_freq, end_freq, points_per_decade)
+            response = np.broadcast_to(lambda_function(s), s.shape)
+
+            model = rational.reduce_order(s, response, tolerance, max_order)
+            _reduced_models.put(key, model)
+
+        return model
+
+    def eval_time_response(
+        self,
+        input_node: str,
+        output_node: str,
+        response: str = 'step',
+        end_time: Optional[float] = None,
+        num_points: int = 500
+    ) -> Dict:
+        """Evaluates the step or impulse response of the transfer function.
+
+        The response is computed in closed form from the partial fractions of
+        the reduced-order model (see reduced_transfer_function), which is
+        cached per SFG version and parameter set, so it costs a single
+        vectorized evaluation once the frequency response has been viewed.
+
+        Args:
+            input_node: The name of the input node.
+            output_node: The name of the output node.
+            response: Either 'step' or 'impulse'. The impulse of the model's
+                direct term at t = 0 is not included in the impulse response.
+            end_time: The ending time, in seconds. Defaults to ten time
+                constants of the slowest pole, or of the fastest right
+                half-plane pole if the model is unstable.
+            num_points: The number of time points.
+
+        Returns:
+            A dictionary with the 'time' and 'response' lists, the 'order'
+            and fitting 'error' of the model used, and whether it is
+            'stable', i.e. has no right half-plane poles.
+        """
+        if response not in ('step', 'impulse'):
+            raise ValueError('Invalid response.')
+        if end_time is not None and end_time <= 0:
+            raise ValueError('Invalid end time.')
+        if num_points < 2:
+            raise ValueError('Invalid number of points.')
+
+        model = self.reduced_transfer_function(input_node, output_node)
+
+        if end_time is None:
+            end_time = 10 * model.time_constant()
+
+        t = np.linspace(0, end_time, num_points)
+        values = model.step(t) if response == 'step' else model.impulse(t)
+
+        return {
+            'time': t.tolist(),
+            'response': analysis.to_json_array(values),
+            'order': model.order,
+            'error': model.error,
+            'stable': bool(np.all(model.poles.real <= 0)),
+        }
+
+    def _compute_loop_gain(self, cache_result: bool) \
+            -> Tuple[sympy.Expr, Callable]:
+
+        if self.loop_gain:
+            sympy_expression = _load_expression(self.loop_gain)
+            return sympy_expression, self._numerical_function(sympy_expression)
+
+        # The symbolic loop gain function depends on the SFG alone.
+        artifacts = self._sfg_entry().artifacts
+
+        sympy_expression = artifacts.get('loop_gain')
+        if sympy_expression is None:
+            fingerprint, _ = self._canonical_sfg()
+            sympy_expression = _shared_analysis(
+                (fingerprint, 'loop_gain'),
+                lambda: mason.loop_gain(self._load_sfg())
+            )
+            artifacts.put('loop_gain', sympy_expression)
 
-        # Compile symbolic expression into lambda function for numerical
-        # computations.
-        lambda_function = sympy.lambdify('s', lambda_function, 'numpy')
+        lambda_function = self._numerical_function(sympy_expression)
 
         if cache_result:
             self.loop_gain = LoopGainFunction(
-                sympy_expression=dill.dumps(sympy_expression),
-                lambda_function=dill.dumps(lambda_function, recurse=True)
+                sympy_expression=sfg_format.dumps_expression(
+                    sympy_expression, compress=True),
+                expression_digest=sfg_format.digest(sympy_expression)
             )
 
         return sympy_expression, lambda_function
@@ -469,17 +1660,42 @@ class Circuit(Document):
         Returns:
             The loop gain function.
         """
-        sympy_expression, _ = self._compute_loop_gain(cache_result=cache_result)
+        return self.render_loop_gain(
+            latex=latex,
+            factor=factor,
+            numerical=numerical,
+            cache_result=cache_result
+        )['loop_gain']
 
-        if numerical:
-            sympy_expression = sympy_expression.subs(
-                {k: v for k, v in self.parameters.items() if k != 'f'}
-            )
+    def render_loop_gain(
+        self,
+        latex: bool = False,
+        factor: bool = True,
+        numerical: bool = False,
+        preview_terms: Optional[int] = None,
+        cache_result: bool = False
+    ) -> Dict:
+        """Formats the loop gain function of a circuit within a time budget.
 
-        if factor:
-            sympy_expression = sympy_expression.factor()
+        Args:
+            latex: If True, formats the function in latex.
+            factor: If True, factors the expression. Defaults to True.
+            numerical: If True, substitutes all symbols for numerical values,
+                except 's'. Defaults to False.
+            preview_terms: Optional; If given, a preview keeping this many
+                leading terms of the numerator and denominator is included.
+            cache_result: If True, caches the computed loop gain function;
+                save() should be called to propagate changes to the cache.
 
-        return sympy.latex(sympy_expression) if latex else str(sympy_expression)
+        Returns:
+            A dictionary with the 'loop_gain', whether it is 'complete', and,
+            if preview_terms is given, the 'preview' and the total number of
+            'terms'.
+        """
+        sympy_expression, _ = self._compute_loop_gain(cache_result=cache_result)
+
+        return self._render(sympy_expression, 'loop_gain', latex, factor,
+                            numerical, preview_terms)
 
     def eval_loop_gain(
             self,
@@ -555,7 +1771,57 @@ class Circuit(Document):
 
         # Convert numpy arrays to plain python lists.
         return freq.tolist(), gain.tolist(), phase.tolist()
-    
+
+    def eval_nyquist(
+        self,
+        start_freq: float,
+        end_freq: float,
+        points_per_decade: int = 10,
+        max_points: int = 5000,
+        cache_result: bool = False
+    ) -> Dict:
+        """Evaluates the Nyquist plot of the loop gain function, with
+        additional points where the plot turns sharply or passes close to the
+        critical point.
+
+        The loop gain is 1 - (graph determinant), so the closed loop becomes
+        unstable when the loop gain reaches 1 rather than -1; 1 is used as the
+        critical point.
+
+        Args:
+            start_freq: The starting frequency, in hertz.
+            end_freq: The ending frequency, in hertz.
+            points_per_decade: The number of points per decade before
+                refinement.
+            max_points: The maximum number of points.
+            cache_result: If True, caches the computed loop gain function;
+                save() should be called to propagate changes to the cache.
+
+        Returns:
+            A dictionary with the 'frequency', 'real' and 'imag' lists, the
+            'critical_point', the number of clockwise 'encirclements' of it
+            by the full Nyquist contour, and whether that count is 'exact'.
+        """
+        _, lambda_function = self._compute_loop_gain(cache_result=cache_result)
+
+        result = nyquist.adaptive_response(
+            lambda_function,
+            start_freq,
+            end_freq,
+            points_per_decade,
+            critical_point=1,
+            max_points=max_points
+        )
+        response = result['response']
+
+        return {
+            'frequency': result['frequency'].tolist(),
+            'real': analysis.to_json_array(response.real),
+            'imag': analysis.to_json_array(response.imag),
+            'critical_point': 1,
+            **nyquist.encirclements(response, critical_point=1),
+        }
+
     def remove_branch_sfg(self, source, target):
         """Remove a branch from the sfg.
 
@@ -563,14 +1829,9 @@ class Circuit(Document):
             source: node representing start of path
             target: node representing end of the path
         """
-        #save current sfg
-        self.sfg_stack.append(self.sfg)
-        self.redo_stack.clear()
-        if len(self.sfg_stack) > 5:
-            self.sfg_stack = self.sfg_stack[-5:]
 
-        # De-serialize sfg
-        sfg = dill.loads(self.sfg)
+        # Check out a modifiable copy of the sfg
+        sfg = self._checkout_sfg()
 
         # check nodes exist
         if not sfg or not sfg.has_node(source) or not sfg.has_node(target):
@@ -579,7 +1840,7 @@ class Circuit(Document):
         sfg = removing_branch(sfg, source, target)
         if not sfg or sfg == "Path is too short":
             raise Exception('The selected branch does not exist')
-        self.sfg = dill.dumps(sfg)
+        self._commit_sfg(sfg)
 
     def simplify_sfg(self, source, target ):
         """Simplify the sfg.
@@ -588,14 +1849,9 @@ class Circuit(Document):
             source: node representing start of path
             target: node representing end of the path
         """
-        #save current sfg
-        self.sfg_stack.append(self.sfg)
-        self.redo_stack.clear()
-        if len(self.sfg_stack) > 5:
-            self.sfg_stack = self.sfg_stack[-5:]
 
-        # De-serialize sfg
-        sfg = dill.loads(self.sfg)
+        # Check out a modifiable copy of the sfg
+        sfg = self._checkout_sfg()
 
         # check nodes exist
         if not sfg or not sfg.has_node(source) or not sfg.has_node(target):
@@ -605,7 +1861,7 @@ class Circuit(Document):
         if not sfg or sfg == "Path is too short":
             raise Exception('The selected path is too short') 
 
-        self.sfg = dill.dumps(sfg)
+        self._commit_sfg(sfg)
 
 
     # STARTED HERE 
@@ -617,28 +1873,21 @@ class Circuit(Document):
             source: node representing start of path (optional)
             target: node representing end of path (optional)
         """
-        # Save current SFG state for undo functionality
-        self.sfg_stack.append(self.sfg)
-        self.redo_stack.clear()
-        
-        if len(self.sfg_stack) > 5:
-            self.sfg_stack = self.sfg_stack[-5:]
 
         try:
-            # De-serialize the SFG (make sure it's a valid graph object)
-            sfg = dill.loads(self.sfg)
+            # Check out the SFG (make sure it's a valid graph object)
+            sfg = self._checkout_sfg()
 
             # Remove dead branches (or simplify based on the given source/target)
             print("removing dead branches...")
             sfg = remove_dead_branches(sfg)  # Pass 'sfg' to remove_dead_branches
 
             # Update the SFG state with the simplified graph
-            self.sfg = dill.dumps(sfg)
+            self._commit_sfg(sfg)
 
         except Exception as e:
             # Handle any errors (like bad deserialization or invalid graph)
             print(f"Error simplifying SFG: {e}")
-            self.sfg = self.sfg_stack.pop()  # Restore previous state in case of error
             raise  # Re-raise the exception for further handling if needed
 
         # Optionally, you could return the simplified SFG or just ensure the state is updated
@@ -656,28 +1905,21 @@ class Circuit(Document):
     def simplify_whole_graph_trivial(self):
         print("Simplifying the entire graph...")
 
-        # Save current SFG state for undo functionality
-        self.sfg_stack.append(self.sfg)
-        self.redo_stack.clear()
-        
-        if len(self.sfg_stack) > 5:
-            self.sfg_stack = self.sfg_stack[-5:]
 
         try:
-            # De-serialize the SFG (make sure it's a valid graph object)
-            sfg = dill.loads(self.sfg)
+            # Check out the SFG (make sure it's a valid graph object)
+            sfg = self._checkout_sfg()
 
             # Remove dead branches (or simplify based on the given source/target)
             print("removing dead branches...")
             sfg = simplify_whole_graph(sfg)  # Pass 'sfg' to remove_dead_branches
 
             # Update the SFG state with the simplified graph
-            self.sfg = dill.dumps(sfg)
+            self._commit_sfg(sfg)
 
         except Exception as e:
             # Handle any errors (like bad deserialization or invalid graph)
             print(f"Error simplifying SFG: {e}")
-            self.sfg = self.sfg_stack.pop()  # Restore previous state in case of error
             raise  # Re-raise the exception for further handling if needed
 
         # Optionally, you could return the simplified SFG or just ensure the state is updated
@@ -692,14 +1934,170 @@ class Circuit(Document):
         return len(list(self.sfg.successors(node))) == 0
 
     def undo_sfg(self):
-        if len(self.sfg_stack) > 0:
-            self.redo_stack.append(self.sfg)
-            self.sfg = self.sfg_stack.pop()
+        """Reverts the last edit of the SFG, if there is one.
+
+        Raises:
+            ConflictError: If the edited nodes or edges were changed since.
+        """
+        if not self.history:
+            return
+
+        edit = self.history[-1]
+        sfg = self._apply_edit(edit, reverse=True)
+        if edit.checkpoint and sfg_format.equal(sfg, edit.checkpoint):
+            sfg = edit.checkpoint
+
+        self.sfg = sfg
+        self.history.pop()
+        self.undone.append(edit)
 
     def redo_sfg(self):
-        if len(self.redo_stack) > 0:
-            self.sfg_stack.append(self.sfg)
-            self.sfg = self.redo_stack.pop()
+        """Applies the last undone edit of the SFG again, if there is one.
+
+        Raises:
+            ConflictError: If the edited nodes or edges were changed since.
+        """
+        if not self.undone:
+            return
+
+        edit = self.undone[-1]
+        self.sfg = self._apply_edit(edit)
+        self.undone.pop()
+        self.history.append(edit)
+
+    def list_branches(self) -> List[Dict]:
+        """Describes the branches of the SFG.
+
+        Returns:
+            A list with a dictionary for each branch, with its name, the
+            branch it was forked from (parent), and the size of its stored
+            changes from the original SFG, in bytes.
+        """
+        return [{
+            'name': branch.name,
+            'parent': branch.parent,
+            'size': len(branch.delta or b''),
+        } for branch in self.branches]
+
+    def fork_branch(self, name: str, parent: str = MAIN_BRANCH):
+        """Creates a named branch of the SFG.
+
+        The branch only stores the changes of its parent from the original
+        SFG, so a branch of an unchanged SFG stores nothing.
+
+        Args:
+            name: The name of the branch.
+            parent: The branch to copy. By default, the circuit's SFG.
+
+        Raises:
+            ValueError: If the name is invalid or in use.
+            LookupError: If the parent branch does not exist.
+        """
+        if not name or name == MAIN_BRANCH or \
+                any(branch.name == name for branch in self.branches):
+            raise ValueError(f'Invalid branch name {name!r}.')
+
+        if parent == MAIN_BRANCH:
+            delta = sfg_format.diff(self._original_sfg(), self.sfg)
+        else:
+            delta = self._find_branch(parent).delta
+
+        self.branches.append(SFGBranch(name=name, parent=parent, delta=delta))
+
+    def delete_branch(self, name: str):
+        """Deletes a branch of the SFG.
+
+        Raises:
+            LookupError: If the branch does not exist.
+        """
+        self.branches.remove(self._find_branch(name))
+
+    def checkout_branch(self, name: str):
+        """Replaces the circuit's SFG by a copy of a branch. This is
+        recorded in the history, so that it can be undone.
+
+        Raises:
+            LookupError: If the branch does not exist.
+        """
+        previous = self.sfg
+        self.sfg = self.branch_sfg(name)
+        self._record_edit(previous)
+
+    def branch_sfg(self, name: str) -> bytes:
+        """Returns the serialized SFG of a branch.
+
+        Raises:
+            LookupError: If the branch does not exist.
+        """
+        if name == MAIN_BRANCH:
+            return self.sfg
+
+        delta = self._find_branch(name).delta
+        if not delta:
+            return self._original_sfg()
+
+        original = self._original_sfg()
+        key = (str(self.id), _content_version(original),
+               hashlib.sha1(delta).hexdigest())
+        data = _branch_sfgs.get(key)
+        if data is None:
+            data = sfg_format.patch(original, delta, compress=True)
+            _branch_sfgs.put(key, data)
+
+        return data
+
+    def branch(self, name: str) -> 'Circuit':
+        """Returns a branch of the SFG as a circuit, with the parameters of
+        this one, to compute its transfer functions and responses.
+
+        The circuit must not be saved. It shares the per-worker caches of
+        every SFG with the same content, e.g. the one it was forked from.
+
+        Raises:
+            LookupError: If the branch does not exist.
+        """
+        if name == MAIN_BRANCH:
+            return self
+
+        return Circuit(id=self.id, name=self.name, parameters=self.parameters,
+                       sfg=self.branch_sfg(name))
+
+    def _find_branch(self, name: str) -> SFGBranch:
+        for branch in self.branches:
+            if branch.name == name:
+                return branch
+        raise LookupError(f'Branch {name!r} not found')
+
+    def _original_sfg(self) -> bytes:
+        if not self.original_sfg:
+            raise ValueError('The circuit has no original SFG to branch from.')
+        return self.original_sfg
+
+    def _apply_edit(self, edit: SFGEdit, reverse: bool = False) -> bytes:
+        try:
+            return sfg_format.patch(self.sfg, edit.delta, reverse=reverse,
+                                    compress=True)
+        except ValueError as e:
+            raise ConflictError(f'The SFG was changed since the edit: {e}')
+
+    def _record_edit(self, previous: bytes):
+        # Adds the change from the previous SFG to the current one to the
+        # history, dropping the edits which were undone.
+        delta = sfg_format.diff(previous, self.sfg)
+        if delta is None:
+            return
+
+        edit = SFGEdit(delta=delta)
+        recent = self.history[-(CHECKPOINT_INTERVAL - 1):]
+        # The checkpoints are looked for without reading their blobs.
+        if not any(e._data.get('checkpoint') for e in recent):
+            edit.checkpoint = previous
+
+        self.history.append(edit)
+        if len(self.history) > HISTORY_DEPTH:
+            self.history = self.history[-HISTORY_DEPTH:]
+        if self.undone:
+            self.undone = []
 
     def get_current_sfg(self):
         return self.deserialize_sfg()
@@ -719,7 +2117,7 @@ class Circuit(Document):
         # print("editSymbolic:", editSymbolic)
         
         # print("loading sfg")
-        sfg = dill.loads(self.sfg)
+        sfg = self._checkout_sfg()
         # print("sfg loaded")
         # print("sfg:", sfg)
 
@@ -737,7 +2135,7 @@ class Circuit(Document):
                 # print("edge data:", sfg.edges[src, dst])
                 sfg.edges[src, dst]['weight'] = editSymbolic
                 # print("edge data after edit:", sfg.edges[src, dst])
-                self.sfg = dill.dumps(sfg)
+                self._commit_sfg(sfg)
                 # return sfg.edges[src, dst]['weight']
                 break
         # self.sfg = dill.dumps(sfg)
@@ -775,30 +2173,22 @@ class Circuit(Document):
         # Load the current state of the SFG
         try:
             # print("Loading SFG...")
-            sfg = dill.loads(self.sfg)
+            sfg = self._checkout_sfg()
             # print("SFG loaded successfully.")
         except Exception as e:
             raise RuntimeError(f"Failed to load SFG: {e}")
 
-        # Iterate through edges and find the one to update
-        edge_found = False
-        # print("Iterating through edges...")
-        for src, dst in sfg.edges:
-            if src == editSrc and dst == editDst:
-                # print(f"Found edge from {src} to {dst}. Updating symbolic weight.")
-                # Update the symbolic weight for the found edge
-                sfg.edges[src, dst]['weight'] = editSymbolic
-                edge_found = True
-                break
-
         # Handle the case where the edge wasn't found
-        if not edge_found:
+        if not sfg.has_edge(editSrc, editDst):
             raise ValueError(f"The edge from {editSrc} to {editDst} does not exist!")
 
+        # Update the symbolic weight for the found edge
+        sfg.edges[editSrc, editDst]['weight'] = editSymbolic
+
         # Serialize the updated SFG back to the database field
         try:
             # print("Serializing the updated SFG...")
-            self.sfg = dill.dumps(sfg)
+            self._commit_sfg(sfg)
             # print("SFG serialized and stored successfully.")
         except Exception as e:
             raise RuntimeError(f"Failed to serialize the updated SFG: {e}")
@@ -811,24 +2201,12 @@ class Circuit(Document):
     # SFG binary field --> graph (json object)
     def deserialize_sfg(self):
         output = {}
-        sfg = dill.loads(self.sfg) # binary to obj (deserialization)
-        freq = 2j * math.pi * sympy.Symbol('f')
+        sfg = self._checkout_sfg()
 
         for src, dst in sfg.edges:
-            symbolic = sfg.edges[src, dst]['weight']
-
-            if isinstance(symbolic, sympy.Expr):
-                numeric = symbolic.subs('s', freq).subs(self.parameters)
-            else:
-                numeric = symbolic
-
-            magnitude, phase = cmath.polar(numeric)
-
-            sfg.edges[src, dst]['weight'] = {
-                'symbolic': sympy.latex(symbolic) if isinstance(symbolic, sympy.Expr) else str(symbolic),
-                'magnitude': magnitude,
-                'phase': phase*(180/cmath.pi)
-            }
+            sfg.edges[src, dst]['weight'] = expressions.edge_weight(
+                sfg.edges[src, dst]['weight'], self.parameters
+            )
 
         output['sfg'] = nx.cytoscape_data(sfg)
         return output
@@ -855,8 +2233,11 @@ class Circuit(Document):
         self.transfer_functions = new_circuit.transfer_functions
         self.loop_gain = new_circuit.loop_gain
         self.created = new_circuit.created
-        self.sfg_stack = new_circuit.sfg_stack
-        self.redo_stack = new_circuit.redo_stack
+        self.history = getattr(new_circuit, 'history', None) or []
+        self.undone = getattr(new_circuit, 'undone', None) or []
+        # Branches are stored as deltas from the original SFG, so only those
+        # of the imported circuit still apply.
+        self.branches = getattr(new_circuit, 'branches', None) or []
 
     def compute_phase_margin(
             self,
@@ -1036,7 +2417,220 @@ class Circuit(Document):
         self.update_parameters({param_name: original_param})
 
         return param_values, bandwidths
-    
+
+    def sweep_parameters(
+        self,
+        input_node: str,
+        output_node: str,
+        axes: Optional[List[Dict]] = None,
+        corners: Optional[List[Dict[str, float]]] = None,
+        metrics: Iterable[str] = ('phase_margin', 'bandwidth', 'dc_gain'),
+        start_freq: float = 1e3,
+        end_freq: float = 1e12,
+        points_per_decade: int = 30
+    ) -> Dict:
+        """Sweeps several parameters at once and computes transfer function
+        metrics over the full grid, or over a list of corners.
+
+        Unlike sweep_params_for_phase_margin, the circuit parameters are not
+        modified; the transfer function is compiled once with its parameters
+        as arguments and evaluated for all parameter sets in vectorized calls.
+
+        Args:
+            input_node: The name of the input node.
+            output_node: The name of the output node.
+            axes: Sweep axis specifications. Each is a dictionary with the
+                parameter 'name', and either explicit 'values', or a 'scale'
+                ('linear' or 'log') with 'start', 'stop' and 'num' values.
+            corners: A list of parameter sets to evaluate instead of a grid.
+            metrics: The metrics to compute. Can include 'phase_margin',
+                'bandwidth' and 'dc_gain'.
+            start_freq: The starting frequency, in hertz.
+            end_freq: The ending frequency, in hertz.
+            points_per_decade: The number of points per decade.
+
+        Returns:
+            A dictionary with the swept 'parameters', the 'shape' of the result
+            and the 'metrics' arrays.
+        """
+        sympy_expression = self._transfer_function_expression(
+            input_node, output_node
+        )
+        freq, _ = frequency_points(start_freq, end_freq, points_per_decade)
+
+        return analysis.sweep(
+            sympy_expression,
+            freq,
+            self.parameters,
+            axes=axes,
+            corners=corners,
+            metrics=metrics
+        )
+
+    def montecarlo(
+        self,
+        input_node: str,
+        output_node: str,
+        distributions: Dict[str, Dict],
+        samples: int = 1000,
+        metrics: Iterable[str] = ('phase_margin', 'bandwidth', 'dc_gain'),
+        bins: int = 20,
+        percentiles: Iterable[float] = (1, 5, 50, 95, 99),
+        seed: Optional[int] = None,
+        start_freq: float = 1e3,
+        end_freq: float = 1e12,
+        points_per_decade: int = 30
+    ) -> Dict:
+        """Runs a Monte-Carlo tolerance analysis of the transfer function.
+
+        Args:
+            input_node: The name of the input node.
+            output_node: The name of the output node.
+            distributions: A mapping from parameter names, or patterns such
+                as 'R*', to distributions, e.g.
+                {'R*': {'type': 'uniform', 'tolerance': 0.05}}. See
+                analysis.sample_parameters.
+            samples: The number of samples.
+            metrics: The metrics to compute. Can include 'phase_margin',
+                'bandwidth' and 'dc_gain'.
+            bins: The number of histogram bins per metric.
+            percentiles: The percentiles to report per metric.
+            seed: Optional; A seed for reproducible results.
+            start_freq: The starting frequency, in hertz.
+            end_freq: The ending frequency, in hertz.
+            points_per_decade: The number of points per decade.
+
+        Returns:
+            A dictionary with the number of 'samples', the randomized
+            'parameters' and a summary of each metric.
+        """
+        sympy_expression = self._transfer_function_expression(
+            input_node, output_node
+        )
+        freq, _ = frequency_points(start_freq, end_freq, points_per_decade)
+
+        return analysis.montecarlo(
+            sympy_expression,
+            freq,
+            self.parameters,
+            distributions,
+            samples,
+            metrics=metrics,
+            bins=bins,
+            percentiles=percentiles,
+            seed=seed
+        )
+
+    def solve_for(
+        self,
+        input_node: str,
+        output_node: str,
+        metric: str,
+        target: float,
+        free: List[Dict],
+        tolerance: float = 1e-3,
+        start_freq: float = 1e3,
+        end_freq: float = 1e12,
+        points_per_decade: int = 100
+    ) -> Dict:
+        """Finds the values of one or more free parameters for which a
+        transfer function metric reaches a target, e.g. the capacitance that
+        gives 60 degrees of phase margin.
+
+        The circuit parameters are not modified; the solved values can be
+        applied with update_parameters.
+
+        Args:
+            input_node: The name of the input node.
+            output_node: The name of the output node.
+            metric: The target metric. Can be 'phase_margin', 'bandwidth' or
+                'dc_gain'.
+            target: The target metric value.
+            free: The free parameters, each a dictionary with the parameter
+                'name', its 'min' and 'max' bounds, and optionally its
+                'scale' ('linear' or 'log').
+            tolerance: The tolerance on the metric, relative to
+                max(1, |target|).
+            start_freq: The starting frequency, in hertz.
+            end_freq: The ending frequency, in hertz.
+            points_per_decade: The number of points per decade. Metrics are
+                computed on this frequency grid, so it bounds how precisely
+                the target can be met.
+
+        Returns:
+            A dictionary with the solved 'parameters', the achieved 'metric'
+            value, the 'target', whether the search 'converged', and the
+            number of parameter sets evaluated ('evaluations').
+        """
+        sympy_expression = self._transfer_function_expression(
+            input_node, output_node
+        )
+        freq, _ = frequency_points(start_freq, end_freq, points_per_decade)
+
+        return analysis.solve_for(
+            sympy_expression,
+            freq,
+            self.parameters,
+            metric,
+            target,
+            free,
+            tolerance=tolerance
+        )
+
+    def eval_sensitivity(
+        self,
+        input_node: str,
+        output_node: str,
+        start_freq: float,
+        end_freq: float,
+        points_per_decade: int,
+        phase_unit: str = 'deg'
+    ) -> Dict:
+        """Given a frequency range, evaluates the normalized sensitivities of
+        the transfer function's magnitude and phase to every circuit
+        parameter over that range.
+
+        The magnitude sensitivity to a parameter p is d(ln|H|) / d(ln p), and
+        the phase sensitivity is d(angle(H)) / d(ln p), i.e. the relative
+        change in gain, and the change in phase, per relative change in p.
+
+        Args:
+            input_node: The name of the input node.
+            output_node: The name of the output node.
+            start_freq: The starting frequency, in hertz.
+            end_freq: The ending frequency, in hertz.
+            points_per_decade: The number of points per decade.
+            phase_unit: The unit for the phase sensitivities. Can be 'deg'
+                for degrees, or 'rad' for radians.
+
+        Returns:
+            A dictionary with the 'frequency' list, and 'magnitude' and
+            'phase' mappings from each parameter to its list of
+            sensitivities.
+        """
+        sympy_expression = self._transfer_function_expression(
+            input_node, output_node
+        )
+        freq, s = frequency_points(start_freq, end_freq, points_per_decade)
+
+        function = compile_sensitivities(sympy_expression)
+        sensitivities = function(s, self.parameters)
+
+        if phase_unit == 'rad':
+            phase = sensitivities.imag
+        elif phase_unit == 'deg':
+            phase = np.degrees(sensitivities.imag)
+        else:
+            raise ValueError('Invalid phase unit.')
+
+        names = function.parameter_names
+        return {
+            'frequency': freq.tolist(),
+            'magnitude': dict(zip(names,
+                                  analysis.to_json_array(sensitivities.real))),
+            'phase': dict(zip(names, analysis.to_json_array(phase))),
+        }
+
     def is_device_valid(self, device_name: str) -> bool:
         """
         Check if a given device exists in the circuit parameters.
@@ -1047,4 +2641,145 @@ class Circuit(Document):
         Returns:
             bool: True if the device exists, False otherwise.
         """
-        return device_name in self.parameters
\ No newline at end of file
+        return device_name in self.parameters
+
+
+class _Preview:
+    """The state needed to evaluate a circuit's transfer functions without
+    loading it from the database.
+
+    Previews are shared by concurrent requests: the lock guards their
+    compiled functions and parameters.
+    """
+
+    def __init__(self, circuit: Circuit):
+        # The version of the stored circuit, and of its SFG, which the
+        # parameters and compiled functions are those of.
+        self.version = circuit.version
+        self.sfg_version = circuit._sfg_version()
+        self.parameters = dict(circuit.parameters)
+        self.functions = {}
+        self.lock = Lock()
+
+
+def _refresh_preview(circuit: Circuit):
+    # Called whenever a circuit is saved by this process. Saves by other
+    # processes are found by preview_transfer_function, from the version of
+    # the stored circuit.
+    preview = _previews.get(str(circuit.id))
+    if preview is None:
+        return
+
+    if preview.sfg_version != circuit._sfg_version():
+        # Compiled functions are only valid for the SFG they came from.
+        _previews.pop(str(circuit.id))
+        return
+
+    with preview.lock:
+        preview.version = circuit.version
+        preview.parameters = dict(circuit.parameters)
+
+
+def preview_transfer_function(
+    circuit_id: str,
+    input_node: str,
+    output_node: str,
+    overlay: Dict[str, float],
+    start_freq: float,
+    end_freq: float,
+    points_per_decade: int,
+    gain_unit: str = 'db',
+    phase_unit: str = 'deg'
+) -> Tuple[List[float], List[float], List[float]]:
+    """Evaluates the gain and phase of a transfer function with temporary
+    parameter values, for live previews while parameters are edited.
+
+    The transfer function is compiled with its parameters as arguments and
+    kept in process memory along with the circuit parameters, so that only
+    the first call for a circuit and node pair loads the circuit from the
+    database. Later calls only read the version of the stored circuit, and
+    load it again if it was saved since, e.g. by another server process. The
+    overlay is never saved.
+
+    Args:
+        circuit_id: The ID of the circuit.
+        input_node: The name of the input node.
+        output_node: The name of the output node.
+        overlay: Parameter values replacing those of the circuit.
+        start_freq: The starting frequency, in hertz.
+        end_freq: The ending frequency, in hertz.
+        points_per_decade: The number of points per decade.
+        gain_unit: The unit for the gain output. Can be None or
+            '' for dimensionless, or 'db' for decibels.
+        phase_unit: The unit for the phase output. Can be 'deg' for degrees,
+            or 'rad' for radians.
+
+    Returns:
+        A (frequency_list, gain_list, phase_list) tuple.
+
+    Raises:
+        LookupError: If the circuit does not exist.
+    """
+    stored = Circuit.objects(id=circuit_id).only('version') \
+        .as_pymongo().first()
+    if stored is None:
+        raise LookupError('Circuit not found')
+
+    circuit = None
+    preview = _previews.get(circuit_id)
+    if preview is None or preview.version != stored.get('version'):
+        circuit = Circuit.load(circuit_id, 'parameters', 'sfg',
+                               'transfer_functions')
+        if not circuit:
+            raise LookupError('Circuit not found')
+
+        current = _Preview(circuit)
+        if preview is not None and preview.sfg_version == current.sfg_version:
+            # Only the parameters changed, which the compiled functions take
+            # as arguments.
+            with preview.lock:
+                current.functions.update(preview.functions)
+        preview = current
+        _previews.put(circuit_id, preview)
+
+    key = (input_node, output_node)
+    with preview.lock:
+        function = preview.functions.get(key)
+        parameters = preview.parameters
+
+    if function is None:
+        circuit = circuit or Circuit.load(circuit_id, 'parameters', 'sfg',
+                                          'transfer_functions')
+        if not circuit:
+            raise LookupError('Circuit not found')
+
+        function = compile_expression(circuit._transfer_function_expression(
+            input_node, output_node
+        ))
+        # The circuit may have been saved since the preview was made.
+        if circuit._sfg_version() == preview.sfg_version:
+            with preview.lock:
+                preview.functions[key] = function
+
+    if not overlay.keys() <= parameters.keys():
+        raise ValueError('Invalid parameters.')
+
+    freq, s = frequency_points(start_freq, end_freq, points_per_decade)
+    output = function(s, {**parameters, **overlay})
+
+    if gain_unit in (None, ''):
+        gain = np.abs(output)
+    elif gain_unit == 'db':
+        gain = gain_db(output)
+    else:
+        raise ValueError('Invalid gain unit.')
+
+    if phase_unit == 'rad':
+        phase = np.angle(output, deg=False)
+    elif phase_unit == 'deg':
+        phase = np.angle(output, deg=True)
+    else:
+        raise ValueError('Invalid phase unit.')
+
+    return (freq.tolist(), analysis.to_json_array(gain),
+            analysis.to_json_array(phase))
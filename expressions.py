@@ -0,0 +1,101 @@
+"""Process-wide cache of SFG edge weight expressions.
+
+Every de-serialized SFG holds new copies of its edge weight expressions, even
+when they are unchanged, so rendering them (e.g. after an undo) would repeat
+the same work. Expressions are instead interned by structure: equal
+expressions share a single entry, which holds their LaTeX form and compiled
+numeric function once computed. An unchanged edge is never re-rendered or
+re-compiled while its entry is cached.
+
+Note that sympy expressions define __slots__ without __weakref__, so they
+cannot be held in a weak-value table; entries are kept in a bounded LRU cache
+instead.
+"""
+from typing import Mapping, Optional
+import cmath
+import math
+
+import numpy as np
+import sympy
+
+from cache import LRUCache
+from parametric import ParametricFunction
+import symbolic
+
+
+class _Entry:
+    __slots__ = ('expression', 'latex', 'function', 'evaluations')
+
+    def __init__(self, expression: sympy.Expr):
+        self.expression = expression
+        self.latex: Optional[str] = None
+        self.function: Optional[ParametricFunction] = None
+        self.evaluations = 0
+
+
+_entries = LRUCache(maxsize=4096)
+
+
+def _entry(expression: sympy.Expr) -> _Entry:
+    entry = _entries.get(expression)
+    if entry is None:
+        entry = _Entry(expression)
+        _entries.put(expression, entry)
+    return entry
+
+
+def latex(expression: sympy.Expr) -> str:
+    """Renders an expression in LaTeX, re-using previous renderings of equal
+    expressions."""
+    entry = _entry(expression)
+    if entry.latex is None:
+        entry.latex = sympy.latex(expression)
+    return entry.latex
+
+
+def evaluate(expression: sympy.Expr, parameters: Mapping[str, float]) \
+        -> complex:
+    """Evaluates an expression at the frequency given by the parameter 'f',
+    in hertz, re-using the compiled function of equal expressions.
+
+    Args:
+        expression: An expression of 's' and circuit parameters.
+        parameters: The parameter values, including 'f'.
+
+    Returns:
+        The complex value.
+    """
+    entry = _entry(expression)
+
+    # Compiling costs more than a single substitution, so expressions are
+    # only compiled once they are evaluated again.
+    if entry.function is None and entry.evaluations == 0:
+        entry.evaluations += 1
+        s = 2j * math.pi * sympy.Symbol('f')
+        return complex(symbolic.subs(symbolic.subs(expression, {'s': s}),
+                                     parameters))
+
+    if entry.function is None:
+        entry.function = ParametricFunction(expression)
+
+    s = np.array([2j * math.pi * parameters['f']])
+    return complex(entry.function(s, parameters)[0])
+
+
+def edge_weight(weight, parameters: Mapping[str, float]) -> dict:
+    """Formats an SFG edge weight for output, with its symbolic form and its
+    magnitude and phase (in degrees) at the frequency given by the parameter
+    'f'."""
+    if isinstance(weight, sympy.Expr):
+        text = latex(weight)
+        numeric = evaluate(weight, parameters)
+    else:
+        text = str(weight)
+        numeric = weight
+
+    magnitude, phase = cmath.polar(numeric)
+    return {
+        'symbolic': text,
+        'magnitude': magnitude,
+        'phase': phase * (180 / cmath.pi),
+    }
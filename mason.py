@@ -1,11 +1,13 @@
 from itertools import tee, zip_longest, groupby
-from typing import List, Set, Tuple, Any, Callable, Iterator, Optional
+from typing import Dict, List, Set, Tuple, Any, Callable, Iterator, Optional
 from collections import OrderedDict
 
 import sympy
 import networkx as nx
 from networkx.algorithms import all_simple_paths, simple_cycles
 
+import symbolic
+
 
 def pairwise(iterable):
     """Returns a pairwise iterator."""
@@ -53,9 +55,18 @@ def disjoint_combinations(items: List, key: Callable[[Any], Set]) \
     yield from dfs(0, [], set())
 
 
+def edge_weights(graph: nx.DiGraph) -> Dict[Tuple[Any, Any], Any]:
+    """Maps each edge of an SFG to its weight, converted to the symbolic
+    backend type."""
+    return {(u, v): symbolic.to_backend(weight)
+            for u, v, weight in graph.edges(data='weight')}
+
+
 def determinant(graph: nx.DiGraph,
                 cycle_combinations: List[Tuple[OrderedDict, ...]],
-                path: Optional[OrderedDict] = None) -> sympy.Expr:
+                path: Optional[OrderedDict] = None,
+                weights: Optional[Dict[Tuple[Any, Any], Any]] = None) \
+        -> sympy.Expr:
     """Finds the determinant of an SFG.
 
     Finds the determinant of an SFG, considering only feedback loops not
@@ -67,10 +78,17 @@ def determinant(graph: nx.DiGraph,
         cycle_combinations: All combinations of non-touching cycles in the SFG.
         path: Optional; A simple path with which feedback loops should not
             intersect.
+        weights: Optional; The edge weights, as returned by edge_weights. If
+            given, the determinant is returned as a backend expression rather
+            than a sympy expression.
 
     Returns:
         The determinant expression.
     """
+    if weights is None:
+        return symbolic.to_sympy(determinant(graph, cycle_combinations, path,
+                                             edge_weights(graph)))
+
     path = path or OrderedDict()
     gain_products_sums = []
 
@@ -84,16 +102,16 @@ def determinant(graph: nx.DiGraph,
                 # If all cycles in this combination do not intersect the path,
                 # compute the product of loop gains.
 
-                gains = (graph.edges[u, v]['weight']
+                gains = (weights[u, v]
                          for cycle in comb
                          for u, v in pairwise_circular(cycle))
-                gain_products.append(sympy.Mul.fromiter(gains))
+                gain_products.append(symbolic.mul(gains))
 
         # Odd-sized combinations have a negative sign.
         sign = -1 if size % 2 else 1
-        gain_products_sums.append(sympy.Add.fromiter(gain_products) * sign)
+        gain_products_sums.append(symbolic.add(gain_products) * sign)
 
-    return 1 + sympy.Add.fromiter(gain_products_sums)
+    return 1 + symbolic.add(gain_products_sums)
 
 
 def transfer_function(sfg: nx.DiGraph, input_node: str, output_node: str) \
@@ -121,29 +139,27 @@ def transfer_function(sfg: nx.DiGraph, input_node: str, output_node: str) \
         cycles, key=lambda cycle: cycle.keys()))
     cycle_combinations.sort(key=len)
 
+    # Build the expressions with the symbolic backend.
+    weights = edge_weights(sfg)
+
     # Find overall determinant.
-    denom = determinant(sfg, cycle_combinations)
+    denom = determinant(sfg, cycle_combinations, weights=weights)
 
     # For each forward path, find its gain and determinant. Then, find the sum
     # of their products.
-    path_gains = (sympy.Mul.fromiter(sfg.edges[u, v]['weight']
-                                     for u, v in pairwise(path))
+    path_gains = (symbolic.mul(weights[u, v] for u, v in pairwise(path))
                   for path in paths)
-    determs = (determinant(sfg, cycle_combinations, path) for path in paths)
-    numer = sympy.Add.fromiter(
-        sympy.Mul(path_gain, determ)
+    determs = (determinant(sfg, cycle_combinations, path, weights)
+               for path in paths)
+    numer = symbolic.add(
+        path_gain * determ
         for path_gain, determ in zip(path_gains, determs)
     )
 
     # Final result
-    transfer_function = numer / denom
-    loop_gain = 1 - denom
-
-    print(cycles)
-    print(cycle_combinations)
-    print(sfg)
-    print("lg")
-    print(loop_gain)
+    transfer_function = symbolic.to_sympy(numer / denom)
+    loop_gain = symbolic.to_sympy(1 - denom)
+
     return transfer_function, loop_gain
 
 
@@ -165,13 +181,8 @@ def loop_gain(sfg: nx.DiGraph) -> sympy.Expr:
     cycle_combinations.sort(key=len)
 
     # Find overall determinant.
-    determ = determinant(sfg, cycle_combinations)
-    print(cycles)
-    print(cycle_combinations)
-    print(sfg)
-    print("lg!!")
-    loop_gain = 1 - determ
-    print(loop_gain)
+    determ = determinant(sfg, cycle_combinations, weights=edge_weights(sfg))
+    loop_gain = symbolic.to_sympy(1 - determ)
     return loop_gain
 
 
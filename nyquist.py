@@ -0,0 +1,138 @@
+from typing import Callable, Dict
+import math
+
+import numpy as np
+
+from parametric import frequency_points
+
+
+# Refine a segment if the curve turns by more than this angle, in radians,
+# across either of its end points.
+MAX_TURN = math.radians(10)
+
+# Refine a segment if it is longer than this fraction of its distance to the
+# critical point, so that the angle it subtends there is small.
+MAX_SUBTENDED = 0.2
+
+# The largest angle, in radians, between the real axis and the ends of the
+# curve as seen from the critical point, for the curve to be considered closed.
+MAX_END_ANGLE = math.radians(3)
+
+# Segments are never refined beyond this ratio of end to start frequency.
+MIN_RATIO = 1 + 1e-6
+
+
+def _evaluate(function: Callable, freq: np.ndarray) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        output = function(2j * np.pi * freq)
+    return np.broadcast_to(np.asarray(output, dtype=complex), freq.shape)
+
+
+def _segments_to_refine(freq: np.ndarray, z: np.ndarray,
+                        critical_point: complex) -> np.ndarray:
+    chords = np.diff(z)
+    lengths = np.abs(chords)
+
+    refine = np.zeros(len(chords), dtype=bool)
+
+    # Sharp turns: the angle between consecutive chords.
+    with np.errstate(invalid='ignore'):
+        turns = np.abs(np.angle(chords[1:] * np.conj(chords[:-1])))
+    sharp = turns > MAX_TURN
+    refine[:-1] |= sharp
+    refine[1:] |= sharp
+
+    # Segments passing close to the critical point.
+    distance = np.minimum(np.abs(z[:-1] - critical_point),
+                          np.abs(z[1:] - critical_point))
+    refine |= lengths > MAX_SUBTENDED * distance
+
+    # Segments which are already short, either in frequency or compared to the
+    # size of the curve, are not refined any further.
+    scale = np.max(np.abs(z[np.isfinite(z)]), initial=1.0)
+    refine &= freq[1:] / freq[:-1] > MIN_RATIO
+    refine &= lengths > 1e-9 * scale
+
+    return refine & np.isfinite(chords)
+
+
+def adaptive_response(
+    function: Callable,
+    start_freq: float,
+    end_freq: float,
+    points_per_decade: int = 10,
+    critical_point: complex = -1,
+    max_points: int = 5000
+) -> Dict[str, np.ndarray]:
+    """Evaluates a frequency response on an adaptively refined frequency grid.
+
+    Starting from a logarithmic grid, segments of the curve which turn sharply
+    or pass close to the critical point are repeatedly split in half (in log
+    frequency), until they are smooth or the maximum number of points is
+    reached. Each pass evaluates all new points in a single vectorized call.
+
+    Args:
+        function: The compiled function of s.
+        start_freq: The starting frequency, in hertz.
+        end_freq: The ending frequency, in hertz.
+        points_per_decade: The number of points per decade of the initial
+            grid.
+        critical_point: The point the curve should be resolved around.
+        max_points: The maximum number of points.
+
+    Returns:
+        A dictionary with the 'frequency' and complex 'response' arrays.
+    """
+    freq, _ = frequency_points(start_freq, end_freq, points_per_decade)
+    z = _evaluate(function, freq)
+
+    while len(freq) < max_points:
+        refine = np.flatnonzero(_segments_to_refine(freq, z, critical_point))
+        if not len(refine):
+            break
+
+        refine = refine[:max_points - len(freq)]
+        new_freq = np.sqrt(freq[refine] * freq[refine + 1])
+        new_z = _evaluate(function, new_freq)
+
+        freq = np.insert(freq, refine + 1, new_freq)
+        z = np.insert(z, refine + 1, new_z)
+
+    return {'frequency': freq, 'response': z}
+
+
+def encirclements(z: np.ndarray, critical_point: complex = -1) -> Dict:
+    """Counts the clockwise encirclements of a point by a Nyquist plot.
+
+    The response is only sampled over positive frequencies. Since the response
+    of a real system at negative frequencies is its complex conjugate, the full
+    Nyquist contour winds around the point twice as much as this half does.
+
+    Args:
+        z: The response over increasing positive frequencies.
+        critical_point: The point to count encirclements of.
+
+    Returns:
+        A dictionary with the number of clockwise 'encirclements', and whether
+        the count is 'exact', i.e. the response is finite, and is real at both
+        ends of the frequency range, so that the contour is closed.
+    """
+    w = z[np.isfinite(z)] - critical_point
+
+    if len(w) < 2:
+        return {'encirclements': 0, 'exact': False}
+
+    # The angle swept by each segment around the point.
+    swept = np.angle(w[1:] * np.conj(w[:-1])).sum()
+    winding = -swept / math.pi
+
+    # The contour is closed if both ends lie (nearly) on the real axis, so
+    # that the unsampled frequencies cannot add to the angle swept.
+    ends = np.angle(w[[0, -1]])
+    closed = bool(np.all(np.minimum(np.abs(ends), math.pi - np.abs(ends))
+                         <= MAX_END_ANGLE))
+
+    return {
+        'encirclements': int(round(winding)),
+        'exact': closed and len(w) == len(z),
+    }
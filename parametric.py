@@ -0,0 +1,285 @@
+from functools import lru_cache
+from typing import Callable, Dict, Mapping, Sequence, Tuple, Union
+import math
+
+import numpy as np
+import sympy
+
+import symbolic
+
+
+# Complex frequency symbol used by every edge expression in an SFG.
+S = sympy.Symbol('s')
+
+ArrayLike = Union[float, np.ndarray]
+
+
+class ParametricFunction:
+    """A symbolic expression compiled over 's' and its circuit parameters.
+
+    Unlike the lambda functions cached on a circuit, which have every
+    parameter substituted before compilation, a parametric function keeps
+    the parameters as arguments. The expression is compiled once and can then
+    be evaluated for any number of parameter sets in a single vectorized call.
+
+    Attributes:
+        expression: The symbolic expression.
+        parameter_names: The names of the parameters the expression depends
+            on, in the order they are passed to the compiled function.
+    """
+
+    def __init__(self, expression: sympy.Expr):
+        self.expression = expression
+        symbols = sorted(
+            (symbol for symbol in expression.free_symbols if symbol != S),
+            key=lambda symbol: symbol.name
+        )
+        self.parameter_names = tuple(symbol.name for symbol in symbols)
+        self._function = sympy.lambdify([S, *symbols], expression, 'numpy',
+                                        cse=True)
+
+    def __call__(self, s: np.ndarray, parameters: Mapping[str, ArrayLike]) \
+            -> np.ndarray:
+        """Evaluates the expression.
+
+        Args:
+            s: A 1-D array of complex frequencies.
+            parameters: A mapping of parameter names to numerical values.
+                Values may be scalars, or 1-D arrays of equal length to
+                evaluate a batch of parameter sets at once.
+
+        Returns:
+            A complex array of shape (len(s),) if every parameter is a scalar,
+            or (batch_size, len(s)) otherwise.
+        """
+        s = np.asarray(s)
+        batch_size = batch_length(parameters)
+
+        args = []
+        for name in self.parameter_names:
+            if name not in parameters:
+                raise ValueError(f'Missing value for parameter {name}.')
+            value = np.asarray(parameters[name], dtype=float)
+            args.append(value.reshape(-1, 1) if value.ndim else value)
+
+        if batch_size is None:
+            shape = s.shape
+        else:
+            shape = (batch_size, len(s))
+            s = s[np.newaxis, :]
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            output = self._function(s, *args)
+
+        # Constant expressions compile to functions returning scalars, so
+        # the output must be broadcast to the expected shape.
+        return np.broadcast_to(np.asarray(output, dtype=complex), shape)
+
+
+class ParametricVector:
+    """A list of symbolic expressions compiled over 's' and their circuit
+    parameters into a single function, which evaluates all of them at once
+    and shares their common subexpressions.
+
+    Attributes:
+        expressions: The symbolic expressions.
+        parameter_names: The names of the parameters the expressions depend
+            on, in the order they are passed to the compiled function.
+    """
+
+    def __init__(self, expressions: Sequence[sympy.Expr]):
+        self.expressions = [sympy.sympify(expression)
+                            for expression in expressions]
+        symbols = sorted(
+            {symbol for expression in self.expressions
+             for symbol in expression.free_symbols if symbol != S},
+            key=lambda symbol: symbol.name
+        )
+        self.parameter_names = tuple(symbol.name for symbol in symbols)
+        self._function = sympy.lambdify([S, *symbols], self.expressions,
+                                        'numpy', cse=True)
+
+    def __call__(self, s: np.ndarray, parameters: Mapping[str, float]) \
+            -> np.ndarray:
+        """Evaluates the expressions.
+
+        Args:
+            s: A 1-D array of complex frequencies.
+            parameters: A mapping of parameter names to scalar values.
+
+        Returns:
+            A complex array of shape (len(expressions), len(s)).
+        """
+        s = np.asarray(s)
+
+        args = []
+        for name in self.parameter_names:
+            if name not in parameters:
+                raise ValueError(f'Missing value for parameter {name}.')
+            args.append(float(parameters[name]))
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            output = self._function(s, *args)
+
+        return np.array([np.broadcast_to(np.asarray(row, dtype=complex), s.shape)
+                         for row in output]).reshape(len(output), len(s))
+
+
+class SensitivityFunction:
+    """The normalized sensitivities of an expression to its parameters.
+
+    The normalized sensitivity of H to a parameter p is
+    (p / H) * dH/dp = d(ln H) / d(ln p). Its real part is the sensitivity of
+    ln|H|, and its imaginary part is the sensitivity of the phase of H, in
+    radians. Each derivative is taken symbolically once, and all of them are
+    compiled into a single function which shares common subexpressions.
+
+    Attributes:
+        expression: The symbolic expression.
+        parameter_names: The names of the parameters the expression depends
+            on, in the order of the sensitivities returned.
+    """
+
+    def __init__(self, expression: sympy.Expr):
+        self.expression = expression
+        symbols = sorted(
+            (symbol for symbol in expression.free_symbols if symbol != S),
+            key=lambda symbol: symbol.name
+        )
+        self.parameter_names = tuple(symbol.name for symbol in symbols)
+
+        sensitivities = [symbol * symbolic.diff(expression, symbol) / expression
+                         for symbol in symbols]
+        self._function = sympy.lambdify([S, *symbols], sensitivities, 'numpy',
+                                        cse=True)
+
+    def __call__(self, s: np.ndarray, parameters: Mapping[str, float]) \
+            -> np.ndarray:
+        """Evaluates the sensitivities.
+
+        Args:
+            s: A 1-D array of complex frequencies.
+            parameters: A mapping of parameter names to scalar values.
+
+        Returns:
+            A complex array of shape (len(parameter_names), len(s)).
+        """
+        s = np.asarray(s)
+
+        args = []
+        for name in self.parameter_names:
+            if name not in parameters:
+                raise ValueError(f'Missing value for parameter {name}.')
+            args.append(float(parameters[name]))
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            output = self._function(s, *args)
+
+        return np.array([np.broadcast_to(np.asarray(row, dtype=complex), s.shape)
+                         for row in output]).reshape(len(args), len(s))
+
+
+@lru_cache(maxsize=128)
+def compile_expression(expression: sympy.Expr) -> ParametricFunction:
+    """Compiles an expression into a parametric function, re-using previously
+    compiled functions for identical expressions."""
+    return ParametricFunction(expression)
+
+
+@lru_cache(maxsize=8)
+def compile_sensitivities(expression: sympy.Expr) -> SensitivityFunction:
+    """Compiles the sensitivities of an expression, re-using previously
+    compiled functions for identical expressions."""
+    return SensitivityFunction(expression)
+
+
+def batch_length(parameters: Mapping[str, ArrayLike]) -> Union[int, None]:
+    """Returns the batch size of a set of parameter values, or None if every
+    value is a scalar."""
+    lengths = {np.size(value) for value in parameters.values()
+               if np.ndim(value)}
+
+    if not lengths:
+        return None
+    if len(lengths) > 1:
+        raise ValueError('Parameter arrays must have equal lengths.')
+
+    return lengths.pop()
+
+
+def frequency_points(
+    start_freq: float,
+    end_freq: float,
+    points_per_decade: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Generates logarithmically spaced frequency points.
+
+    Args:
+        start_freq: The starting frequency, in hertz.
+        end_freq: The ending frequency, in hertz.
+        points_per_decade: The number of points per decade.
+
+    Returns:
+        A (frequency, s) tuple of arrays.
+    """
+    if start_freq <= 0 or end_freq <= start_freq:
+        raise ValueError('Invalid frequency range.')
+
+    num_decades = math.log10(end_freq / start_freq)
+    num_points = max(2, round(points_per_decade * num_decades))
+    freq = np.logspace(math.log10(start_freq), math.log10(end_freq),
+                       num_points)
+
+    return freq, 2j * np.pi * freq
+
+
+def gain_db(response: np.ndarray) -> np.ndarray:
+    """Returns the gain of a complex response in decibels."""
+    with np.errstate(divide='ignore'):
+        return 20 * np.log10(np.abs(response))
+
+
+def phase_margin(freq: np.ndarray, response: np.ndarray) -> np.ndarray:
+    """Computes the phase margin along the last axis of a response.
+
+    Like Circuit.compute_phase_margin, the phase margin is taken at the point
+    whose gain is closest to 0 dB.
+    """
+    gain = gain_db(response)
+    phase = np.angle(response, deg=True)
+
+    index = np.argmin(np.abs(gain), axis=-1)[..., np.newaxis]
+    return 180 - np.abs(np.take_along_axis(phase, index, axis=-1)[..., 0])
+
+
+def bandwidth(freq: np.ndarray, response: np.ndarray) -> np.ndarray:
+    """Computes the bandwidth along the last axis of a response.
+
+    Like Circuit.calculate_bandwidth, the bandwidth is the frequency after the
+    gain peak whose gain is closest to 3 dB below the peak. It is NaN if the
+    peak is at the last frequency point.
+    """
+    gain = gain_db(response)
+    peak = np.argmax(gain, axis=-1)[..., np.newaxis]
+    threshold = np.take_along_axis(gain, peak, axis=-1) - 3
+
+    # Only consider points after the peak.
+    positions = np.arange(gain.shape[-1])
+    distance = np.where(positions > peak, np.abs(gain - threshold), np.inf)
+
+    result = freq[np.argmin(distance, axis=-1)]
+    return np.where(peak[..., 0] == gain.shape[-1] - 1, np.nan, result)
+
+
+def dc_gain(freq: np.ndarray, response: np.ndarray) -> np.ndarray:
+    """Returns the gain, in decibels, at the lowest frequency point."""
+    return gain_db(response[..., 0])
+
+
+# Maps metric names to functions of (frequency, response) that reduce the last
+# axis of the response.
+METRICS: Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    'phase_margin': phase_margin,
+    'bandwidth': bandwidth,
+    'dc_gain': dc_gain,
+}
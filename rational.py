@@ -0,0 +1,260 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+class PoleResidueModel:
+    """A rational function in pole-residue form,
+
+        H(s) = direct + sum(residues[k] / (s - poles[k])).
+
+    Poles and residues are complex, and come in conjugate pairs so that the
+    function is real for real s. Evaluating the model costs a handful of
+    operations per pole and frequency point, regardless of the size of the
+    symbolic expression it approximates.
+
+    Attributes:
+        poles: The poles.
+        residues: The residues of each pole.
+        direct: The constant term, i.e. the value as s tends to infinity.
+        error: The maximum relative error of the fit over its samples.
+    """
+
+    def __init__(self, poles: np.ndarray, residues: np.ndarray, direct: float,
+                 error: float = 0.0):
+        self.poles = np.asarray(poles, dtype=complex)
+        self.residues = np.asarray(residues, dtype=complex)
+        self.direct = float(direct)
+        self.error = float(error)
+
+    @property
+    def order(self) -> int:
+        return len(self.poles)
+
+    def __call__(self, s: np.ndarray) -> np.ndarray:
+        s = np.asarray(s)
+        terms = self.residues[:, np.newaxis] / \
+            (s[np.newaxis, :] - self.poles[:, np.newaxis])
+        return self.direct + terms.sum(axis=0)
+
+    def impulse(self, t: np.ndarray) -> np.ndarray:
+        """Evaluates the impulse response at times t >= 0, excluding the
+        impulse of weight direct at t = 0."""
+        t = np.asarray(t, dtype=float)
+        with np.errstate(over='ignore', invalid='ignore'):
+            terms = self.residues[:, np.newaxis] * \
+                np.exp(self.poles[:, np.newaxis] * t[np.newaxis, :])
+        return terms.sum(axis=0).real
+
+    def step(self, t: np.ndarray) -> np.ndarray:
+        """Evaluates the unit step response at times t >= 0."""
+        t = np.asarray(t, dtype=float)
+        poles = self.poles[:, np.newaxis]
+        residues = self.residues[:, np.newaxis]
+
+        # Integral of the impulse response. A pole at the origin integrates
+        # to a ramp instead.
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            terms = np.where(
+                poles == 0,
+                residues * t,
+                residues / poles * np.expm1(poles * t)
+            )
+        return self.direct + terms.sum(axis=0).real
+
+    def time_constant(self) -> float:
+        """Returns the time constant of the slowest pole, or of the fastest
+        one if every pole is on the imaginary axis.
+
+        If there are right half-plane poles, returns the time constant of the
+        fastest of them instead, over which the response grows by a factor
+        of e: the response of the slower poles is negligible by comparison,
+        and overflows long before they have settled.
+        """
+        growth = self.poles.real[self.poles.real > 0]
+        if len(growth):
+            return 1 / growth.max()
+
+        rates = np.abs(self.poles.real)
+        rates = rates[rates > 0]
+        if len(rates):
+            return 1 / rates.min()
+
+        frequencies = np.abs(self.poles)
+        frequencies = frequencies[frequencies > 0]
+        return 1 / frequencies.max() if len(frequencies) else 1.0
+
+    def to_dict(self) -> Dict:
+        return {
+            'order': self.order,
+            'poles': [[p.real, p.imag] for p in self.poles.tolist()],
+            'residues': [[r.real, r.imag] for r in self.residues.tolist()],
+            'direct': self.direct,
+            'error': self.error,
+        }
+
+
+def _split_poles(poles: np.ndarray) -> List[complex]:
+    """Keeps real poles, and one representative (with a positive imaginary
+    part) of each complex conjugate pair."""
+    scale = np.maximum(np.abs(poles), 1e-300)
+    real = np.abs(poles.imag) <= 1e-9 * scale
+    return [complex(p.real, 0) for p in poles[real]] + \
+        [complex(p) for p in poles[~real] if p.imag > 0]
+
+
+def _basis(s: np.ndarray, poles: List[complex]) -> np.ndarray:
+    # Real-valued partial fraction basis: one column per real pole, and two
+    # per complex pair, so that all fitted coefficients are real.
+    columns = []
+    for a in poles:
+        if a.imag == 0:
+            columns.append(1 / (s - a.real))
+        else:
+            columns.append(1 / (s - a) + 1 / (s - a.conjugate()))
+            columns.append(1j / (s - a) - 1j / (s - a.conjugate()))
+    return np.column_stack(columns)
+
+
+def _least_squares(matrix: np.ndarray, rhs: np.ndarray) -> np.ndarray:
+    # Solves a complex least-squares problem for real unknowns, with column
+    # scaling to keep the (widely ranging) partial fraction columns
+    # well-conditioned.
+    matrix = np.concatenate((matrix.real, matrix.imag))
+    rhs = np.concatenate((rhs.real, rhs.imag))
+
+    norms = np.linalg.norm(matrix, axis=0)
+    norms[norms == 0] = 1
+
+    solution, *_ = np.linalg.lstsq(matrix / norms, rhs, rcond=None)
+    return solution / norms
+
+
+def _relocate(poles: List[complex], coefficients: np.ndarray) -> List[complex]:
+    # The zeros of the weighting function sigma(s) become the new poles.
+    n = len(coefficients)
+    A = np.zeros((n, n))
+    b = np.zeros(n)
+
+    i = 0
+    for a in poles:
+        if a.imag == 0:
+            A[i, i] = a.real
+            b[i] = 1
+            i += 1
+        else:
+            A[i:i + 2, i:i + 2] = [[a.real, a.imag], [-a.imag, a.real]]
+            b[i] = 2
+            i += 2
+
+    # Unlike the usual formulation of vector fitting, unstable poles are not
+    # flipped into the left half-plane, since the exact transfer function of
+    # an SFG may well have right half-plane poles.
+    zeros = np.linalg.eigvals(A - np.outer(b, coefficients))
+    return _split_poles(zeros)
+
+
+def _initial_poles(s: np.ndarray, order: int) -> List[complex]:
+    omega = np.abs(s.imag)
+    low, high = omega.min(), omega.max()
+
+    pairs = np.geomspace(low, high, order // 2) if order > 1 else []
+    poles = [complex(-beta / 100, beta) for beta in pairs]
+    if order % 2:
+        poles.insert(0, complex(-np.sqrt(low * high), 0))
+
+    return poles
+
+
+def _fit_residues(s: np.ndarray, response: np.ndarray,
+                  weights: np.ndarray, poles: List[complex]) \
+        -> Tuple[np.ndarray, np.ndarray, float]:
+    phi = _basis(s, poles)
+    matrix = np.column_stack((phi, np.ones(len(s)))) * weights[:, np.newaxis]
+    solution = _least_squares(matrix, response * weights)
+
+    all_poles, residues = [], []
+    i = 0
+    for a in poles:
+        if a.imag == 0:
+            all_poles.append(a)
+            residues.append(solution[i])
+            i += 1
+        else:
+            residue = complex(solution[i], solution[i + 1])
+            all_poles += [a, a.conjugate()]
+            residues += [residue, residue.conjugate()]
+            i += 2
+
+    return np.array(all_poles), np.array(residues), solution[-1]
+
+
+def vector_fit(s: np.ndarray, response: np.ndarray, order: int,
+               iterations: int = 10) -> PoleResidueModel:
+    """Fits a rational function of a given order to a sampled frequency
+    response, using vector fitting.
+
+    Args:
+        s: The complex frequencies of the samples, on the imaginary axis.
+        response: The sampled complex response.
+        order: The number of poles.
+        iterations: The number of pole relocation iterations.
+
+    Returns:
+        The fitted model.
+    """
+    s = np.asarray(s, dtype=complex)
+    response = np.asarray(response, dtype=complex)
+
+    # Weight samples by their inverse magnitude, so that the relative error
+    # (i.e. the error in decibels and degrees) is minimized.
+    magnitude = np.abs(response)
+    weights = 1 / np.maximum(magnitude, 1e-12 * magnitude.max())
+
+    poles = _initial_poles(s, order)
+
+    for _ in range(iterations):
+        phi = _basis(s, poles)
+        matrix = np.column_stack((
+            phi, np.ones(len(s)), -response[:, np.newaxis] * phi
+        )) * weights[:, np.newaxis]
+        solution = _least_squares(matrix, response * weights)
+
+        poles = _relocate(poles, solution[phi.shape[1] + 1:])
+
+    poles, residues, direct = _fit_residues(s, response, weights, poles)
+    model = PoleResidueModel(poles, residues, direct)
+    model.error = float(np.max(np.abs(model(s) - response) * weights))
+
+    return model
+
+
+def reduce_order(s: np.ndarray, response: np.ndarray,
+                 tolerance: float = 1e-3, max_order: int = 20) \
+        -> PoleResidueModel:
+    """Finds the lowest-order rational approximation of a sampled frequency
+    response within an error bound.
+
+    Args:
+        s: The complex frequencies of the samples, on the imaginary axis.
+        response: The sampled complex response.
+        tolerance: The maximum relative error of the approximation.
+        max_order: The maximum number of poles.
+
+    Returns:
+        The first model meeting the tolerance, or the most accurate model
+        found if none does.
+    """
+    if not np.all(np.isfinite(response)):
+        raise ValueError('The response is not finite over the frequency range.')
+
+    best = None
+    for order in range(1, max_order + 1):
+        model = vector_fit(s, response, order)
+
+        if best is None or model.error < best.error:
+            best = model
+        if model.error <= tolerance:
+            break
+
+    return best
@@ -0,0 +1,218 @@
+"""Bounded-time rendering of large symbolic expressions.
+
+Factoring a transfer function of a large circuit can take minutes, which would
+block the worker serving the request. Expressions are instead simplified in a
+separate process, which first computes a cheap canonical form, and then the
+factored form. A request waits for the factored form up to a time budget, and
+otherwise returns the best form ready by then (or the unsimplified expression).
+The worker process keeps running in the background, and its results are cached
+for the next request.
+"""
+from threading import Condition, Lock, Thread
+from typing import Set, Tuple
+import multiprocessing
+import time
+
+import sympy
+
+from cache import LRUCache
+
+
+S = sympy.Symbol('s')
+
+# Simplifications, from the cheapest to the most preferred. Each one is
+# computed in turn and supersedes the last.
+STRATEGIES = ('collect', 'factor')
+
+# The number of seconds a request waits for the factored form.
+BUDGET = 2.0
+
+# Simplifications still running after this many seconds are abandoned.
+BACKGROUND_LIMIT = 120.0
+
+# The maximum number of worker processes running at once. Past this, requests
+# fall back to the unsimplified expression until some finish.
+MAX_JOBS = 4
+
+# The context worker processes are started from. See process_context.
+_context = None
+_context_lock = Lock()
+
+# Maps (expression, latex) to the best (text, complete) form so far.
+_rendered = LRUCache(maxsize=128)
+_jobs: Set[Tuple] = set()
+_condition = Condition()
+
+
+def _format(expression: sympy.Expr, latex: bool) -> str:
+    return sympy.latex(expression) if latex else str(expression)
+
+
+def simplify(expression: sympy.Expr, strategy: str) -> sympy.Expr:
+    """Simplifies an expression.
+
+    Args:
+        expression: The expression.
+        strategy: 'factor' to factor the expression, 'cancel' to reduce it to
+            a single fraction of expanded polynomials without common factors,
+            or 'collect' to write it as a single fraction with the numerator
+            and denominator collected in powers of s.
+
+    Returns:
+        The simplified expression.
+    """
+    if strategy == 'factor':
+        return expression.factor()
+    if strategy == 'cancel':
+        return sympy.cancel(expression)
+    if strategy == 'collect':
+        numerator, denominator = sympy.fraction(sympy.together(expression))
+        return sympy.collect(sympy.expand(numerator), S) / \
+            sympy.collect(sympy.expand(denominator), S)
+
+    raise ValueError('Invalid strategy.')
+
+
+def _run(connection, expression: sympy.Expr, latex: bool):
+    # Runs in a worker process. Only the (much smaller) formatted strings are
+    # sent back.
+    for strategy in STRATEGIES:
+        connection.send(_format(simplify(expression, strategy), latex))
+    connection.close()
+
+
+def process_context() -> multiprocessing.context.BaseContext:
+    """Returns the context which worker processes of the server (e.g. those
+    of background renders) are started from.
+
+    Worker processes are forked from a server process with sympy already
+    imported, rather than from the (threaded) web server itself. Where
+    forkserver is not available (e.g. on Windows), they are spawned. The
+    context is only created when first needed, so that importing this module
+    starts nothing.
+    """
+    global _context
+    with _context_lock:
+        if _context is None:
+            try:
+                context = multiprocessing.get_context('forkserver')
+            except ValueError:
+                context = multiprocessing.get_context('spawn')
+            else:
+                context.set_forkserver_preload([__name__])
+            _context = context
+
+        return _context
+
+
+def _supervise(key: Tuple):
+    context = process_context()
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run, args=(sender, *key), daemon=True)
+    process.start()
+    sender.close()
+
+    deadline = time.monotonic() + BACKGROUND_LIMIT
+
+    try:
+        for i in range(len(STRATEGIES)):
+            if not receiver.poll(max(deadline - time.monotonic(), 0)):
+                break
+
+            text = receiver.recv()
+            with _condition:
+                _rendered.put(key, (text, i == len(STRATEGIES) - 1))
+                _condition.notify_all()
+    except (EOFError, OSError):
+        pass
+    finally:
+        # sympy cannot be interrupted from another thread, so the process is
+        # terminated instead.
+        process.terminate()
+        process.join()
+        receiver.close()
+
+        with _condition:
+            _jobs.discard(key)
+            _condition.notify_all()
+
+
+def render(expression: sympy.Expr, factor: bool = True, latex: bool = True,
+           budget: float = BUDGET) -> Tuple[str, bool]:
+    """Formats an expression, simplifying it within a time budget.
+
+    Args:
+        expression: The expression.
+        factor: If True, the expression is factored, or, failing that, put in
+            a simpler form. If False, it is formatted as is.
+        latex: If True, formats the expression in latex. If False, returns
+            the expression in plain text.
+        budget: The number of seconds to wait for the factored form.
+
+    Returns:
+        A (text, complete) tuple, where complete is False if the factored form
+        was not ready, and the text is a cheaper form of the expression.
+    """
+    if not factor:
+        return _format(expression, latex), True
+
+    key = (expression, latex)
+    deadline = time.monotonic() + budget
+
+    with _condition:
+        rendered = _rendered.get(key)
+
+        if rendered is None and key not in _jobs and len(_jobs) < MAX_JOBS:
+            _jobs.add(key)
+            Thread(target=_supervise, args=(key,), daemon=True).start()
+
+        while not (rendered and rendered[1]):
+            remaining = deadline - time.monotonic()
+            if key not in _jobs or remaining <= 0:
+                break
+
+            _condition.wait(remaining)
+            rendered = _rendered.get(key)
+
+    return rendered or (_format(expression, latex), False)
+
+
+def preview(expression: sympy.Expr, max_terms: int = 8,
+            latex: bool = True) -> Tuple[str, int]:
+    """Formats a truncated form of an expression, keeping the leading terms of
+    its numerator and denominator.
+
+    Args:
+        expression: The expression.
+        max_terms: The number of terms to keep in the numerator and in the
+            denominator.
+        latex: If True, formats the expression in latex. If False, returns
+            the expression in plain text.
+
+    Returns:
+        A (text, terms) tuple, where terms is the total number of terms in the
+        numerator and denominator.
+    """
+    numerator, denominator = sympy.fraction(expression)
+
+    parts = []
+    terms = 0
+    for part in (numerator, denominator):
+        args = sympy.Add.make_args(part)
+        terms += len(args)
+
+        text = ' + '.join(_format(arg, latex) for arg in args[:max_terms])
+        if len(args) > max_terms:
+            more = len(args) - max_terms
+            if latex:
+                text += r' + \ldots \text{(%d more terms)}' % more
+            else:
+                text += f' + ... ({more} more terms)'
+        parts.append(text)
+
+    if denominator == 1:
+        return parts[0], terms - 1
+
+    if latex:
+        return r'\frac{%s}{%s}' % tuple(parts), terms
+    return '(%s)/(%s)' % tuple(parts), terms
@@ -21,6 +21,20 @@ app = Flask(__name__, static_folder="frontend/dist", static_url_path="/")
 # app.config['DEBUG'] = False
 CORS(app)
 
+# The document fields read by each kind of endpoint. Circuits are loaded with
+# only these fields (see db.Circuit.load); any other field is fetched from the
+# database if it turns out to be needed.
+SFG_FIELDS = ("parameters", "sfg")
+CIRCUIT_FIELDS = ("name",) + SFG_FIELDS
+EDIT_FIELDS = CIRCUIT_FIELDS + ("history", "undone")
+RESET_FIELDS = CIRCUIT_FIELDS + ("original_sfg", "original_parameters")
+TRANSFER_FUNCTION_FIELDS = SFG_FIELDS + ("transfer_functions",)
+LOOP_GAIN_FIELDS = SFG_FIELDS + ("loop_gain",)
+# Parameter sweeps change the parameters, which clears both caches.
+SWEEP_FIELDS = TRANSFER_FUNCTION_FIELDS + ("loop_gain",)
+DEVICE_FIELDS = ("parameters",)
+BRANCH_FIELDS = SFG_FIELDS + ("original_sfg", "branches")
+
 
 @app.route("/favicon.ico")
 def favicon():
@@ -44,7 +58,7 @@ def serve_webpage(path):
 
 @app.route("/circuits/<circuit_id>", methods=["GET"])
 def get_circuit(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *CIRCUIT_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -82,7 +96,7 @@ def create_circuit():
 
 @app.route("/circuits/<circuit_id>/reset", methods=["POST"])
 def reset_circuit(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *RESET_FIELDS)
     if not circuit:
         abort(404, description="Circuit not found")
 
@@ -91,13 +105,15 @@ def reset_circuit(circuit_id):
         circuit.save()
         fields = request.args.get("fields", type=lambda s: s and s.split(",") or None)
         return circuit.to_dict(fields)
+    except db.ConflictError as e:
+        abort(409, description=str(e))
     except Exception as e:
         abort(400, description=str(e))
 
 
 @app.route("/circuits/<circuit_id>", methods=["PATCH"])
 def patch_circuit(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *CIRCUIT_FIELDS)
     if not circuit:
         abort(404, description="Circuit not found")
 
@@ -118,7 +134,7 @@ def patch_circuit(circuit_id):
 
 @app.route("/circuits/<circuit_id>/update_edge", methods=["PATCH"])
 def update_edge(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS)
     if not circuit:
         abort(404, description="Circuit not found")
 
@@ -134,13 +150,15 @@ def update_edge(circuit_id):
 
         return circuit.to_dict(fields)
 
+    except db.ConflictError as e:
+        abort(409, description=str(e))
     except Exception as e:
         abort(400, description=str(e))
 
 
 @app.route("/circuits/<circuit_id>/update_edge_new", methods=["PATCH"])
 def update_edge_new(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS)
     if not circuit:
         abort(404, description="Circuit not found")
 
@@ -202,6 +220,8 @@ def update_edge_new(circuit_id):
         print(circuit_dict)
         return circuit_dict
 
+    except db.ConflictError as e:
+        abort(409, description=str(e))
     except Exception as e:
         abort(400, description=str(e))
 
@@ -210,7 +230,7 @@ def update_edge_new(circuit_id):
 # url for the server route, matching method
 @app.route("/circuits/<circuit_id>/remove_branch", methods=["PATCH"])
 def remove_branch(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -236,6 +256,8 @@ def remove_branch(circuit_id):
         # return jsonify(response), 200
         return circuit.to_dict(fields)
 
+    except db.ConflictError as e:
+        abort(409, description=str(e))
     except Exception as e:
         abort(status=400, text=str(e))
 
@@ -244,54 +266,20 @@ def remove_branch(circuit_id):
 # GET method must not have body but extracts information from the URL
 def get_edge_info(circuit_id):
     try:
-        print("trying get_edge_info server side")
-        circuit = db.Circuit.objects(id=circuit_id).first()
+        circuit = db.Circuit.load(circuit_id, *SFG_FIELDS)
         if not circuit:
             return jsonify(error="Circuit not found"), 404
         # GET method needs "request/args/get()" rather than "request/json/get()" used in PATCH
         source = request.args.get("source")
         target = request.args.get("target")
-        print("got source and target")
-        print("source: " + str(source))
-        print("target: " + str(target))
 
         if not source or not target:
-            print("source or target not provided")
             return jsonify(error="Source and target nodes must be provided"), 400
 
-        fields = request.args.get("fields", type=lambda s: s and s.split(",") or None)
-
-        print("fields: " + str(fields))
-        print(circuit.to_dict(fields))
-
-        
-        circuit_data = circuit.to_dict(fields)
-
-        # Extracting the list of edges
-        edges = circuit_data["sfg"]["elements"]["edges"]
-
-        # Iterate over the edges to extract the desired information
-        for edge in edges:
-            weight = edge["data"]["weight"]
-            symbolic = weight["symbolic"]
-            magnitude = weight["magnitude"]
-            phase = weight["phase"]
-
-            print(f"Edge from {edge['data']['source']} to {edge['data']['target']}:")
-            print(f"  Symbolic: {symbolic}")
-            print(f"  Magnitude: {magnitude}")
-            print(f"  Phase: {phase}")
-
-        # Find the edge with the matching source and target
-        selected_edge = None
-        for e in edges:
-            if e["data"]["source"] == source and e["data"]["target"] == target:
-                selected_edge = e
-                print("selected_edge: " + str(selected_edge))
-                break
-
-        if not selected_edge:
-            print("edge not found")
+        # Only the selected edge is evaluated.
+        try:
+            selected_edge, = circuit.evaluate_edges([(source, target)])
+        except LookupError:
             return jsonify(error="Edge not found"), 404
 
         response = jsonify(selected_edge)
@@ -303,9 +291,216 @@ def get_edge_info(circuit_id):
     except Exception as e:
         return jsonify(error=str(e)), 400
 
+
+@app.route("/circuits/<circuit_id>/edges", methods=["GET"])
+def get_edges(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *SFG_FIELDS)
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    sources = request.args.getlist("source")
+    targets = request.args.getlist("target")
+    node = request.args.get("node")
+
+    if len(sources) != len(targets):
+        abort(400, description="Each source must be paired with a target")
+
+    try:
+        edges = circuit.evaluate_edges(
+            list(zip(sources, targets)) or None, node=node
+        )
+
+    except LookupError as e:
+        abort(404, description=str(e))
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify({"edges": edges})
+
+
+@app.route("/circuits/<circuit_id>/edges/table", methods=["GET"])
+def get_edge_table(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *SFG_FIELDS)
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    start_freq = request.args.get("start_freq_hz", type=float)
+    end_freq = request.args.get("end_freq_hz", type=float)
+    points_per_decade = request.args.get("points_per_decade", default=10, type=int)
+
+    try:
+        table = circuit.eval_edge_table(start_freq, end_freq, points_per_decade)
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify(table)
+
+
+@app.route("/circuits/<circuit_id>/branches", methods=["GET"])
+def get_branches(circuit_id):
+    circuit = db.Circuit.load(circuit_id, "branches")
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    return jsonify({"branches": circuit.list_branches()})
+
+
+@app.route("/circuits/<circuit_id>/branches", methods=["POST"])
+def create_branch(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *BRANCH_FIELDS)
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    name = request.json.get("name")
+    parent = request.json.get("parent", db.MAIN_BRANCH)
+
+    try:
+        circuit.fork_branch(name, parent)
+        circuit.save()
+
+    except LookupError as e:
+        abort(404, description=str(e))
+
+    except db.ConflictError as e:
+        abort(409, description=str(e))
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify({"branches": circuit.list_branches()})
+
+
+@app.route("/circuits/<circuit_id>/branches/<name>", methods=["DELETE"])
+def delete_branch(circuit_id, name):
+    circuit = db.Circuit.load(circuit_id, "branches")
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    try:
+        circuit.delete_branch(name)
+        circuit.save()
+
+    except LookupError as e:
+        abort(404, description=str(e))
+
+    return jsonify({"branches": circuit.list_branches()})
+
+
+@app.route("/circuits/<circuit_id>/branches/<name>/checkout", methods=["POST"])
+def checkout_branch(circuit_id, name):
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS, "original_sfg", "branches")
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    try:
+        circuit.checkout_branch(name)
+        circuit.save()
+        fields = request.args.get("fields", type=lambda s: s and s.split(",") or None)
+
+        return circuit.to_dict(fields)
+
+    except LookupError as e:
+        abort(404, description=str(e))
+
+    except db.ConflictError as e:
+        abort(409, description=str(e))
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+
+@app.route("/circuits/<circuit_id>/branches/transfer_function", methods=["GET"])
+def get_branch_transfer_functions(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *BRANCH_FIELDS, "transfer_functions")
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    names = request.args.get("branches", default=db.MAIN_BRANCH).split(",")
+    input_node = request.args.get("input_node")
+    output_node = request.args.get("output_node")
+    latex = request.args.get("latex", default=True, type=lambda s: bool(strtobool(s)))
+    factor = request.args.get("factor", default=True, type=lambda s: bool(strtobool(s)))
+    numerical = request.args.get(
+        "numerical", default=False, type=lambda s: bool(strtobool(s))
+    )
+    preview_terms = request.args.get("preview_terms", type=int)
+
+    try:
+        # Branches with the same SFG share their cached transfer function.
+        transfer_functions = {
+            name: circuit.branch(name).render_transfer_function(
+                input_node,
+                output_node,
+                latex=latex,
+                factor=factor,
+                numerical=numerical,
+                preview_terms=preview_terms,
+            )
+            for name in names
+        }
+
+    except LookupError as e:
+        abort(404, description=str(e))
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify({"branches": transfer_functions})
+
+
+@app.route("/circuits/<circuit_id>/branches/transfer_function/bode", methods=["GET"])
+def get_branch_bode(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *BRANCH_FIELDS, "transfer_functions")
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    names = request.args.get("branches", default=db.MAIN_BRANCH).split(",")
+    input_node = request.args.get("input_node")
+    output_node = request.args.get("output_node")
+    start_freq = request.args.get("start_freq_hz", type=float)
+    end_freq = request.args.get("end_freq_hz", type=float)
+    points_per_decade = request.args.get("points_per_decade", type=int)
+    frequency_unit = request.args.get("frequency_unit", default="hz")
+    gain_unit = request.args.get("gain_unit", default="db")
+    phase_unit = request.args.get("phase_unit", default="deg")
+
+    try:
+        responses = {}
+        for name in names:
+            freq, gain, phase = circuit.branch(name).eval_transfer_function(
+                input_node,
+                output_node,
+                start_freq,
+                end_freq,
+                points_per_decade,
+                frequency_unit,
+                gain_unit,
+                phase_unit,
+            )
+            responses[name] = {"frequency": freq, "gain": gain, "phase": phase}
+
+    except LookupError as e:
+        abort(404, description=str(e))
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify({"branches": responses})
+
+
 @app.route("/circuits/<circuit_id>/transfer_function", methods=["GET"])
 def get_transfer_function(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *TRANSFER_FUNCTION_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -317,14 +512,16 @@ def get_transfer_function(circuit_id):
     numerical = request.args.get(
         "numerical", default=False, type=lambda s: bool(strtobool(s))
     )
+    preview_terms = request.args.get("preview_terms", type=int)
 
     try:
-        transfer_function = circuit.compute_transfer_function(
+        transfer_function = circuit.render_transfer_function(
             input_node,
             output_node,
             latex=latex,
             factor=factor,
             numerical=numerical,
+            preview_terms=preview_terms,
             cache_result=False,
         )
 
@@ -334,7 +531,7 @@ def get_transfer_function(circuit_id):
     circuit.save()
 
     # Return the loop gain as a JSON response with appropriate Cache-Control header
-    response = jsonify({"transfer_function": transfer_function})
+    response = jsonify(transfer_function)
 
     # Disable caching for the response
     response.headers["Cache-Control"] = (
@@ -356,7 +553,7 @@ def get_transfer_function(circuit_id):
 
 @app.route("/circuits/<circuit_id>/transfer_function/bode", methods=["GET"])
 def get_transfer_function_bode(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *TRANSFER_FUNCTION_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -369,6 +566,7 @@ def get_transfer_function_bode(circuit_id):
     frequency_unit = request.args.get("frequency_unit", default="hz")
     gain_unit = request.args.get("gain_unit", default="db")
     phase_unit = request.args.get("phase_unit", default="deg")
+    reduced = request.args.get("reduced", default=False, type=lambda s: bool(strtobool(s)))
 
     try:
         freq, gain, phase = circuit.eval_transfer_function(
@@ -381,6 +579,7 @@ def get_transfer_function_bode(circuit_id):
             gain_unit,
             phase_unit,
             cache_result=False,
+            reduced=reduced,
         )
 
     except Exception as e:
@@ -404,9 +603,123 @@ def get_transfer_function_bode(circuit_id):
     return response
 
 
+@app.route("/circuits/<circuit_id>/transfer_function/reduced", methods=["GET"])
+def get_transfer_function_reduced(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *SFG_FIELDS)
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    input_node = request.args.get("input_node")
+    output_node = request.args.get("output_node")
+    options = {
+        "tolerance": request.args.get("tolerance", type=float),
+        "max_order": request.args.get("max_order", type=int),
+        "start_freq": request.args.get("start_freq_hz", type=float),
+        "end_freq": request.args.get("end_freq_hz", type=float),
+        "points_per_decade": request.args.get("points_per_decade", type=int),
+    }
+
+    try:
+        model = circuit.reduced_transfer_function(
+            input_node,
+            output_node,
+            **{k: v for k, v in options.items() if v is not None}
+        )
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    response = jsonify(model.to_dict())
+
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Pragma"] = "no-cache"
+    response.headers["Expires"] = "0"
+
+    return response
+
+
+def get_time_response(circuit_id, response_type):
+    circuit = db.Circuit.load(circuit_id, *SFG_FIELDS)
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    input_node = request.args.get("input_node")
+    output_node = request.args.get("output_node")
+    end_time = request.args.get("end_time", type=float)
+    num_points = request.args.get("num_points", default=500, type=int)
+
+    try:
+        result = circuit.eval_time_response(
+            input_node,
+            output_node,
+            response_type,
+            end_time,
+            num_points,
+        )
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    response = jsonify(result)
+
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Pragma"] = "no-cache"
+    response.headers["Expires"] = "0"
+
+    return response
+
+
+@app.route("/circuits/<circuit_id>/transfer_function/step", methods=["GET"])
+def get_transfer_function_step(circuit_id):
+    return get_time_response(circuit_id, "step")
+
+
+@app.route("/circuits/<circuit_id>/transfer_function/impulse", methods=["GET"])
+def get_transfer_function_impulse(circuit_id):
+    return get_time_response(circuit_id, "impulse")
+
+
+@app.route("/circuits/<circuit_id>/transfer_function/sensitivity", methods=["GET"])
+def get_transfer_function_sensitivity(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *TRANSFER_FUNCTION_FIELDS)
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    input_node = request.args.get("input_node")
+    output_node = request.args.get("output_node")
+    start_freq = request.args.get("start_freq_hz", type=float)
+    end_freq = request.args.get("end_freq_hz", type=float)
+    points_per_decade = request.args.get("points_per_decade", type=int)
+    phase_unit = request.args.get("phase_unit", default="deg")
+
+    try:
+        sensitivity = circuit.eval_sensitivity(
+            input_node,
+            output_node,
+            start_freq,
+            end_freq,
+            points_per_decade,
+            phase_unit,
+        )
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    response = jsonify(sensitivity)
+
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Pragma"] = "no-cache"
+    response.headers["Expires"] = "0"
+
+    return response
+
+
 @app.route("/circuits/<circuit_id>/loop_gain", methods=["GET"])
 def get_loop_gain(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *LOOP_GAIN_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -416,10 +729,15 @@ def get_loop_gain(circuit_id):
     numerical = request.args.get(
         "numerical", default=False, type=lambda s: bool(strtobool(s))
     )
+    preview_terms = request.args.get("preview_terms", type=int)
 
     try:
-        loop_gain = circuit.compute_loop_gain(
-            latex=latex, factor=factor, numerical=numerical, cache_result=False
+        loop_gain = circuit.render_loop_gain(
+            latex=latex,
+            factor=factor,
+            numerical=numerical,
+            preview_terms=preview_terms,
+            cache_result=False,
         )
 
     except Exception as e:
@@ -432,7 +750,7 @@ def get_loop_gain(circuit_id):
     # # return {'loop_gain': loop_gain}
 
     # Return the loop gain as a JSON response with appropriate Cache-Control header
-    response = jsonify({"loop_gain": loop_gain})
+    response = jsonify(loop_gain)
     # response.headers['Cache-Control'] = 'no-store'  # Prevent caching
 
     # Disable caching for the response
@@ -453,7 +771,7 @@ def get_loop_gain(circuit_id):
 
 @app.route("/circuits/<circuit_id>/loop_gain/bode", methods=["GET"])
 def get_loop_gain_bode(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *LOOP_GAIN_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -497,10 +815,43 @@ def get_loop_gain_bode(circuit_id):
     return response
 
 
+@app.route("/circuits/<circuit_id>/loop_gain/nyquist", methods=["GET"])
+def get_loop_gain_nyquist(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *SFG_FIELDS)
+
+    if not circuit:
+        abort(404, description="Circuit not found")
+
+    start_freq = request.args.get("start_freq_hz", type=float)
+    end_freq = request.args.get("end_freq_hz", type=float)
+    points_per_decade = request.args.get("points_per_decade", default=10, type=int)
+    max_points = request.args.get("max_points", default=5000, type=int)
+
+    try:
+        result = circuit.eval_nyquist(
+            start_freq,
+            end_freq,
+            points_per_decade,
+            max_points,
+            cache_result=False,
+        )
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    response = jsonify(result)
+
+    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    response.headers["Pragma"] = "no-cache"
+    response.headers["Expires"] = "0"
+
+    return response
+
+
 # CHECK HERE FOR SIMPLIFICATION OF THE CIRCUIT
 @app.route("/circuits/<circuit_id>/simplify", methods=["PATCH"])
 def simplify_circuit(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -520,6 +871,8 @@ def simplify_circuit(circuit_id):
 
         return circuit.to_dict(fields)
 
+    except db.ConflictError as e:
+        abort(409, description=str(e))
     except Exception as e:
         abort(status=400, text=str(e))
 
@@ -529,7 +882,7 @@ def simplify_circuit(circuit_id):
 def simplification_automation_sfg(circuit_id):
     print("INSIDE SIMPLIFICAION FUNCTION...")
 
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -585,7 +938,7 @@ def simplification_automation_sfg_entire(circuit_id):
     Endpoint to simplify the entire signal-flow graph (SFG) for a given circuit.
     """
     print("INSIDE SIMPLIFICATION FUNCTION TRIVIAL...")
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -604,7 +957,7 @@ def simplification_automation_sfg_entire(circuit_id):
 
 @app.route("/circuits/<circuit_id>/undo", methods=["PATCH"])
 def undo_sfg(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -623,7 +976,7 @@ def undo_sfg(circuit_id):
 
 @app.route("/circuits/<circuit_id>/redo", methods=["PATCH"])
 def redo_sfg(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *EDIT_FIELDS)
 
     if not circuit:
         abort(404, description="Circuit not found")
@@ -643,7 +996,8 @@ def redo_sfg(circuit_id):
 # For SFG Export
 @app.route("/circuits/<circuit_id>/export", methods=["GET"])
 def get_sfg(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    # The whole document is exported.
+    circuit = db.Circuit.load(circuit_id)
     if not circuit:
         abort(404, description="Circuit not found")
 
@@ -667,7 +1021,7 @@ def import_dill_sfg(circuit_id):
     
     # First check if circuit is in database already
     try: 
-        circuit = db.Circuit.objects(id=circuit_id).first()
+        circuit = db.Circuit.load(circuit_id, *CIRCUIT_FIELDS)
     except (ValidationError, TypeError, ValueError):
         circuit = None
 
@@ -713,12 +1067,14 @@ def import_dill_sfg(circuit_id):
 
         return circuit.to_dict(fields)
 
+    except db.ConflictError as e:
+        abort(409, description=str(e))
     except Exception as e:
         abort(400, description=str(e))
 
 @app.route('/circuits/<circuit_id>/pm/plot', methods=['GET'])
 def plot_phase_margin(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *SWEEP_FIELDS)
 
     if not circuit:
         abort(404, description='Circuit not found')
@@ -771,7 +1127,7 @@ def plot_phase_margin(circuit_id):
 
 @app.route('/circuits/<circuit_id>/bandwidth/plot', methods=['GET'])
 def plot_bandwidth(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *SWEEP_FIELDS)
 
     if not circuit:
         abort(404, description='Circuit not found')
@@ -822,9 +1178,139 @@ def plot_bandwidth(circuit_id):
 
     return response
 
+@app.route('/circuits/<circuit_id>/preview/bode', methods=['POST'])
+def preview_bode(circuit_id):
+    # Only reads the version of the stored circuit: the evaluator is held in
+    # memory after the first call, so that previews can be redrawn while a
+    # slider is dragged.
+    input_node = request.json.get('input_node')
+    output_node = request.json.get('output_node')
+
+    if not input_node or not output_node:
+        abort(400, description='Missing required parameters: input_node, output_node')
+
+    try:
+        freq, gain, phase = db.preview_transfer_function(
+            circuit_id,
+            input_node,
+            output_node,
+            overlay=request.json.get('parameters', {}),
+            start_freq=float(request.json.get('start_freq_hz', 1)),
+            end_freq=float(request.json.get('end_freq_hz', 1e9)),
+            points_per_decade=int(request.json.get('points_per_decade', 20)),
+            gain_unit=request.json.get('gain_unit', 'db'),
+            phase_unit=request.json.get('phase_unit', 'deg')
+        )
+
+    except LookupError as e:
+        abort(404, description=str(e))
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify({'frequency': freq, 'gain': gain, 'phase': phase})
+
+@app.route('/circuits/<circuit_id>/sweep', methods=['POST'])
+def sweep_parameters(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *TRANSFER_FUNCTION_FIELDS)
+
+    if not circuit:
+        abort(404, description='Circuit not found')
+
+    input_node = request.json.get('input_node')
+    output_node = request.json.get('output_node')
+
+    if not input_node or not output_node:
+        abort(400, description='Missing required parameters: input_node, output_node')
+
+    try:
+        result = circuit.sweep_parameters(
+            input_node=input_node,
+            output_node=output_node,
+            axes=request.json.get('axes'),
+            corners=request.json.get('corners'),
+            metrics=request.json.get('metrics', ['phase_margin', 'bandwidth', 'dc_gain']),
+            start_freq=float(request.json.get('start_freq_hz', 1e3)),
+            end_freq=float(request.json.get('end_freq_hz', 1e12)),
+            points_per_decade=int(request.json.get('points_per_decade', 30))
+        )
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify(result)
+
+@app.route('/circuits/<circuit_id>/montecarlo', methods=['POST'])
+def run_montecarlo(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *TRANSFER_FUNCTION_FIELDS)
+
+    if not circuit:
+        abort(404, description='Circuit not found')
+
+    input_node = request.json.get('input_node')
+    output_node = request.json.get('output_node')
+    distributions = request.json.get('distributions')
+
+    if not input_node or not output_node or not distributions:
+        abort(400, description='Missing required parameters: input_node, output_node, distributions')
+
+    try:
+        result = circuit.montecarlo(
+            input_node=input_node,
+            output_node=output_node,
+            distributions=distributions,
+            samples=int(request.json.get('samples', 1000)),
+            metrics=request.json.get('metrics', ['phase_margin', 'bandwidth', 'dc_gain']),
+            bins=int(request.json.get('bins', 20)),
+            percentiles=request.json.get('percentiles', [1, 5, 50, 95, 99]),
+            seed=request.json.get('seed'),
+            start_freq=float(request.json.get('start_freq_hz', 1e3)),
+            end_freq=float(request.json.get('end_freq_hz', 1e12)),
+            points_per_decade=int(request.json.get('points_per_decade', 30))
+        )
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify(result)
+
+@app.route('/circuits/<circuit_id>/solve_for', methods=['POST'])
+def solve_for(circuit_id):
+    circuit = db.Circuit.load(circuit_id, *TRANSFER_FUNCTION_FIELDS)
+
+    if not circuit:
+        abort(404, description='Circuit not found')
+
+    input_node = request.json.get('input_node')
+    output_node = request.json.get('output_node')
+    metric = request.json.get('metric')
+    target = request.json.get('target')
+    free = request.json.get('free')
+
+    if not input_node or not output_node or not metric or target is None or not free:
+        abort(400, description='Missing required parameters: input_node, output_node, metric, target, free')
+
+    try:
+        result = circuit.solve_for(
+            input_node=input_node,
+            output_node=output_node,
+            metric=metric,
+            target=float(target),
+            free=free,
+            tolerance=float(request.json.get('tolerance', 1e-3)),
+            start_freq=float(request.json.get('start_freq_hz', 1e3)),
+            end_freq=float(request.json.get('end_freq_hz', 1e12)),
+            points_per_decade=int(request.json.get('points_per_decade', 100))
+        )
+
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return jsonify(result)
+
 @app.route('/circuits/<circuit_id>/devices/check', methods=['GET'])
 def check_device(circuit_id):
-    circuit = db.Circuit.objects(id=circuit_id).first()
+    circuit = db.Circuit.load(circuit_id, *DEVICE_FIELDS)
 
     if not circuit:
         abort(404, description='Circuit not found')
@@ -844,6 +1330,13 @@ def check_device(circuit_id):
         # Handle unexpected errors gracefully
         return jsonify({"error": str(e)}), 400
 
+@app.errorhandler(db.ConflictError)
+def conflict(e):
+    # The circuit was changed by another request in a way which conflicts
+    # with this one.
+    return jsonify(error=str(e)), 409
+
+
 @app.errorhandler(404)
 def not_found(e):
     # Let API routes return a proper 404
@@ -0,0 +1,558 @@
+"""Compact, versioned serialization of SFGs and their expressions.
+
+An SFG is stored as a node table, an edge table of (source, target,
+expression id) rows, and a table of the distinct edge weight expressions,
+each in a prefix encoding of plain Python values. The tables are packed with
+pickle protocol 5, and optionally compressed with zlib.
+
+Only plain values (tuples, lists, dicts, strings and numbers) are ever
+unpickled, so the format does not depend on the versions of sympy, networkx
+or dill, and loading it cannot run arbitrary code. Data written before this
+format, as dill pickles, is still read.
+
+Expressions are decoded lazily: SFGReader decodes the weight of an edge only
+when it is accessed, so reads which touch a few edges do not decode the whole
+graph.
+"""
+from functools import lru_cache
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Tuple
+import hashlib
+import io
+import pickle
+import zlib
+
+import dill
+import networkx as nx
+import sympy
+
+
+MAGIC = b'SFG'
+FORMAT_VERSION = 1
+
+# Flags stored after the format version.
+COMPRESSED = 1
+
+# Prefix encoding. Atoms are encoded as plain values: a string is a symbol
+# name, and an int or float is a number. Every other node is a tuple whose
+# first item is one of these tags; operators are followed by their arguments.
+ADD = '+'         # ('+', nargs)
+MUL = '*'         # ('*', nargs)
+POW = '^'         # ('^',), followed by the base and exponent
+RATIONAL = '/'    # ('/', p, q)
+CONSTANT = 'c'    # ('c', name), e.g. pi, E or I
+FUNCTION = 'f'    # ('f', name, nargs), e.g. exp or sin
+
+_OPERATORS = {sympy.Add: ADD, sympy.Mul: MUL}
+
+# Circuits share a small set of parameter names, so symbols are re-used
+# rather than constructed (and validated) for every occurrence.
+_symbol = lru_cache(maxsize=4096)(sympy.Symbol)
+
+
+class _Unpickler(pickle.Unpickler):
+    # The format only contains plain values, so no class is ever loaded.
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError('Invalid SFG data.')
+
+
+def _encode(expression: sympy.Expr, tokens: List):
+    if expression.is_Symbol:
+        tokens.append(expression.name)
+    elif expression.is_Integer:
+        tokens.append(int(expression))
+    elif expression.is_Rational:
+        tokens.append((RATIONAL, int(expression.p), int(expression.q)))
+    elif expression.is_Float:
+        tokens.append(float(expression))
+    elif not expression.args:
+        # Singletons such as pi, E and I.
+        tokens.append((CONSTANT, type(expression).__name__))
+    else:
+        if type(expression) in _OPERATORS:
+            tokens.append((_OPERATORS[type(expression)], len(expression.args)))
+        elif expression.is_Pow:
+            tokens.append((POW,))
+        else:
+            tokens.append((FUNCTION, type(expression).__name__,
+                           len(expression.args)))
+
+        for arg in expression.args:
+            _encode(arg, tokens)
+
+
+def encode_expression(expression) -> Tuple:
+    """Encodes an expression as a tuple of prefix tokens."""
+    tokens = []
+    _encode(sympy.sympify(expression), tokens)
+    return tuple(tokens)
+
+
+def decode_expression(tokens: Tuple) -> sympy.Expr:
+    """Decodes an expression from its prefix tokens.
+
+    Expressions are rebuilt with evaluation, so that they are put in the
+    canonical form of the installed sympy version, whichever version wrote
+    them.
+    """
+    tokens = iter(tokens)
+
+    def decode() -> sympy.Expr:
+        token = next(tokens)
+
+        if isinstance(token, str):
+            return _symbol(token)
+        if isinstance(token, int):
+            return sympy.Integer(token)
+        if isinstance(token, float):
+            return sympy.Float(token)
+
+        tag = token[0]
+        if tag == ADD:
+            args = [decode() for _ in range(token[1])]
+            return sympy.Add(*args)
+        if tag == MUL:
+            args = [decode() for _ in range(token[1])]
+            return sympy.Mul(*args)
+        if tag == POW:
+            base = decode()
+            return sympy.Pow(base, decode())
+        if tag == RATIONAL:
+            return sympy.Rational(token[1], token[2])
+        if tag == CONSTANT:
+            return getattr(sympy.S, token[1])
+        if tag == FUNCTION:
+            args = [decode() for _ in range(token[2])]
+            return getattr(sympy, token[1])(*args)
+
+        raise ValueError('Invalid expression data.')
+
+    return decode()
+
+
+def digest(expression: sympy.Expr) -> str:
+    """Returns a digest of the encoding of an expression, which identifies it
+    by content."""
+    tokens = encode_expression(expression)
+    return hashlib.sha1(pickle.dumps(tokens, protocol=5)).hexdigest()
+
+
+def _pack(data: Dict, compress: bool) -> bytes:
+    payload = pickle.dumps(data, protocol=5)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= COMPRESSED
+
+    return MAGIC + bytes((FORMAT_VERSION, flags)) + payload
+
+
+def _unpack(data: bytes) -> Dict:
+    version, flags = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version > FORMAT_VERSION:
+        raise ValueError(f'Unsupported SFG format version {version}.')
+
+    payload = memoryview(data)[len(MAGIC) + 2:]
+    if flags & COMPRESSED:
+        payload = zlib.decompress(payload)
+
+    return _Unpickler(io.BytesIO(payload)).load()
+
+
+def is_packed(data: bytes) -> bool:
+    """Returns True if data is in this format, rather than a dill pickle."""
+    return data[:len(MAGIC)] == MAGIC
+
+
+def dumps(graph: nx.DiGraph, compress: bool = False) -> bytes:
+    """Serializes an SFG.
+
+    Args:
+        graph: The SFG.
+        compress: If True, compresses the data.
+
+    Returns:
+        The serialized SFG.
+    """
+    nodes = {node: attributes or None
+             for node, attributes in graph.nodes(data=True)}
+
+    # Equal expressions are encoded once.
+    encoded = {}
+    edges = {}
+    for src, dst, attributes in graph.edges(data=True):
+        attributes = dict(attributes)
+        weight = sympy.sympify(attributes.pop('weight', 0))
+
+        if weight not in encoded:
+            encoded[weight] = encode_expression(weight)
+
+        edges[src, dst] = (encoded[weight], attributes or None)
+
+    return _pack_tables(dict(graph.graph), nodes, edges, compress)
+
+
+def _pack_tables(
+    attributes: Dict,
+    nodes: Dict[Hashable, Optional[Dict]],
+    edges: Dict[Tuple[Hashable, Hashable], Tuple[Tuple, Optional[Dict]]],
+    compress: bool
+) -> bytes:
+    # Packs the node table, and the edge table with the encoded weight of
+    # each edge. Equal expressions are stored once.
+    index = {node: i for i, node in enumerate(nodes)}
+
+    expression_ids = {}
+    expressions = []
+    edge_rows = []
+    for (src, dst), (tokens, edge_attributes) in edges.items():
+        if tokens not in expression_ids:
+            expression_ids[tokens] = len(expressions)
+            expressions.append(tokens)
+
+        edge_rows.append((index[src], index[dst], expression_ids[tokens],
+                          edge_attributes))
+
+    return _pack({
+        'graph': attributes,
+        'nodes': list(nodes.items()),
+        'edges': edge_rows,
+        'expressions': expressions,
+    }, compress)
+
+
+def _unpack_tables(data: bytes) -> Tuple[
+    Dict,
+    Dict[Hashable, Optional[Dict]],
+    Dict[Tuple[Hashable, Hashable], Tuple[Tuple, Optional[Dict]]]
+]:
+    # The inverse of _pack_tables. Data written by dill is encoded first.
+    if not is_packed(data):
+        return _unpack_tables(dumps(dill.loads(data)))
+
+    tables = _unpack(data)
+    names = [node for node, _ in tables['nodes']]
+    expressions = tables['expressions']
+
+    return tables['graph'], dict(tables['nodes']), {
+        (names[src], names[dst]): (expressions[expression_id], attributes)
+        for src, dst, expression_id, attributes in tables['edges']
+    }
+
+
+def _changes(base: Dict, other: Dict) -> Dict:
+    # The items of other which were added or changed since base, with None
+    # for those which were removed.
+    changes = {key: value for key, value in other.items()
+               if key not in base or base[key] != value}
+    changes.update((key, None) for key in base if key not in other)
+    return changes
+
+
+def _entry(table: Dict, key: Hashable) -> Tuple:
+    # A table entry in a delta: empty if the key is not in the table.
+    return (table[key],) if key in table else ()
+
+
+def diff(old: bytes, new: bytes) -> Optional[bytes]:
+    """Returns the changes from one SFG to another.
+
+    The delta holds each changed node, edge and graph attribute as it was
+    before and after, so it can be applied in either direction (see patch).
+
+    Args:
+        old: The SFG before the changes.
+        new: The SFG after the changes.
+
+    Returns:
+        The delta, or None if the SFGs are equal.
+    """
+    changes = []
+    for old_table, new_table in zip(_unpack_tables(old), _unpack_tables(new)):
+        changes.append({
+            key: (_entry(old_table, key), _entry(new_table, key))
+            for key in _changes(old_table, new_table)
+        })
+
+    if not any(changes):
+        return None
+    return _pack({'changes': changes}, compress=True)
+
+
+def patch(data: bytes, delta: bytes, reverse: bool = False,
+          compress: bool = False) -> bytes:
+    """Applies a delta made by diff to an SFG.
+
+    Args:
+        data: The SFG.
+        delta: The delta.
+        reverse: If True, reverts the changes instead.
+        compress: If True, compresses the patched SFG.
+
+    Returns:
+        The patched SFG.
+
+    Raises:
+        ValueError: If a changed node, edge or graph attribute of the SFG
+            does not have the value the delta changes.
+    """
+    patched = []
+    for table, changes in zip(_unpack_tables(data),
+                              _unpack(delta)['changes']):
+        table = dict(table)
+        for key, (before, after) in changes.items():
+            if reverse:
+                before, after = after, before
+            if _entry(table, key) != before:
+                raise ValueError(f'{key!r} was changed since.')
+
+            if after:
+                table[key] = after[0]
+            else:
+                del table[key]
+        patched.append(table)
+
+    return _pack_tables(*patched, compress)
+
+
+def equal(a: bytes, b: bytes) -> bool:
+    """Returns True if two serialized SFGs have the same nodes, edges and
+    attributes, even if they are in a different order."""
+    return _unpack_tables(a) == _unpack_tables(b)
+
+
+def content_digest(data: bytes) -> str:
+    """Returns a digest of the nodes, edges and attributes of a serialized
+    SFG, which does not depend on their order, or on how the SFG was
+    serialized."""
+    content = tuple(sorted(table.items(), key=repr)
+                    for table in _unpack_tables(data))
+    return hashlib.sha1(pickle.dumps(content, protocol=5)).hexdigest()
+
+
+def _refine(colors: Dict[Hashable, str],
+            edges: Dict[Tuple[Hashable, Hashable], str]) -> Dict[Hashable, str]:
+    # Weisfeiler-Lehman colour refinement: each node is coloured by its own
+    # colour and the labelled edges to and from the colours of its
+    # neighbours, until no more nodes are told apart.
+    while True:
+        neighbours = {node: [] for node in colors}
+        for (src, dst), label in edges.items():
+            neighbours[src].append(('out', label, colors[dst]))
+            neighbours[dst].append(('in', label, colors[src]))
+
+        refined = {
+            node: hashlib.sha1(repr(
+                (colors[node], sorted(neighbours[node]))
+            ).encode()).hexdigest()
+            for node in colors
+        }
+        if len(set(refined.values())) == len(set(colors.values())):
+            return colors
+        colors = refined
+
+
+def canonical_form(data: bytes) -> Tuple[str, Dict[Hashable, int]]:
+    """Returns a fingerprint of a serialized SFG which does not depend on the
+    names of its nodes, and the canonical label of each node.
+
+    The nodes are ordered by colour refinement over the edge weights and
+    attributes, so SFGs which only differ in their node names get the same
+    fingerprint, and corresponding nodes get the same labels. Nodes which
+    refinement cannot tell apart (e.g. those of symmetric subgraphs) are told
+    apart by name, one at a time. Equal fingerprints always mean that the
+    SFGs are equal under their labels, though in rare cases isomorphic SFGs
+    get different fingerprints.
+
+    Args:
+        data: The serialized SFG.
+
+    Returns:
+        The fingerprint, and a map from each node to its label.
+    """
+    attributes, nodes, edges = _unpack_tables(data)
+    edge_labels = {edge: repr(entry) for edge, entry in edges.items()}
+
+    colors = _refine({node: repr(attrs) for node, attrs in nodes.items()},
+                     edge_labels)
+    while len(set(colors.values())) < len(colors):
+        counts = {}
+        for color in colors.values():
+            counts[color] = counts.get(color, 0) + 1
+        tied = min(color for color, count in counts.items() if count > 1)
+        node = min((n for n in colors if colors[n] == tied), key=repr)
+        colors = _refine({**colors, node: tied + '*'}, edge_labels)
+
+    order = sorted(colors, key=colors.get)
+    labels = {node: i for i, node in enumerate(order)}
+    content = (
+        sorted(attributes.items(), key=repr),
+        [nodes[node] for node in order],
+        sorted((labels[src], labels[dst], entry)
+               for (src, dst), entry in edges.items()),
+    )
+    fingerprint = hashlib.sha1(pickle.dumps(content, protocol=5)).hexdigest()
+    return fingerprint, labels
+
+
+def merge(base: bytes, ours: bytes, theirs: bytes,
+          compress: bool = False) -> bytes:
+    """Merges two independent sets of changes to an SFG.
+
+    Changes to different nodes and edges commute, so both are kept: the
+    nodes and edges which ours changed since base are applied to theirs.
+
+    Args:
+        base: The SFG both sets of changes were made to.
+        ours: The SFG with the first set of changes.
+        theirs: The SFG with the second set of changes.
+        compress: If True, compresses the merged SFG.
+
+    Returns:
+        The merged SFG.
+
+    Raises:
+        ValueError: If both change the same node, edge or graph attribute
+            differently.
+    """
+    base_tables = _unpack_tables(base)
+    our_tables = _unpack_tables(ours)
+    their_tables = _unpack_tables(theirs)
+
+    merged = []
+    for base_table, our_table, their_table in zip(
+            base_tables, our_tables, their_tables):
+        our_changes = _changes(base_table, our_table)
+        their_changes = _changes(base_table, their_table)
+
+        for key in our_changes.keys() & their_changes.keys():
+            if our_changes[key] != their_changes[key]:
+                raise ValueError(f'Conflicting changes to {key!r}.')
+
+        table = dict(their_table)
+        for key, value in our_changes.items():
+            if key in our_table:
+                table[key] = value
+            else:
+                table.pop(key, None)
+        merged.append(table)
+
+    attributes, nodes, edges = merged
+    if any(src not in nodes or dst not in nodes for src, dst in edges):
+        raise ValueError('Conflicting changes to the nodes of an edge.')
+
+    return _pack_tables(attributes, nodes, edges, compress)
+
+
+def dumps_expression(expression: sympy.Expr, compress: bool = False) -> bytes:
+    """Serializes a single expression, e.g. a transfer function."""
+    return _pack({'expression': encode_expression(expression)}, compress)
+
+
+def loads_expression(data: bytes) -> sympy.Expr:
+    """De-serializes an expression written by dumps_expression, or by
+    dill."""
+    if not is_packed(data):
+        return dill.loads(data)
+    return decode_expression(_unpack(data)['expression'])
+
+
+class SFGReader:
+    """Reads a serialized SFG, decoding edge weights only when accessed.
+
+    The node and edge tables are read on construction, which is cheap; each
+    distinct weight expression is decoded on first access. Data written by
+    dill is de-serialized whole.
+    """
+
+    def __init__(self, data: bytes):
+        self._graph: Optional[nx.DiGraph] = None
+
+        if not is_packed(data):
+            self._graph = dill.loads(data)
+            return
+
+        tables = _unpack(data)
+        self._attributes = tables['graph']
+        self._nodes = tables['nodes']
+        self._expressions: List[Any] = tables['expressions']
+        self._decoded: List[Optional[sympy.Expr]] = \
+            [None] * len(self._expressions)
+
+        names = [node for node, _ in self._nodes]
+        self._names = set(names)
+        self._edges: Dict[Tuple[Hashable, Hashable], Tuple[int, Any]] = {
+            (names[src], names[dst]): (expression_id, attributes)
+            for src, dst, expression_id, attributes in tables['edges']
+        }
+
+        # The edges of each node, so that they are found without scanning
+        # every edge.
+        self._in_edges: Dict[Hashable, List[Tuple[Hashable, Hashable]]] = {}
+        self._out_edges: Dict[Hashable, List[Tuple[Hashable, Hashable]]] = {}
+        for src, dst in self._edges:
+            self._out_edges.setdefault(src, []).append((src, dst))
+            self._in_edges.setdefault(dst, []).append((src, dst))
+
+    def __contains__(self, node: Hashable) -> bool:
+        if self._graph is not None:
+            return node in self._graph
+        return node in self._names
+
+    @property
+    def edges(self) -> List[Tuple[Hashable, Hashable]]:
+        """The (source, target) pairs of the edges."""
+        if self._graph is not None:
+            return list(self._graph.edges)
+        return list(self._edges)
+
+    def has_edge(self, src: Hashable, dst: Hashable) -> bool:
+        if self._graph is not None:
+            return self._graph.has_edge(src, dst)
+        return (src, dst) in self._edges
+
+    def in_edges(self, node: Hashable) -> Iterator[Tuple[Hashable, Hashable]]:
+        if self._graph is not None:
+            return iter(self._graph.in_edges(node)
+                        if node in self._graph else ())
+        return iter(self._in_edges.get(node, ()))
+
+    def out_edges(self, node: Hashable) -> Iterator[Tuple[Hashable, Hashable]]:
+        if self._graph is not None:
+            return iter(self._graph.out_edges(node)
+                        if node in self._graph else ())
+        return iter(self._out_edges.get(node, ()))
+
+    def weight(self, src: Hashable, dst: Hashable) -> sympy.Expr:
+        """Returns the weight of an edge, decoding it if needed."""
+        if self._graph is not None:
+            return self._graph.edges[src, dst]['weight']
+
+        expression_id, _ = self._edges[src, dst]
+        return self._expression(expression_id)
+
+    def _expression(self, expression_id: int) -> sympy.Expr:
+        expression = self._decoded[expression_id]
+        if expression is None:
+            expression = decode_expression(self._expressions[expression_id])
+            self._decoded[expression_id] = expression
+        return expression
+
+    def graph(self) -> nx.DiGraph:
+        """Decodes the whole SFG into a new graph."""
+        if self._graph is not None:
+            return self._graph.copy()
+
+        graph = nx.DiGraph(**self._attributes)
+        for node, attributes in self._nodes:
+            graph.add_node(node, **(attributes or {}))
+
+        for (src, dst), (expression_id, attributes) in self._edges.items():
+            graph.add_edge(src, dst, weight=self._expression(expression_id),
+                           **(attributes or {}))
+
+        return graph
+
+
+def loads(data: bytes) -> nx.DiGraph:
+    """De-serializes an SFG written by dumps, or by dill."""
+    return SFGReader(data).graph()
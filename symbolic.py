@@ -0,0 +1,75 @@
+"""Backend for the hot symbolic operations on SFG expressions.
+
+Building Mason's formula, and substituting parameter values into its result,
+are slow in pure-Python sympy. When SymEngine is installed, these operations
+run on it instead, and results are converted back to sympy, which remains the
+type used everywhere else (e.g. for factoring, and LaTeX output). Setting the
+SYMBOLIC_BACKEND environment variable to 'sympy' disables SymEngine.
+"""
+from typing import Iterable, Mapping, Union
+import os
+
+import sympy
+
+try:
+    import symengine
+except ImportError:
+    symengine = None
+
+
+if symengine is not None and os.environ.get('SYMBOLIC_BACKEND') != 'sympy':
+    BACKEND = 'symengine'
+else:
+    BACKEND = 'sympy'
+
+
+def to_backend(expr):
+    """Converts a sympy expression (or number) to the backend type."""
+    if BACKEND == 'symengine':
+        return symengine.sympify(expr)
+    return sympy.sympify(expr)
+
+
+def to_sympy(expr) -> sympy.Expr:
+    """Converts a backend expression back to sympy."""
+    return sympy.sympify(expr)
+
+
+def mul(factors: Iterable):
+    """Multiplies backend expressions."""
+    if BACKEND == 'symengine':
+        return symengine.Mul(*factors)
+    return sympy.Mul.fromiter(factors)
+
+
+def add(terms: Iterable):
+    """Adds backend expressions."""
+    if BACKEND == 'symengine':
+        return symengine.Add(*terms)
+    return sympy.Add.fromiter(terms)
+
+
+def subs(expr: sympy.Expr,
+         values: Mapping[Union[str, sympy.Symbol], object]) -> sympy.Expr:
+    """Substitutes values for symbols in a sympy expression.
+
+    Args:
+        expr: The expression.
+        values: A mapping from symbols, or symbol names, to values.
+
+    Returns:
+        The resulting sympy expression.
+    """
+    if BACKEND == 'symengine':
+        values = {symengine.Symbol(str(k)): to_backend(v)
+                  for k, v in values.items()}
+        return to_sympy(to_backend(expr).subs(values))
+
+    return expr.subs(values)
+
+
+def diff(expr: sympy.Expr, symbol: sympy.Symbol) -> sympy.Expr:
+    """Differentiates a sympy expression with respect to a symbol."""
+    if BACKEND == 'symengine':
+        return to_sympy(to_backend(expr).diff(to_backend(symbol)))
+    return sympy.diff(expr, symbol)
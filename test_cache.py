@@ -0,0 +1,45 @@
+import unittest
+
+from cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_bounded_by_size(self):
+        cache = LRUCache(maxsize=10, maxbytes=10, sizeof=len)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        self.assertEqual(cache.size, 8)
+
+        cache.put('c', b'1234')
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 8)
+
+        # Replacing or removing an item updates the total size.
+        cache.put('b', b'12')
+        self.assertEqual(cache.size, 6)
+        cache.pop('c')
+        self.assertEqual(cache.size, 2)
+
+    def test_keeps_oversized_item(self):
+        # The most recent item is kept even if it exceeds the size limit.
+        cache = LRUCache(maxsize=10, maxbytes=4, sizeof=len)
+        cache.put('a', b'12')
+        cache.put('b', b'123456')
+
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.get('b'), b'123456')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,588 @@
+import cmath
+import math
+import os
+import unittest
+from collections import Counter
+from unittest import mock
+
+import dill
+import mongoengine
+import sympy
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import db
+import server
+
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'test_data')
+
+
+def read_test_data(name):
+    with open(os.path.join(TEST_DATA_DIR, name), 'r') as f:
+        return f.read()
+
+
+def create_circuit(name='2N3904_cascode'):
+    return db.Circuit.create(
+        name=name,
+        netlist=read_test_data(f'{name}.cir'),
+        op_point_log=read_test_data(f'{name}.log'),
+    )
+
+
+def substitute(expression, parameters, freq):
+    # Evaluates an expression at a frequency, in hertz, by substitution.
+    values = {symbol: 2j * math.pi * freq if symbol.name == 's'
+              else parameters[symbol.name]
+              for symbol in expression.free_symbols}
+    return complex(expression.subs(values))
+
+
+@unittest.skipIf(mongomock is None, 'mongomock is not installed')
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        mongoengine.disconnect()
+        mongoengine.connect('test', mongo_client_class=mongomock.MongoClient)
+        for document in (db.Circuit, db.Blob, db.Analysis, db.Upload):
+            document._collection = None
+        for cache in (db._blobs, db._uploads, db._previews, db._analyses):
+            cache.clear()
+
+    def tearDown(self):
+        mongoengine.disconnect()
+
+
+class TestBlobs(DatabaseTestCase):
+
+    def assertBlobRefsCounted(self):
+        # Every blob counts the references to it from stored circuits and
+        # uploads.
+        expected = Counter()
+        for document in (*db.Circuit._get_collection().find(),
+                         *db.Upload._get_collection().find()):
+            expected += db._blob_refs(document)
+        counted = {blob['_id']: blob['refs']
+                   for blob in db.Blob._get_collection().find()}
+        self.assertEqual(counted, dict(expected))
+
+    def edit(self, circuit_id, factor):
+        circuit = db.Circuit.load(circuit_id, 'parameters', 'sfg', 'history',
+                                  'undone')
+        sfg = circuit._checkout_sfg()
+        src, dst = next(iter(sfg.edges))
+        sfg.edges[src, dst]['weight'] *= factor
+        circuit._commit_sfg(sfg)
+        circuit.save()
+
+    def test_blob_refs_counted(self):
+        circuit = create_circuit()
+        other = create_circuit()
+        self.assertBlobRefsCounted()
+
+        for factor in (2, 3, 4):
+            self.edit(circuit.id, factor)
+        circuit = db.Circuit.load(circuit.id, 'parameters', 'sfg',
+                                  'transfer_functions')
+        circuit._compute_transfer_function('Vin', 'Vout', cache_result=True)
+        circuit.save()
+        self.assertBlobRefsCounted()
+
+        circuit = db.Circuit.load(circuit.id, 'parameters', 'sfg', 'history',
+                                  'undone')
+        circuit.undo_sfg()
+        circuit.save()
+        circuit.redo_sfg()
+        circuit.save()
+        circuit = db.Circuit.load(circuit.id, 'parameters', 'sfg',
+                                  'original_sfg', 'branches')
+        circuit.fork_branch('edited')
+        circuit.save()
+        self.assertBlobRefsCounted()
+
+        # Fields which are assigned without being read (e.g. the history
+        # and cached transfer functions on reset) release their references.
+        circuit = db.Circuit.load(circuit.id, 'name', 'parameters', 'sfg',
+                                  'original_sfg', 'original_parameters')
+        circuit.reset_to_original()
+        circuit.save()
+        self.assertBlobRefsCounted()
+
+        self.edit(other.id, 5)
+        export = dill.dumps(db.Circuit.load(other.id))
+        circuit = db.Circuit.load(circuit.id, 'name', 'parameters', 'sfg')
+        circuit.import_circuit(dill.loads(export))
+        circuit.save()
+        self.assertBlobRefsCounted()
+
+        db.Circuit.load(other.id).delete()
+        self.assertBlobRefsCounted()
+        db.Circuit.load(circuit.id).delete()
+        self.assertBlobRefsCounted()
+
+    def test_export_holds_content(self):
+        circuit = create_circuit()
+        circuit._compute_transfer_function('Vin', 'Vout', cache_result=True)
+        sfg = circuit._checkout_sfg()
+        src, dst = next(iter(sfg.edges))
+        sfg.edges[src, dst]['weight'] *= 2
+        circuit._commit_sfg(sfg)
+        circuit.save()
+
+        stored = db.Circuit.load(circuit.id)
+        export = dill.dumps(stored)
+
+        # The export still loads once the blobs are gone.
+        db.Blob.drop_collection()
+        db._blobs.clear()
+        loaded = dill.loads(export)
+        self.assertEqual(loaded.netlist, read_test_data('2N3904_cascode.cir'))
+        self.assertEqual(loaded.sfg, stored.sfg)
+        self.assertEqual(loaded.history[0].checkpoint,
+                         stored.history[0].checkpoint)
+        self.assertEqual(
+            db.sfg_format.loads_expression(
+                loaded.transfer_functions[0].sympy_expression),
+            db.sfg_format.loads_expression(
+                stored.transfer_functions[0].sympy_expression))
+
+        # Importing it stores the blobs again.
+        imported = create_circuit('2N3904_common_emitter')
+        imported.import_circuit(loaded)
+        imported.save()
+
+        db._blobs.clear()
+        imported = db.Circuit.load(imported.id)
+        self.assertEqual(imported.netlist,
+                         read_test_data('2N3904_cascode.cir'))
+        self.assertEqual(imported.original_sfg, stored.original_sfg)
+
+    def test_repeated_upload(self):
+        circuit = create_circuit()
+
+        # Repeated uploads are not processed again, whether the result is
+        # cached in this worker or only stored.
+        for clear in (False, True):
+            if clear:
+                db._uploads.clear()
+                db._blobs.clear()
+            with mock.patch.object(db.circuit_parser.Circuit,
+                                   'from_ltspice_netlist') as parse, \
+                    mock.patch.object(db, 'DPI') as dpi:
+                other = create_circuit()
+            parse.assert_not_called()
+            dpi.assert_not_called()
+
+            self.assertEqual(other.sfg, circuit.sfg)
+            self.assertEqual(other.parameters, circuit.parameters)
+
+        # Each circuit has its own parameters.
+        other.update_parameters({'Rs': 1.0})
+        other.save()
+        self.assertNotEqual(db.Circuit.load(circuit.id).parameters['Rs'],
+                            1.0)
+        self.assertNotEqual(create_circuit().parameters['Rs'], 1.0)
+        self.assertEqual(db.Upload.objects.count(), 1)
+        self.assertBlobRefsCounted()
+
+
+class TestLoad(DatabaseTestCase):
+    def test_deferred_fields(self):
+        stored = create_circuit()
+        circuit = db.Circuit.load(stored.id, 'name')
+
+        # The other fields are fetched one at a time, on first access.
+        self.assertEqual(circuit.name, stored.name)
+        self.assertIsNone(circuit._data['netlist'])
+        self.assertEqual(circuit.netlist, stored.netlist)
+        self.assertIsNone(circuit._data['svg'])
+        self.assertEqual(circuit.parameters, stored.parameters)
+        self.assertEqual(circuit.svg, stored.svg)
+        self.assertEqual(list(circuit._checkout_sfg().edges(data=True)),
+                         list(stored._checkout_sfg().edges(data=True)))
+
+        # A field assigned before it is read is not fetched over.
+        circuit = db.Circuit.load(stored.id, 'name')
+        circuit.parameters = {'Rs': 1.0}
+        self.assertEqual(circuit.parameters, {'Rs': 1.0})
+
+        self.assertIsNone(db.Circuit.load('000000000000000000000000', 'name'))
+
+    def assertUpdated(self, circuit, update):
+        # Saves the circuit, checking the fields of the update sent.
+        collection = mongomock.collection.Collection
+        stored = db.Circuit._get_collection().find_one({'_id': circuit.id})
+        with mock.patch.object(collection, 'update_one', autospec=True,
+                               side_effect=collection.update_one) as spy:
+            circuit.save()
+
+        sent = [call.args[2] for call in spy.call_args_list
+                if call.args[0].name == db.Circuit._get_collection_name()]
+        self.assertEqual([{operator: set(fields)
+                           for operator, fields in doc.items()}
+                          for doc in sent], [update] if update else [])
+
+        # The other stored fields are untouched.
+        updated = db.Circuit._get_collection().find_one({'_id': circuit.id})
+        changed = set().union(*update.values()) if update else set()
+        for key in set(stored) | set(updated):
+            if key not in changed:
+                self.assertEqual(updated.get(key), stored.get(key), key)
+
+    def test_changed_fields_only(self):
+        circuit_id = create_circuit().id
+
+        circuit = db.Circuit.load(circuit_id, 'name')
+        circuit.name = 'renamed'
+        self.assertUpdated(circuit, {'$set': {'name', 'version'}})
+
+        # Assigning the stored value changes nothing.
+        circuit = db.Circuit.load(circuit_id, 'name')
+        circuit.name = 'renamed'
+        self.assertUpdated(circuit, None)
+
+        circuit = db.Circuit.load(circuit_id, 'parameters', 'sfg', 'history',
+                                  'undone')
+        sfg = circuit._checkout_sfg()
+        src, dst = next(iter(sfg.edges))
+        sfg.edges[src, dst]['weight'] *= 2
+        circuit._commit_sfg(sfg)
+        self.assertUpdated(circuit, {'$set': {'sfg', 'version'},
+                                     '$push': {'history'}})
+
+
+class TestPreview(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.circuit = create_circuit()
+        self.expression = self.circuit._transfer_function_expression(
+            'Vin', 'Vout')
+
+    def preview(self, overlay=None):
+        return db.preview_transfer_function(
+            str(self.circuit.id), 'Vin', 'Vout', overlay or {}, 1e3, 1e6, 1,
+            gain_unit='', phase_unit='rad')
+
+    def assertPreviewed(self, result, parameters):
+        for freq, gain, phase in zip(*result):
+            value = substitute(self.expression, parameters, freq)
+            self.assertAlmostEqual(gain / abs(value), 1, places=6)
+            self.assertAlmostEqual(phase, math.atan2(value.imag, value.real),
+                                   places=6)
+
+    def test_overlay(self):
+        parameters = dict(self.circuit.parameters)
+        self.assertPreviewed(self.preview(), parameters)
+
+        # The overlay is evaluated, but not saved.
+        result = self.preview({'Rs': 10.0})
+        self.assertPreviewed(result, {**parameters, 'Rs': 10.0})
+        self.assertEqual(db.Circuit.load(self.circuit.id).parameters,
+                         parameters)
+
+        with self.assertRaises(ValueError):
+            self.preview({'nope': 1.0})
+
+    def test_saved_parameters(self):
+        self.preview()
+
+        circuit = db.Circuit.load(self.circuit.id, 'parameters', 'sfg')
+        circuit.update_parameters({'Rs': 10.0})
+        circuit.save()
+        self.assertPreviewed(self.preview(), circuit.parameters)
+
+        # Saves by another process are found from the stored version.
+        db.Circuit._get_collection().update_one(
+            {'_id': self.circuit.id},
+            {'$set': {'parameters.Rs': 20.0}, '$inc': {'version': 1}})
+        self.assertPreviewed(self.preview(),
+                             {**circuit.parameters, 'Rs': 20.0})
+
+    def test_undefined_values(self):
+        _, gain, phase = self.preview({'Rs': float('nan')})
+        self.assertEqual(gain, [None] * len(gain))
+        self.assertEqual(phase, [None] * len(phase))
+
+    def test_route(self):
+        client = server.app.test_client()
+        response = client.post(
+            f'/circuits/{self.circuit.id}/preview/bode',
+            json={'input_node': 'Vin', 'output_node': 'Vout',
+                  'parameters': {'Rs': 10.0}, 'start_freq_hz': 1e3,
+                  'end_freq_hz': 1e6, 'points_per_decade': 1,
+                  'gain_unit': '', 'phase_unit': 'rad'})
+        self.assertEqual(response.status_code, 200)
+        result = response.get_json()
+        self.assertPreviewed(
+            (result['frequency'], result['gain'], result['phase']),
+            {**self.circuit.parameters, 'Rs': 10.0})
+
+        response = client.post(
+            '/circuits/000000000000000000000000/preview/bode',
+            json={'input_node': 'Vin', 'output_node': 'Vout'})
+        self.assertEqual(response.status_code, 404)
+
+
+class TestEdges(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.circuit = create_circuit()
+        self.sfg = self.circuit._load_sfg()
+
+    def assertWeight(self, edge, magnitude, phase, parameters, freq):
+        value = substitute(self.sfg.edges[edge]['weight'], parameters, freq)
+        self.assertAlmostEqual(
+            abs(magnitude * cmath.exp(1j * math.radians(phase)) - value)
+            / abs(value), 0, places=6)
+
+    def assertEdges(self, edges, expected):
+        self.assertEqual([(e['data']['source'], e['data']['target'])
+                          for e in edges], expected)
+        parameters = self.circuit.parameters
+        for edge in edges:
+            data = edge['data']
+            self.assertWeight((data['source'], data['target']),
+                              data['weight']['magnitude'],
+                              data['weight']['phase'], parameters,
+                              parameters['f'])
+
+    def test_evaluate_edges(self):
+        # The second evaluation of a weight is compiled.
+        for _ in range(2):
+            self.assertEdges(self.circuit.evaluate_edges(),
+                             list(self.sfg.edges))
+
+        node = next(iter(self.sfg.nodes))
+        self.assertEdges(
+            self.circuit.evaluate_edges(node=node),
+            list(self.sfg.in_edges(node)) + list(self.sfg.out_edges(node)))
+
+        edge = list(self.sfg.edges)[-1]
+        self.assertEdges(self.circuit.evaluate_edges([edge, edge]), [edge])
+
+        with self.assertRaises(LookupError):
+            self.circuit.evaluate_edges(node='missing')
+        with self.assertRaises(LookupError):
+            self.circuit.evaluate_edges([(node, node)])
+
+    def test_edge_table(self):
+        table = self.circuit.eval_edge_table(1, 1e6, 1)
+
+        self.assertEqual([tuple(e) for e in table['edges']],
+                         list(self.sfg.edges))
+        for edge, magnitudes, phases in zip(self.sfg.edges,
+                                            table['magnitude'],
+                                            table['phase']):
+            for freq, magnitude, phase in zip(table['frequency'], magnitudes,
+                                              phases):
+                self.assertWeight(edge, magnitude, phase,
+                                  self.circuit.parameters, freq)
+
+    def test_routes(self):
+        client = server.app.test_client()
+        node = next(iter(self.sfg.nodes))
+
+        response = client.get(f'/circuits/{self.circuit.id}/edges',
+                              query_string={'node': node})
+        self.assertEqual(response.status_code, 200)
+        self.assertEdges(
+            response.get_json()['edges'],
+            list(self.sfg.in_edges(node)) + list(self.sfg.out_edges(node)))
+
+        response = client.get(f'/circuits/{self.circuit.id}/edges',
+                              query_string={'source': node, 'target': node})
+        self.assertEqual(response.status_code, 404)
+
+        response = client.get(f'/circuits/{self.circuit.id}/edges/table',
+                              query_string={'start_freq_hz': 1,
+                                            'end_freq_hz': 1e3,
+                                            'points_per_decade': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(),
+                         self.circuit.eval_edge_table(1, 1e3, 1))
+
+
+class TestConcurrentEdits(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.circuit_id = create_circuit().id
+        self.sfg = db.Circuit.load(self.circuit_id, 'sfg')._load_sfg()
+        self.edges = list(self.sfg.edges)[:2]
+
+    def load(self):
+        return db.Circuit.load(self.circuit_id, *server.EDIT_FIELDS)
+
+    def assertStoredWeights(self, weights):
+        sfg = db.Circuit.load(self.circuit_id, 'sfg')._load_sfg()
+        self.assertEqual(list(sfg.edges), list(self.sfg.edges))
+        for edge in sfg.edges:
+            self.assertEqual(sfg.edges[edge]['weight'],
+                             weights.get(edge, self.sfg.edges[edge]['weight']))
+
+    def test_different_edges(self):
+        # Both copies are loaded before either is saved.
+        first, second = self.load(), self.load()
+        first.edit_edge(*self.edges[0], 'RL')
+        second.edit_edge(*self.edges[1], 'Rs')
+        first.save()
+        second.save()
+
+        self.assertStoredWeights({self.edges[0]: sympy.Symbol('RL'),
+                                  self.edges[1]: sympy.Symbol('Rs')})
+        self.assertEqual(len(db.Circuit.load(self.circuit_id, 'history')
+                             .history), 2)
+
+    def test_same_edge(self):
+        first, second = self.load(), self.load()
+        first.edit_edge(*self.edges[0], 'RL')
+        second.edit_edge(*self.edges[0], 'Rs')
+        first.save()
+        with self.assertRaises(db.ConflictError):
+            second.save()
+
+        self.assertStoredWeights({self.edges[0]: sympy.Symbol('RL')})
+
+    def test_conflict_route(self):
+        # Another request edits the edge while this one is handled.
+        load = db.Circuit.load
+
+        def load_and_edit(circuit_id, *fields):
+            circuit = load(circuit_id, *fields)
+            other = load(circuit_id, *fields)
+            other.edit_edge(*self.edges[0], 'RL')
+            other.save()
+            return circuit
+
+        with mock.patch.object(db.Circuit, 'load', side_effect=load_and_edit):
+            response = server.app.test_client().patch(
+                f'/circuits/{self.circuit_id}/update_edge_new',
+                json={'source': self.edges[0][0],
+                      'target': self.edges[0][1], 'symbolic': 'Rs'})
+
+        self.assertEqual(response.status_code, 409)
+        self.assertStoredWeights({self.edges[0]: sympy.Symbol('RL')})
+
+
+class TestHistory(DatabaseTestCase):
+    def edges(self, circuit):
+        return list(circuit._load_sfg().edges(data=True))
+
+    def test_checkpoints(self):
+        circuit_id = create_circuit().id
+        fields = ('parameters', 'sfg', 'history', 'undone')
+
+        # The SFG before each edit, and after the last one.
+        sfgs = []
+        for i in range(25):
+            circuit = db.Circuit.load(circuit_id, *fields)
+            sfgs.append(self.edges(circuit))
+            sfg = circuit._checkout_sfg()
+            src, dst = list(sfg.edges)[i % 3]
+            sfg.edges[src, dst]['weight'] *= i + 2
+            circuit._commit_sfg(sfg)
+            circuit.save()
+        sfgs.append(self.edges(db.Circuit.load(circuit_id, 'sfg')))
+
+        history = db.Circuit.load(circuit_id, 'history').history
+        self.assertEqual(
+            [i for i, edit in enumerate(history) if edit.checkpoint],
+            [0, 10, 20])
+
+        # Undo and redo across the last checkpoint.
+        for i in reversed(range(18, 25)):
+            circuit = db.Circuit.load(circuit_id, *fields)
+            circuit.undo_sfg()
+            circuit.save()
+            self.assertEqual(self.edges(circuit), sfgs[i])
+        for i in range(19, 26):
+            circuit = db.Circuit.load(circuit_id, *fields)
+            circuit.redo_sfg()
+            circuit.save()
+            self.assertEqual(self.edges(circuit), sfgs[i])
+
+
+class TestBranches(DatabaseTestCase):
+    fields = (*server.EDIT_FIELDS, 'original_sfg', 'branches')
+
+    def edges(self, circuit_id, branch=db.MAIN_BRANCH):
+        circuit = db.Circuit.load(circuit_id, *self.fields)
+        return list(db.sfg_format.loads(circuit.branch_sfg(branch))
+                    .edges(data=True))
+
+    def change(self, circuit_id, *steps):
+        # Applies each step to the circuit, and saves it.
+        circuit = db.Circuit.load(circuit_id, *self.fields)
+        for step, *args in steps:
+            getattr(circuit, step)(*args)
+        circuit.save()
+
+    def test_checkout(self):
+        circuit_id = create_circuit().id
+        original = self.edges(circuit_id)
+        (src, dst, _), *_ = original
+
+        self.change(circuit_id, ('fork_branch', 'original'))
+        self.change(circuit_id, ('edit_edge', src, dst, 'RL'))
+        edited = self.edges(circuit_id)
+        self.change(circuit_id, ('fork_branch', 'edited'))
+        self.change(circuit_id, ('edit_edge', src, dst, 'Rs'))
+        latest = self.edges(circuit_id)
+        self.assertNotEqual(edited, original)
+        self.assertNotEqual(latest, edited)
+
+        self.change(circuit_id, ('checkout_branch', 'original'))
+        self.assertEqual(self.edges(circuit_id), original)
+        self.change(circuit_id, ('checkout_branch', 'edited'))
+        self.assertEqual(self.edges(circuit_id), edited)
+
+        # Each checkout is undone as an edit.
+        self.change(circuit_id, ('undo_sfg',))
+        self.assertEqual(self.edges(circuit_id), original)
+        self.change(circuit_id, ('undo_sfg',))
+        self.assertEqual(self.edges(circuit_id), latest)
+        self.assertEqual(self.edges(circuit_id, 'original'), original)
+        self.assertEqual(self.edges(circuit_id, 'edited'), edited)
+
+    def test_export(self):
+        circuit_id = create_circuit().id
+        (src, dst, _), *_ = self.edges(circuit_id)
+        self.change(circuit_id, ('edit_edge', src, dst, 'RL'),
+                    ('fork_branch', 'edited'),
+                    ('fork_branch', 'copy', 'edited'))
+        self.change(circuit_id, ('edit_edge', src, dst, 'Rs'))
+        branches = {name: self.edges(circuit_id, name)
+                    for name in (db.MAIN_BRANCH, 'edited', 'copy')}
+
+        export = dill.dumps(db.Circuit.load(circuit_id))
+        imported = create_circuit('2N3904_common_emitter')
+        imported.import_circuit(dill.loads(export))
+        imported.save()
+
+        self.assertEqual(
+            db.Circuit.load(imported.id, 'branches').list_branches(),
+            db.Circuit.load(circuit_id, 'branches').list_branches())
+        for name, edges in branches.items():
+            self.assertEqual(self.edges(imported.id, name), edges)
+
+        self.change(imported.id, ('checkout_branch', 'copy'))
+        self.assertEqual(self.edges(imported.id), branches['edited'])
+
+
+class TestTimeResponse(DatabaseTestCase):
+    def test_unstable(self):
+        # The reduced model of the cascode has a right half-plane pole, whose
+        # growth overflows over a window sized from the slow stable poles.
+        circuit = create_circuit()
+
+        for response in ('step', 'impulse'):
+            result = circuit.eval_time_response('Vin', 'Vout', response)
+            self.assertFalse(result['stable'])
+            self.assertNotIn(None, result['response'])
+            self.assertLess(result['time'][-1], 1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
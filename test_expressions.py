@@ -0,0 +1,40 @@
+import unittest
+from unittest import mock
+
+import sympy
+
+import expressions
+
+
+R, C, s = sympy.symbols('R C s')
+PARAMETERS = {'R': 1e3, 'C': 1e-6, 'f': 1e3}
+
+
+class TestExpressions(unittest.TestCase):
+    def test_latex_rendered_once(self):
+        weight = 1 / (1 + s * R * C + R)
+
+        with mock.patch('sympy.latex', wraps=sympy.latex) as latex:
+            first = expressions.latex(weight)
+            # A structurally equal copy, as from a de-serialized SFG.
+            second = expressions.latex(sympy.sympify(str(weight)))
+
+        self.assertEqual(first, second)
+        self.assertEqual(latex.call_count, 1)
+
+    def test_evaluate(self):
+        weight = 1 / (1 + s * R * C)
+        expected = complex(weight.subs({s: 2j * sympy.pi * 1e3, R: 1e3, C: 1e-6}))
+
+        # The first evaluation substitutes, and later ones are compiled.
+        for _ in range(3):
+            self.assertAlmostEqual(expressions.evaluate(weight, PARAMETERS), expected)
+
+    def test_edge_weight(self):
+        output = expressions.edge_weight(-2 * R / R, PARAMETERS)
+
+        self.assertEqual(output, {'symbolic': '-2', 'magnitude': 2.0, 'phase': 180.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
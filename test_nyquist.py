@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+
+import nyquist
+
+
+def third_order(gain):
+    return lambda s: gain / (1 + s / (2 * np.pi)) ** 3
+
+
+class TestAdaptiveResponse(unittest.TestCase):
+    def test_refines_near_critical_point(self):
+        # The curve passes close to -1 for a gain of 8 (the stability limit).
+        coarse = nyquist.adaptive_response(third_order(0.5), 1e-2, 1e2, 10)
+        fine = nyquist.adaptive_response(third_order(7.9), 1e-2, 1e2, 10)
+
+        self.assertGreater(len(fine['frequency']), len(coarse['frequency']))
+        self.assertTrue(np.all(np.diff(fine['frequency']) > 0))
+
+    def test_max_points(self):
+        result = nyquist.adaptive_response(third_order(7.99), 1e-2, 1e2, 10,
+                                           max_points=50)
+
+        self.assertEqual(len(result['frequency']), 50)
+
+
+class TestEncirclements(unittest.TestCase):
+    def test_stable(self):
+        result = nyquist.adaptive_response(third_order(0.5), 1e-3, 1e3, 10)
+
+        self.assertEqual(nyquist.encirclements(result['response']),
+                         {'encirclements': 0, 'exact': True})
+
+    def test_unstable(self):
+        # 1 + L has two right half-plane zeros for gains above 8.
+        result = nyquist.adaptive_response(third_order(10), 1e-3, 1e3, 10)
+
+        self.assertEqual(nyquist.encirclements(result['response']),
+                         {'encirclements': 2, 'exact': True})
+
+    def test_critical_point(self):
+        result = nyquist.adaptive_response(third_order(-10), 1e-3, 1e3, 10,
+                                           critical_point=1)
+
+        self.assertEqual(
+            nyquist.encirclements(result['response'], critical_point=1),
+            {'encirclements': 2, 'exact': True})
+
+    def test_open_contour(self):
+        # An integrator is not real at either end of the range.
+        result = nyquist.adaptive_response(lambda s: 1 / s, 1e-3, 1e3, 10)
+
+        self.assertFalse(nyquist.encirclements(result['response'])['exact'])
+
+
+if __name__ == '__main__':
+    unittest.main()
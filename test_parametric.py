@@ -0,0 +1,280 @@
+import unittest
+
+import numpy as np
+import sympy
+
+import analysis
+import rendering
+from parametric import (
+    ParametricFunction,
+    ParametricVector,
+    SensitivityFunction,
+    frequency_points,
+    phase_margin,
+)
+
+
+R, C, s = sympy.symbols('R C s')
+
+# First-order low-pass filter.
+LOW_PASS = 1 / (1 + s * R * C)
+
+
+class TestParametricFunction(unittest.TestCase):
+    def test_scalar_parameters(self):
+        function = ParametricFunction(LOW_PASS)
+        freq, s_values = frequency_points(1, 1e6, 10)
+
+        output = function(s_values, {'R': 1e3, 'C': 1e-6})
+        expected = 1 / (1 + s_values * 1e-3)
+
+        self.assertEqual(function.parameter_names, ('C', 'R'))
+        np.testing.assert_allclose(output, expected)
+
+    def test_batched_parameters(self):
+        function = ParametricFunction(LOW_PASS)
+        _, s_values = frequency_points(1, 1e6, 10)
+        capacitances = np.array([1e-9, 1e-6, 1e-3])
+
+        output = function(s_values, {'R': 1e3, 'C': capacitances})
+
+        self.assertEqual(output.shape, (3, len(s_values)))
+        for row, capacitance in zip(output, capacitances):
+            np.testing.assert_allclose(row, 1 / (1 + s_values * 1e3 * capacitance))
+
+    def test_constant_expression(self):
+        function = ParametricFunction(sympy.Integer(2))
+        _, s_values = frequency_points(1, 1e3, 10)
+
+        output = function(s_values, {'R': np.ones(4)})
+
+        self.assertEqual(output.shape, (4, len(s_values)))
+        np.testing.assert_allclose(output, 2)
+
+    def test_missing_parameter(self):
+        function = ParametricFunction(LOW_PASS)
+
+        with self.assertRaises(ValueError):
+            function(np.array([1j]), {'R': 1.0})
+
+    def test_phase_margin(self):
+        # An integrator with unity gain at 1 rad/s has 90 degrees of margin.
+        function = ParametricFunction(1 / s)
+        _, s_values = frequency_points(1e-3, 1e3, 100)
+
+        output = function(s_values, {})
+
+        self.assertAlmostEqual(float(phase_margin(None, output)), 90)
+
+
+class TestParametricVector(unittest.TestCase):
+    def test_edge_weights(self):
+        # Edge weights as in an SFG, including a plain number.
+        function = ParametricVector([LOW_PASS, s * C, 1 / R, 1])
+        _, s_values = frequency_points(1, 1e6, 10)
+
+        output = function(s_values, {'R': 1e3, 'C': 1e-6})
+
+        self.assertEqual(function.parameter_names, ('C', 'R'))
+        self.assertEqual(output.shape, (4, len(s_values)))
+        np.testing.assert_allclose(output[0], 1 / (1 + s_values * 1e-3))
+        np.testing.assert_allclose(output[1], s_values * 1e-6)
+        np.testing.assert_allclose(output[2], 1e-3)
+        np.testing.assert_allclose(output[3], 1)
+
+
+class TestSensitivityFunction(unittest.TestCase):
+    def test_low_pass(self):
+        function = SensitivityFunction(LOW_PASS)
+        _, s_values = frequency_points(1, 1e6, 10)
+
+        output = function(s_values, {'R': 1e3, 'C': 1e-6})
+
+        # Both parameters appear as the product R * C, so their
+        # sensitivities are equal: -s R C / (1 + s R C).
+        expected = -s_values * 1e-3 / (1 + s_values * 1e-3)
+        self.assertEqual(output.shape, (2, len(s_values)))
+        np.testing.assert_allclose(output[0], expected)
+        np.testing.assert_allclose(output[1], expected)
+
+    def test_constant_sensitivity(self):
+        # A gain proportional to R has unit sensitivity to R at all
+        # frequencies.
+        function = SensitivityFunction(R * LOW_PASS)
+        _, s_values = frequency_points(1, 1e6, 10)
+
+        output = function(s_values, {'R': 1e3, 'C': 1e-6})
+
+        np.testing.assert_allclose(
+            output[function.parameter_names.index('R')],
+            1 - s_values * 1e-3 / (1 + s_values * 1e-3))
+
+
+class TestSweep(unittest.TestCase):
+    def test_grid_shape(self):
+        freq, _ = frequency_points(1, 1e9, 20)
+        result = analysis.sweep(
+            LOW_PASS, freq, {'R': 1e3, 'C': 1e-6},
+            axes=[{'name': 'R', 'scale': 'log', 'start': 1e2, 'stop': 1e4, 'num': 3},
+                  {'name': 'C', 'values': [1e-9, 1e-6]}],
+            metrics=['bandwidth', 'dc_gain']
+        )
+
+        self.assertEqual(result['shape'], [3, 2])
+        self.assertEqual(np.shape(result['metrics']['bandwidth']), (3, 2))
+        np.testing.assert_allclose(result['metrics']['dc_gain'], 0, atol=0.1)
+
+        # The bandwidth is inversely proportional to R * C.
+        bandwidth = np.array(result['metrics']['bandwidth'])
+        self.assertTrue(np.all(np.diff(bandwidth, axis=0) < 0))
+        self.assertTrue(np.all(np.diff(bandwidth, axis=1) < 0))
+
+    def test_corners(self):
+        freq, _ = frequency_points(1, 1e9, 20)
+        result = analysis.sweep(
+            LOW_PASS, freq, {'R': 1e3, 'C': 1e-6},
+            corners=[{'R': 1e2}, {'R': 1e4, 'C': 1e-9}],
+            metrics=['dc_gain']
+        )
+
+        self.assertEqual(result['shape'], [2])
+        self.assertEqual(result['parameters'], {'R': [1e2, 1e4], 'C': [1e-6, 1e-9]})
+
+    def test_invalid_parameter(self):
+        freq, _ = frequency_points(1, 1e9, 20)
+
+        with self.assertRaises(ValueError):
+            analysis.sweep(LOW_PASS, freq, {'R': 1e3, 'C': 1e-6},
+                           axes=[{'name': 'L', 'values': [1.0]}])
+
+    def test_grid_too_large(self):
+        freq, _ = frequency_points(1, 1e9, 20)
+        axis = {'scale': 'linear', 'start': 1, 'stop': 2, 'num': 1000}
+
+        # The size is checked before the grid is built.
+        with self.assertRaises(ValueError):
+            analysis.sweep(LOW_PASS, freq, {'R': 1e3, 'C': 1e-6},
+                           axes=[{'name': 'R', **axis}, {'name': 'C', **axis}])
+
+        with self.assertRaises(ValueError):
+            analysis.sweep(LOW_PASS, freq, {'R': 1e3, 'C': 1e-6},
+                           axes=[{'name': 'R', **axis, 'num': 10 ** 9}])
+
+    def test_process_pool(self):
+        # Large grids are evaluated by workers which are not forked from the
+        # server.
+        freq, _ = frequency_points(1, 1e3, 2)
+        num = analysis.PROCESS_POOL_THRESHOLD + 1
+        result = analysis.sweep(
+            LOW_PASS, freq, {'R': 1e3, 'C': 1e-6},
+            axes=[{'name': 'R', 'scale': 'linear', 'start': 1e3, 'stop': 2e3,
+                   'num': num}],
+            metrics=['dc_gain']
+        )
+
+        self.assertEqual(result['shape'], [num])
+        self.assertIs(analysis._get_process_pool()._mp_context,
+                      rendering.process_context())
+
+
+class TestMonteCarlo(unittest.TestCase):
+    def test_sample_parameters(self):
+        rng = np.random.default_rng(0)
+        samples = analysis.sample_parameters(
+            {'R': {'tolerance': 0.05}, 'C*': {'type': 'normal', 'tolerance': 0.2}},
+            {'R': 1e3, 'C': 1e-6, 'L': 1.0}, 1000, rng
+        )
+
+        self.assertEqual(set(samples), {'R', 'C'})
+        self.assertTrue(np.all(np.abs(samples['R'] / 1e3 - 1) <= 0.05))
+        self.assertAlmostEqual(np.std(samples['C'] / 1e-6), 0.2 / 3, places=2)
+
+    def test_summary(self):
+        freq, _ = frequency_points(1, 1e9, 20)
+        result = analysis.montecarlo(
+            LOW_PASS, freq, {'R': 1e3, 'C': 1e-6},
+            {'R': {'tolerance': 0.05}}, 500,
+            metrics=['bandwidth'], bins=10, percentiles=[50], seed=0
+        )
+
+        summary = result['metrics']['bandwidth']
+        self.assertEqual(result['parameters'], ['R'])
+        self.assertEqual(sum(summary['histogram']['counts']), 500)
+        self.assertEqual(len(summary['histogram']['edges']), 11)
+        # The median bandwidth is close to the nominal 1 / (2 pi R C).
+        self.assertAlmostEqual(summary['percentiles']['50'] / 159.15, 1, delta=0.1)
+
+    def test_unmatched_distributions(self):
+        freq, _ = frequency_points(1, 1e9, 20)
+
+        with self.assertRaises(ValueError):
+            analysis.montecarlo(LOW_PASS, freq, {'R': 1e3, 'C': 1e-6},
+                                {'L': {'tolerance': 0.1}}, 10)
+
+
+class TestSolveFor(unittest.TestCase):
+    def test_single_parameter(self):
+        freq, _ = frequency_points(1, 1e9, 200)
+        result = analysis.solve_for(
+            LOW_PASS, freq, {'R': 1e3, 'C': 1e-6}, 'bandwidth', 1e4,
+            [{'name': 'C', 'min': 1e-12, 'max': 1e-3}]
+        )
+
+        # The bandwidth is only computed on the frequency grid, which is too
+        # coarse to meet the default tolerance.
+        self.assertTrue(result['bracketed'])
+        self.assertFalse(result['converged'])
+        # The bandwidth is 1 / (2 pi R C).
+        self.assertAlmostEqual(
+            result['parameters']['C'] / (1 / (2 * np.pi * 1e3 * 1e4)), 1, delta=0.05)
+
+    def test_multiple_parameters(self):
+        gain = sympy.Symbol('A') * sympy.Symbol('B') * LOW_PASS
+        freq, _ = frequency_points(1e-3, 1e3, 20)
+        result = analysis.solve_for(
+            gain, freq, {'A': 1.0, 'B': 1.0, 'R': 1.0, 'C': 1e-6}, 'dc_gain', 20,
+            [{'name': 'A', 'min': 0.1, 'max': 10}, {'name': 'B', 'min': 0.1, 'max': 10}]
+        )
+
+        self.assertTrue(result['converged'])
+        self.assertAlmostEqual(
+            result['parameters']['A'] * result['parameters']['B'], 10, delta=0.1)
+
+    def test_unreachable_target(self):
+        freq, _ = frequency_points(1, 1e9, 20)
+        result = analysis.solve_for(
+            LOW_PASS, freq, {'R': 1e3, 'C': 1e-6}, 'dc_gain', 20,
+            [{'name': 'C', 'min': 1e-12, 'max': 1e-3}]
+        )
+
+        self.assertFalse(result['converged'])
+        self.assertFalse(result['bracketed'])
+
+    def test_within_grid_tolerance(self):
+        freq, _ = frequency_points(1, 1e9, 200)
+        result = analysis.solve_for(
+            LOW_PASS, freq, {'R': 1e3, 'C': 1e-6}, 'bandwidth', 1e4,
+            [{'name': 'C', 'min': 1e-12, 'max': 1e-3}], tolerance=0.02
+        )
+
+        self.assertTrue(result['converged'])
+        self.assertAlmostEqual(result['metric'] / 1e4, 1, delta=0.02)
+
+    def test_undefined_metric_skipped(self):
+        # The error is undefined at some points of the bracket, which must
+        # not be taken for sign changes.
+        def error(x):
+            err = x[:, 0] - 0.3
+            err[(x[:, 0] > 0.282) & (x[:, 0] < 0.29)] = np.nan
+            return err
+
+        x, err, converged, bracketed = analysis._bracket_search(
+            error, 0.5, 1e-6, 50)
+
+        self.assertTrue(converged)
+        self.assertTrue(bracketed)
+        self.assertAlmostEqual(x[0], 0.3, delta=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+
+import numpy as np
+
+from parametric import frequency_points
+from rational import PoleResidueModel, reduce_order, vector_fit
+
+
+class TestVectorFit(unittest.TestCase):
+    def test_real_poles(self):
+        _, s = frequency_points(1, 1e9, 20)
+        response = 10 / ((1 + s / 1e3) * (1 + s / 1e6))
+
+        model = vector_fit(s, response, 2)
+
+        self.assertLess(model.error, 1e-6)
+        np.testing.assert_allclose(sorted(model.poles.real), [-1e6, -1e3], rtol=1e-6)
+
+    def test_complex_poles(self):
+        _, s = frequency_points(1, 1e8, 20)
+        # A resonance at 1e5 rad/s with Q = 5, followed by a real pole.
+        resonance = 1 / (1 + s / 5e5 + (s / 1e5) ** 2)
+        response = resonance / (1 + s / 1e7)
+
+        model = vector_fit(s, response, 3)
+
+        self.assertLess(model.error, 1e-6)
+        np.testing.assert_allclose(model(s), response, rtol=1e-5)
+
+    def test_right_half_plane_zero(self):
+        _, s = frequency_points(1, 1e9, 20)
+        response = (1 - s / 1e5) / (1 + s / 1e3)
+
+        model = vector_fit(s, response, 1)
+
+        self.assertLess(model.error, 1e-6)
+        self.assertAlmostEqual(model.direct, -1e-2, places=6)
+
+
+class TestTimeResponse(unittest.TestCase):
+    def test_first_order(self):
+        model = PoleResidueModel([-1e3], [1e3], 0)
+        t = np.linspace(0, 5e-3, 50)
+
+        np.testing.assert_allclose(model.step(t), 1 - np.exp(-1e3 * t))
+        np.testing.assert_allclose(model.impulse(t), 1e3 * np.exp(-1e3 * t))
+        self.assertAlmostEqual(model.time_constant(), 1e-3)
+
+    def test_underdamped(self):
+        _, s = frequency_points(1, 1e8, 20)
+        # Q = 5 resonance at 1e5 rad/s.
+        response = 1 / (1 + s / 5e5 + (s / 1e5) ** 2)
+        model = vector_fit(s, response, 2)
+        t = np.linspace(0, 1e-3, 200)
+
+        zeta = 0.1
+        omega_d = 1e5 * np.sqrt(1 - zeta ** 2)
+        expected = 1 - np.exp(-zeta * 1e5 * t) * (
+            np.cos(omega_d * t) + zeta / np.sqrt(1 - zeta ** 2) * np.sin(omega_d * t))
+        np.testing.assert_allclose(model.step(t), expected, atol=1e-5)
+
+    def test_unstable(self):
+        # The slow stable pole would overflow the fast growing one long
+        # before it settles.
+        model = PoleResidueModel([-1, 1e6], [1, 1], 0)
+        t = np.linspace(0, 10 * model.time_constant(), 50)
+
+        self.assertAlmostEqual(model.time_constant(), 1e-6)
+        self.assertTrue(np.all(np.isfinite(model.step(t))))
+        self.assertAlmostEqual(model.impulse(t)[-1] / np.exp(10), 1,
+                               places=3)
+
+    def test_integrator(self):
+        model = PoleResidueModel([0], [2], 0)
+        t = np.linspace(0, 1, 5)
+
+        np.testing.assert_allclose(model.step(t), 2 * t)
+
+
+class TestReduceOrder(unittest.TestCase):
+    def test_lowest_order(self):
+        _, s = frequency_points(1, 1e9, 20)
+        response = 10 / ((1 + s / 1e3) * (1 + s / 1e6))
+
+        model = reduce_order(s, response, tolerance=1e-4)
+
+        self.assertEqual(model.order, 2)
+        self.assertEqual(len(model.to_dict()['poles']), 2)
+
+    def test_non_finite_response(self):
+        _, s = frequency_points(1, 1e3, 10)
+
+        with self.assertRaises(ValueError):
+            reduce_order(s, np.full(len(s), np.nan))
+
+
+if __name__ == '__main__':
+    unittest.main()
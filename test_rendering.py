@@ -0,0 +1,81 @@
+import multiprocessing
+import unittest
+from unittest import mock
+
+import sympy
+
+import rendering
+
+
+R, C, s = sympy.symbols('R C s')
+
+
+class TestRendering(unittest.TestCase):
+    def test_simplify(self):
+        expression = (s + 1) / (s ** 2 + 3 * s + 2) + R
+
+        for strategy in ('factor', 'cancel', 'collect'):
+            with self.subTest(strategy=strategy):
+                simplified = rendering.simplify(expression, strategy)
+                self.assertEqual(sympy.simplify(simplified - expression), 0)
+
+        self.assertEqual(rendering.simplify(expression, 'factor'),
+                         (R * s + 2 * R + 1) / (s + 2))
+
+        with self.assertRaises(ValueError):
+            rendering.simplify(expression, 'expand')
+
+    def test_render(self):
+        expression = (s + 1) / (s ** 2 + 3 * s + 2)
+
+        text, complete = rendering.render(expression, latex=False, budget=60)
+        self.assertEqual(text, '1/(s + 2)')
+        self.assertTrue(complete)
+
+    def test_render_without_factor(self):
+        expression = (s + 1) / (s ** 2 + 3 * s + 2)
+
+        text, complete = rendering.render(expression, factor=False)
+        self.assertEqual(text, sympy.latex(expression))
+        self.assertTrue(complete)
+
+    def test_render_out_of_time(self):
+        expression = R / (s ** 2 + 3 * s + 2)
+
+        # Nothing is ready yet, so the expression is returned unsimplified.
+        text, complete = rendering.render(expression, latex=False, budget=0)
+        self.assertEqual(text, str(expression))
+        self.assertFalse(complete)
+
+    def test_preview(self):
+        numerator = sympy.Add(*(R ** i * s ** i for i in range(10)))
+        expression = numerator / (1 + s * R * C)
+
+        text, terms = rendering.preview(expression, max_terms=3, latex=False)
+        self.assertEqual(terms, 12)
+        self.assertIn('(7 more terms)', text)
+        self.assertEqual(text.count(' + '), 4)
+
+        text, terms = rendering.preview(expression, max_terms=10)
+        self.assertNotIn('more terms', text)
+        self.assertTrue(text.startswith(r'\frac{'))
+
+    def test_spawn_without_forkserver(self):
+        # forkserver is not available on Windows.
+        get_context = multiprocessing.get_context
+
+        def without_forkserver(method=None):
+            if method == 'forkserver':
+                raise ValueError('cannot find context for forkserver')
+            return get_context(method)
+
+        with mock.patch.object(rendering, '_context', None), \
+                mock.patch.object(multiprocessing, 'get_context',
+                                  without_forkserver):
+            context = rendering.process_context()
+
+        self.assertEqual(context.get_start_method(), 'spawn')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import pickle
+import unittest
+
+import dill
+import networkx as nx
+import sympy
+
+import sfg_format
+
+
+R1, R2, C, s = sympy.symbols('R1 R2 C s')
+
+
+def example_sfg() -> nx.DiGraph:
+    graph = nx.DiGraph()
+    graph.add_edge('Vin', 'I1', weight=1 / R1)
+    graph.add_edge('I1', 'V1', weight=1 / (C * s + 1 / R1 + 1 / R2))
+    graph.add_edge('V1', 'I1', weight=-1 / R2)
+    graph.add_edge('V1', 'Vout', weight=sympy.Integer(1))
+    graph.add_edge('Vout', 'I2', weight=1 / R1)
+    return graph
+
+
+class TestSFGFormat(unittest.TestCase):
+    def test_round_trip(self):
+        graph = example_sfg()
+
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                data = sfg_format.dumps(graph, compress=compress)
+                loaded = sfg_format.loads(data)
+
+                self.assertTrue(sfg_format.is_packed(data))
+                self.assertEqual(list(loaded.nodes), list(graph.nodes))
+                self.assertEqual(list(loaded.edges), list(graph.edges))
+                for edge in graph.edges:
+                    self.assertEqual(loaded.edges[edge]['weight'],
+                                     graph.edges[edge]['weight'])
+
+    def test_expressions_stored_once(self):
+        graph = example_sfg()
+        data = sfg_format.dumps(graph)
+
+        tables = sfg_format._unpack(data)
+        self.assertEqual(len(tables['edges']), 5)
+        self.assertEqual(len(tables['expressions']), 4)
+
+    def test_expression_round_trip(self):
+        expressions = [
+            sympy.pi * sympy.exp(-s / 3) + sympy.Float(2.5) * sympy.sqrt(C),
+            sympy.I * R1 - sympy.Rational(3, 7),
+            sympy.Integer(-12),
+        ]
+
+        for expression in expressions:
+            with self.subTest(expression=expression):
+                tokens = sfg_format.encode_expression(expression)
+                self.assertEqual(sfg_format.decode_expression(tokens),
+                                 expression)
+
+                data = sfg_format.dumps_expression(expression, compress=True)
+                self.assertEqual(sfg_format.loads_expression(data), expression)
+
+    def test_digest(self):
+        expression = 1 / (C * s + 1 / R1 + 1 / R2)
+
+        # Equal expressions, however they were built, have equal digests.
+        self.assertEqual(sfg_format.digest(expression),
+                         sfg_format.digest(sympy.sympify(str(expression))))
+        self.assertNotEqual(sfg_format.digest(expression),
+                            sfg_format.digest(1 / (C * s + 1 / R1)))
+
+    def test_lazy_reader(self):
+        reader = sfg_format.SFGReader(sfg_format.dumps(example_sfg()))
+
+        self.assertEqual(reader.weight('V1', 'I1'), -1 / R2)
+        self.assertEqual(sum(e is not None for e in reader._decoded), 1)
+
+        self.assertIn('Vout', reader)
+        self.assertTrue(reader.has_edge('V1', 'Vout'))
+        self.assertFalse(reader.has_edge('Vout', 'V1'))
+        self.assertEqual(list(reader.in_edges('I1')),
+                         [('Vin', 'I1'), ('V1', 'I1')])
+        self.assertEqual(list(reader.out_edges('V1')),
+                         [('V1', 'I1'), ('V1', 'Vout')])
+        self.assertEqual(list(reader.in_edges('Vin')), [])
+        self.assertEqual(list(reader.out_edges('missing')), [])
+
+        # Data written by dill has the same edges.
+        legacy = sfg_format.SFGReader(dill.dumps(example_sfg()))
+        for node in (*example_sfg().nodes, 'missing'):
+            self.assertEqual(list(legacy.in_edges(node)),
+                             list(reader.in_edges(node)))
+            self.assertEqual(list(legacy.out_edges(node)),
+                             list(reader.out_edges(node)))
+
+    def test_merge(self):
+        base = example_sfg()
+        ours = base.copy()
+        ours.edges['Vin', 'I1']['weight'] = 2 / R1
+        theirs = base.copy()
+        theirs.remove_edge('Vout', 'I2')
+        theirs.add_edge('Vout', 'I3', weight=1 / R2)
+
+        merged = sfg_format.loads(sfg_format.merge(
+            sfg_format.dumps(base), sfg_format.dumps(ours),
+            sfg_format.dumps(theirs)
+        ))
+        self.assertEqual(merged.edges['Vin', 'I1']['weight'], 2 / R1)
+        self.assertFalse(merged.has_edge('Vout', 'I2'))
+        self.assertEqual(merged.edges['Vout', 'I3']['weight'], 1 / R2)
+
+        # Both change the same edge.
+        theirs.edges['Vin', 'I1']['weight'] = 3 / R1
+        with self.assertRaises(ValueError):
+            sfg_format.merge(sfg_format.dumps(base), sfg_format.dumps(ours),
+                             sfg_format.dumps(theirs))
+
+    def test_diff_and_patch(self):
+        old = example_sfg()
+        new = old.copy()
+        new.remove_edge('Vout', 'I2')
+        new.remove_node('I2')
+        new.edges['V1', 'I1']['weight'] = -2 / R2
+        new.add_edge('I1', 'Vout', weight=C * s)
+
+        old_data = sfg_format.dumps(old)
+        new_data = sfg_format.dumps(new)
+        delta = sfg_format.diff(old_data, new_data)
+
+        self.assertTrue(sfg_format.equal(
+            sfg_format.patch(old_data, delta), new_data))
+        self.assertTrue(sfg_format.equal(
+            sfg_format.patch(new_data, delta, reverse=True), old_data))
+        self.assertIsNone(sfg_format.diff(old_data, old_data))
+
+        # The delta no longer applies once the edges it changes were changed.
+        with self.assertRaises(ValueError):
+            sfg_format.patch(old_data, delta, reverse=True)
+
+    def test_content_digest(self):
+        graph = example_sfg()
+        reordered = nx.DiGraph()
+        reordered.add_nodes_from(reversed(list(graph.nodes)))
+        reordered.add_edges_from(reversed(list(graph.edges(data=True))))
+
+        digest = sfg_format.content_digest(sfg_format.dumps(graph))
+        self.assertEqual(
+            sfg_format.content_digest(sfg_format.dumps(reordered)), digest)
+        self.assertEqual(
+            sfg_format.content_digest(dill.dumps(graph)), digest)
+
+        graph.edges['V1', 'Vout']['weight'] = sympy.Integer(2)
+        self.assertNotEqual(
+            sfg_format.content_digest(sfg_format.dumps(graph)), digest)
+
+    def test_canonical_form(self):
+        graph = example_sfg()
+        names = {'Vin': 'in', 'I1': 'Ia', 'V1': 'Va', 'Vout': 'out',
+                 'I2': 'Ib'}
+        relabeled = nx.relabel_nodes(graph, names)
+
+        fingerprint, labels = sfg_format.canonical_form(
+            sfg_format.dumps(graph))
+        other, other_labels = sfg_format.canonical_form(
+            sfg_format.dumps(relabeled))
+        self.assertEqual(other, fingerprint)
+        self.assertEqual({names[n]: i for n, i in labels.items()},
+                         other_labels)
+
+        graph.edges['V1', 'Vout']['weight'] = sympy.Integer(2)
+        self.assertNotEqual(
+            sfg_format.canonical_form(sfg_format.dumps(graph))[0],
+            fingerprint)
+
+    def test_canonical_form_symmetric(self):
+        # The two branches cannot be told apart by their edges alone.
+        graph = nx.DiGraph()
+        for a, b in (('A', 'B'), ('C', 'D')):
+            graph.add_edge('Vin', a, weight=R1)
+            graph.add_edge(a, b, weight=R2)
+            graph.add_edge(b, 'Vout', weight=C)
+        relabeled = nx.relabel_nodes(graph, {'A': 'D', 'B': 'C', 'C': 'B',
+                                             'D': 'A'})
+
+        fingerprint, labels = sfg_format.canonical_form(
+            sfg_format.dumps(graph))
+        self.assertEqual(sorted(labels.values()), list(range(6)))
+        self.assertEqual(
+            sfg_format.canonical_form(sfg_format.dumps(relabeled))[0],
+            fingerprint)
+
+    def test_legacy_dill(self):
+        graph = example_sfg()
+
+        loaded = sfg_format.loads(dill.dumps(graph))
+        self.assertEqual(list(loaded.edges), list(graph.edges))
+
+        expression = 1 / (C * s + 1 / R1)
+        self.assertEqual(sfg_format.loads_expression(dill.dumps(expression)),
+                         expression)
+
+    def test_rejects_objects(self):
+        data = sfg_format.MAGIC + bytes((sfg_format.FORMAT_VERSION, 0)) + \
+            pickle.dumps({'expression': R1})
+
+        with self.assertRaises(pickle.UnpicklingError):
+            sfg_format.loads_expression(data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from unittest import mock
+
+import networkx as nx
+import sympy
+
+import mason
+import symbolic
+
+
+def example_sfg() -> nx.DiGraph:
+    a, b, c, d, R, C, s = sympy.symbols('a b c d R C s')
+    graph = nx.DiGraph()
+    graph.add_edge('in', 'x', weight=a)
+    graph.add_edge('x', 'y', weight=1 / (1 + s * R * C))
+    graph.add_edge('y', 'x', weight=-b)
+    graph.add_edge('y', 'out', weight=c)
+    graph.add_edge('out', 'out', weight=-d * s)
+    return graph
+
+
+@unittest.skipIf(symbolic.symengine is None, 'SymEngine is not installed.')
+class TestSymEngineBackend(unittest.TestCase):
+    def test_mason_results_match(self):
+        with mock.patch.object(symbolic, 'BACKEND', 'symengine'):
+            fast_tf, fast_lg = mason.transfer_function(example_sfg(), 'in', 'out')
+        with mock.patch.object(symbolic, 'BACKEND', 'sympy'):
+            tf, lg = mason.transfer_function(example_sfg(), 'in', 'out')
+
+        self.assertIsInstance(fast_tf, sympy.Expr)
+        self.assertEqual(sympy.simplify(fast_tf - tf), 0)
+        self.assertEqual(sympy.simplify(fast_lg - lg), 0)
+
+    def test_subs(self):
+        R, C, s = sympy.symbols('R C s')
+        expression = 1 / (1 + s * R * C)
+
+        with mock.patch.object(symbolic, 'BACKEND', 'symengine'):
+            result = symbolic.subs(expression, {'R': 1e3, 'C': 1e-6})
+
+        self.assertIsInstance(result, sympy.Expr)
+        self.assertAlmostEqual(complex(result.subs(s, 1000j)), 1 / (1 + 1j))
+
+
+if __name__ == '__main__':
+    unittest.main()